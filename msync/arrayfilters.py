@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Обновления вложенных списков через arrayFilters (MongoDB 3.6+).
+
+Позиционный оператор $ обновляет только первый подходящий элемент и может
+встречаться в пути один раз, поэтому списки внутри списков через него не
+обновить. Если в Meta sync класса включен array_filters, то каждый $ в путях
+обновления заменяется на $[eN], а условие для eN берется из фильтра
+документа по pk вложенного объекта:
+    фильтр:     {'bs.cs.id': 4}
+    обновление: {'$set': {'bs.$.cs.$.name': 'x'}}
+превращаются в
+    обновление:   {'$set': {'bs.$[e0].cs.$[e1].name': 'x'}}
+    arrayFilters: [{'e0.cs.id': 4}, {'e1.id': 4}]
+Так одно обновление меняет все подходящие элементы на любой глубине.
+
+pymongo 2.x не умеет передавать arrayFilters, поэтому обновление выполняется
+командой update.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+import six
+from bson import SON
+from pymongo.errors import OperationFailure
+
+
+def has_positional(update):
+    return any('$' in path.split('.') for fields in six.itervalues(update) for path in fields)
+
+
+def to_array_filters(query, update):
+    """
+    :param query: фильтр документа в формате монги
+    :param update: обновление в формате монги с позиционными $
+    :returns tuple: обновление с $[eN] и список arrayFilters
+    """
+    identifiers = OrderedDict()
+    array_filters = []
+    new_update = {}
+    for op, fields in six.iteritems(update):
+        new_fields = new_update.setdefault(op, {})
+        for path, value in six.iteritems(fields):
+            prefix, parts = [], []
+            for part in path.split('.'):
+                if part != '$':
+                    prefix.append(part)
+                    parts.append(part)
+                    continue
+
+                prefix_path = '.'.join(prefix)
+                if prefix_path not in identifiers:
+                    identifier = 'e%s' % len(identifiers)
+                    array_filter = _get_array_filter(query, identifier, prefix_path)
+                    # если фильтр не ограничивает элементы списка, то обновляются все
+                    identifiers[prefix_path] = identifier if array_filter else None
+                    if array_filter:
+                        array_filters.append(array_filter)
+
+                identifier = identifiers[prefix_path]
+                parts.append('$[%s]' % identifier if identifier is not None else '$[]')
+            new_fields['.'.join(parts)] = value
+    return new_update, array_filters
+
+
+def _get_array_filter(query, identifier, prefix_path):
+    start = prefix_path + '.'
+    return {'%s.%s' % (identifier, key[len(start):]): value
+            for key, value in six.iteritems(query) if key.startswith(start)}
+
+
+def get_update_statement(query, update, array_filters, upsert=False, multi=True):
+    statement = {'q': query, 'u': update, 'multi': multi, 'upsert': upsert}
+    if array_filters:
+        statement['arrayFilters'] = array_filters
+    return statement
+
+
+def update_with_array_filters(document_cls, query, update, array_filters, upsert=False):
+    """Выполняет обновление командой update и возвращает количество найденных документов"""
+    return run_update_statements(document_cls, [get_update_statement(query, update, array_filters, upsert)])
+
+
+def run_update_statements(document_cls, statements):
+    """Выполняет несколько обновлений одной командой update и возвращает количество найденных документов"""
+    collection = document_cls._get_collection()
+    result = collection.database.command(SON([('update', collection.name), ('updates', statements)]))
+    write_errors = result.get('writeErrors')
+    if write_errors:
+        raise OperationFailure(write_errors[0].get('errmsg'), write_errors[0].get('code'))
+    return result.get('n', 0)
@@ -1,73 +1,332 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import six
-from six.moves import reduce
 import logging
-import operator
-from collections import defaultdict
-from .queryset import QSPk
+import threading
+from collections import defaultdict, OrderedDict
+from mongoengine.errors import NotUniqueError
+from mongoengine.queryset import transform
+from .arrayfilters import has_positional, to_array_filters, update_with_array_filters
+from .merge import merge_updates, to_mongo_update, RawUpdate
+from .queryset import QSPk, QSCreate, QSDeleteIn
+from .rebuild import RebuildLog
+from .routing import get_db_alias_for, route_to
 from .tasks import sync_task
-from .utils import measure_time
+from .utils import chunks, measure_time, replace_documents
+from .writebehind import get_flusher
 
 
 logger = logging.getLogger(__name__)
 
 
+class BatchScope(object):
+    """
+    Контекстный менеджер, внутри которого все BatchQuery и BatchTask одного
+    sync класса накапливают запросы и таски в общий батч, а выполняются они
+    один раз при выходе из контекста. Полезен для каскадных удалений и других
+    массовых операций, где django шлет сигнал на каждый объект:
+        with BatchScope():
+            Foo.objects.filter(...).delete()
+    Для асинхронных sync классов это значит, что таски всего контекста
+    отправляются вместе, порциями. Вложенные BatchScope используют внешний.
+    """
+
+    _local = threading.local()
+
+    def __init__(self):
+        self._batches = OrderedDict()
+        self._outer = None
+
+    @classmethod
+    def get_current(cls):
+        return getattr(cls._local, 'scope', None)
+
+    def get_batch(self, batch_cls, sync_cls, using=None):
+        key = (batch_cls, sync_cls, using)
+        if key not in self._batches:
+            self._batches[key] = batch_cls(sync_cls, using=using)
+        return self._batches[key]
+
+    def __enter__(self):
+        self._outer = self.get_current()
+        if self._outer is None:
+            self._local.scope = self
+        return self
+
+    def __exit__(self, t, value, traceback):
+        if self._outer is not None:
+            return
+
+        self._local.scope = None
+        try:
+            for batch in self._batches.values():
+                batch.run()
+        finally:
+            self._batches.clear()
+
+
 class BatchQuery(object):
     """
     BatchQuery является контекстным менеджером и используется для
     накопления запросов и их слияния, если это возможно.
     Т.е. BatchQuery пытается сделать как можно меньше запросов к базе.
-    Запросы будут слиты, если аргументы к функции filter() у них одинаковы.
+    Запросы будут слиты, если аргументы к функции filter() у них одинаковы
+    (с учетом операторов, см. msync.merge), а удаления собираются в один запрос с $in на коллекцию и на каждое
+    вложенное поле.
+
+    Внутри BatchScope контекст возвращает общий батч этого sync класса,
+    который выполнится при выходе из BatchScope.
+
+    Если у sync класса включен shadow_rebuild, то фильтры всех измененных
+    документов записываются в журнал перестроения коллекции (см. msync.rebuild).
+
+    using - база django, из которой пришли изменения. Для каждой базы свой
+    батч, а запросы идут в соединение монги этой базы (см. msync.routing).
     """
 
-    def __init__(self, sync_cls):
+    def __init__(self, sync_cls, using=None):
         self._sync_cls = sync_cls
+        self._using = using
         self._qs_collection = defaultdict(list)
+        self._removals = OrderedDict()
+        self._deleted_instances = []
+        self._new_documents = []
+        self._after_run = []
+        self._scope = None
 
     @property
     def qs_collection(self):
         return self._qs_collection
 
     def __enter__(self):
+        self._scope = BatchScope.get_current()
+        if self._scope is not None:
+            return self._scope.get_batch(BatchQuery, self._sync_cls, self._using)
+
         self._qs_collection.clear()
+        self._removals.clear()
+        del self._deleted_instances[:]
+        del self._new_documents[:]
+        del self._after_run[:]
         return self
 
     def __exit__(self, t, value, traceback):
-        self.run()
+        if self._scope is None:
+            self.run()
+        self._scope = None
+
+    def insert(self, document):
+        """
+        Откладывает вставку нового документа до выполнения батча. Удаления
+        выполняются после вставок, поэтому отложенное удаление документа с тем
+        же pk (удаление и повторное создание внутри BatchScope) отменяется
+        """
+        pk = getattr(document, self._sync_cls._meta.pk_sfield.name)
+        self._deleted_instances[:] = [ins for ins in self._deleted_instances if ins.pk != pk]
+        self._new_documents.append(document)
+
+    def delete(self, instance, sfield=None):
+        """
+        Откладывает удаление до выполнения батча. Если sfield не передан, то
+        удаляется документ instance, иначе instance удаляется из вложенного
+        поля sfield во всех документах, где он встречается.
+        """
+        if sfield is None:
+            # отложенные обновления удаленного документа уже не нужны
+            self._qs_collection.pop(self._get_pk(instance), None)
+            self._deleted_instances.append(instance)
+        else:
+            self._removals.setdefault(sfield, []).append(instance)
+
+    def after_run(self, callback):
+        """
+        Откладывает вызов callback до успешного выполнения батча. Если при
+        выполнении запросов произошла ошибка, то callback не вызывается
+        """
+        self._after_run.append(callback)
 
     def run(self):
         """
-        Почти все запросы, которые делает msync к монге, происходят здесь.
-        Единственные запросы, которые происходят в самих обработчиках
-        сигналов -- save() и delete().
+        Все запросы, которые делает msync к монге, происходят здесь: сначала
+        вставляются новые документы, затем выполняются обновления и в конце удаления.
 
         Также функция пытается создать заново документ и сохранить его, если она не
         смогла найти его в монге, когда обновляла соответствующий документ.
+        Если у sync класса включен upsert, то документ создается повторным
+        обновлением с upsert и $setOnInsert (см. create_missing).
         """
+        callbacks, self._after_run = self._after_run, []
+        with route_to(self._sync_cls._meta.document, get_db_alias_for(self._sync_cls, self._using)):
+            self._run()
+        for callback in callbacks:
+            callback()
+
+    def _run(self):
+        self.run_inserts()
 
+        document_cls = self._sync_cls._meta.document
         for pk, qss in six.iteritems(self._qs_collection):
-            qs = reduce(operator.or_, qss)
-            qs_path = qs.get_path()
             pk_path = pk.get_path()
+            push_modifiers = {}
+            for qs in qss:
+                push_modifiers.update(qs.get_push_modifiers())
+            updates = merge_updates(document_cls, [qs.get_path() for qs in qss], push_modifiers)
+
+            for i, update in enumerate(updates):
+                logger.info('{}.filter({}).update({})'.format(self._sync_cls, pk_path, update))
+                with measure_time():
+                    updated_number = self.update(pk_path, update)
+                if i == 0:
+                    self.capture(**pk_path)
+
+                if i == 0 and updated_number == 0 and self.is_instance_of_parent(pk.instance):
+                    # документ строится заново целиком, поэтому остальные обновления не нужны
+                    self.create_missing(pk.instance, pk_path, updates)
+                    break
+
+        self.run_deletes()
+
+    def run_inserts(self):
+        """
+        Вставляет новые документы одним insert'ом. Если какой-то из документов
+        уже есть в монге, то все документы батча записываются через replace с upsert.
+        """
+        if not self._new_documents:
+            return
+
+        document_cls = self._sync_cls._meta.document
+        logger.info('{}.insert({} documents)'.format(self._sync_cls, len(self._new_documents)))
+        try:
+            with measure_time():
+                document_cls.objects.insert(self._new_documents, load_bulk=False)
+        except NotUniqueError:
+            logger.warning('%s: some of new documents are already in mongo. Upserting them.' % self._sync_cls)
+            replace_documents(self._sync_cls, self._new_documents)
+
+        pk_name = self._sync_cls._meta.pk_sfield.name
+        self.capture(**{'%s__in' % pk_name: [getattr(document, pk_name) for document in self._new_documents]})
 
+    def run_deletes(self):
+        if not self._removals and not self._deleted_instances:
+            return
+
+        objects = self._sync_cls._meta.document.objects
+        for sfield, instances in six.iteritems(self._removals):
+            pks = [instance.pk for instance in instances]
+            pk_path = QSPk(sync_cls=self._sync_cls, sfield=sfield, pks=pks).get_path()
+            pk_path.update(self._sync_cls._meta.get_nested_shard_key_filter(sfield, instances, removed=True))
+            qs_path = QSDeleteIn(sync_cls=self._sync_cls, sfield=sfield, pks=pks).get_path()
             logger.info('{}.filter({}).update({})'.format(self._sync_cls, pk_path, qs_path))
+            if not isinstance(qs_path, RawUpdate):
+                qs_path = to_mongo_update(self._sync_cls._meta.document, qs_path)
+            with measure_time():
+                self.update(pk_path, qs_path)
+            self.capture(**pk_path)
+
+        if self._deleted_instances:
+            pks = [instance.pk for instance in self._deleted_instances]
+            pk_path = QSPk(sync_cls=self._sync_cls, pks=pks).get_path()
+            pk_path.update(self._sync_cls._meta.get_shard_key_filter(self._deleted_instances))
+            logger.info('{}.filter({}).delete()'.format(self._sync_cls, pk_path))
             with measure_time():
-                updated_number = self._sync_cls._meta.document.objects.filter(**pk_path).update(**qs_path)
+                objects.filter(**pk_path).delete()
+            self.capture(**pk_path)
 
-            if updated_number == 0 and self.is_instance_of_parent(pk.instance):
-                logger.warning('%s with path %s is not in mongo. Saving to %s.' % (
-                    pk.instance.__class__, pk_path, self._sync_cls))
-                self._sync_cls.create_document(pk.instance, with_embedded=True).save()
+    def update(self, pk_path, update, upsert=False):
+        """
+        Выполняет обновление в формате монги. Если у sync класса включен
+        array_filters, то позиционные $ заменяются на arrayFilters
+        """
+        document_cls = self._sync_cls._meta.document
+        if self._sync_cls._meta.array_filters and has_positional(update):
+            query = transform.query(document_cls, **pk_path)
+            update, array_filters = to_array_filters(query, update)
+            logger.info('{}: arrayFilters {}'.format(self._sync_cls, array_filters))
+            return update_with_array_filters(document_cls, query, update, array_filters, upsert=upsert)
+        return document_cls.objects.filter(**pk_path).update(upsert=upsert, __raw__=update)
+
+    def capture(self, **pk_path):
+        """Записывает фильтр измененных документов в журнал перестроения коллекции"""
+        if self._sync_cls._meta.shadow_rebuild:
+            document_cls = self._sync_cls._meta.document
+            RebuildLog(self._sync_cls).record(transform.query(document_cls, **pk_path))
 
     def is_instance_of_parent(self, instance):
         model = self._sync_cls._meta.model
         return model is not None and isinstance(instance, model)
 
+    def create_missing(self, instance, pk_path, updates):
+        """
+        Создает документ, которого не оказалось в монге при обновлении. Если
+        upsert возможен, то документ создается повторным обновлением с upsert и
+        $setOnInsert, иначе он строится целиком и сохраняется через save()
+        """
+        if len(updates) == 1 and self.is_upsert_possible(instance, updates[0]):
+            update = dict(updates[0])
+            insert_values = self.get_insert_values(instance, pk_path, update)
+            if insert_values:
+                # пустой $setOnInsert монга до 5.0 не принимает
+                update['$setOnInsert'] = insert_values
+            logger.warning('%s with path %s is not in mongo. Upserting to %s.' % (
+                instance.__class__, pk_path, self._sync_cls))
+            with measure_time():
+                self.update(pk_path, update, upsert=True)
+        else:
+            logger.warning('%s with path %s is not in mongo. Saving to %s.' % (
+                instance.__class__, pk_path, self._sync_cls))
+            self._sync_cls.create_document(instance, with_embedded=True).save()
+
+    def is_upsert_possible(self, instance, update):
+        """
+        Upsert делается только для документов родительской модельки и только
+        тогда, когда обновление целиком заменяет поля через $set/$unset. Для push/pull
+        и позиционных обновлений вставленный документ получился бы неполным,
+        поэтому для них остается обычный запасной путь с save().
+        """
+        if not self._sync_cls._meta.upsert or not self.is_instance_of_parent(instance):
+            return False
+
+        for op, fields in six.iteritems(update):
+            if op not in ('$set', '$unset') or has_positional({op: fields}):
+                return False
+        return True
+
+    def get_insert_values(self, instance, pk_path, update):
+        """
+        Возвращает значения полей документа для $setOnInsert. Пути, которые
+        есть в самом обновлении или в фильтре, исключаются, т.к. монга не
+        позволяет менять один путь двумя операторами. Если исключается путь
+        внутри вложенного документа (например, 'a.b' из фильтра по shard key),
+        то остальные его поля записываются по отдельным путям ('a.c').
+        """
+        document_cls = self._sync_cls._meta.document
+        used_paths = {path for fields in six.itervalues(update) for path in fields}
+        used_paths.update(transform.query(document_cls, **pk_path))
+        used_paths.add('_id')
+
+        mongo_document = self._sync_cls.create_document(instance, with_embedded=True).to_mongo()
+        return _exclude_paths(mongo_document, used_paths)
+
     def __setitem__(self, key, qs):
+        if isinstance(qs, QSCreate):
+            self._cancel_removals(qs)
         pk = self._get_pk(key)
         self._qs_collection[pk].append(qs)
 
+    def _cancel_removals(self, qs):
+        """
+        Отменяет отложенные удаления вложенных объектов, которые снова добавляются
+        запросом qs, т.к. удаления выполняются после обновлений
+        """
+        instances = self._removals.get(qs.sfield)
+        pk_sfield = qs.sfield.get_nested_sync_cls()._meta.pk_sfield
+        if not instances or pk_sfield is None:
+            return
+        pks = {getattr(document, pk_sfield.name) for document in qs.documents}
+        instances[:] = [ins for ins in instances if ins.pk not in pks]
+        if not instances:
+            del self._removals[qs.sfield]
+
     def _get_pk(self, k):
         try:
             ins, sfield = k
@@ -77,29 +336,76 @@ class BatchQuery(object):
         return QSPk(sync_cls=self._sync_cls, instance=ins, sfield=sfield)
 
 
+def _exclude_paths(document, paths, prefix=''):
+    values = {}
+    for key, value in six.iteritems(document):
+        path = prefix + key
+        if path in paths:
+            continue
+        if isinstance(value, dict) and any(p.startswith(path + '.') for p in paths):
+            values.update(_exclude_paths(value, paths, path + '.'))
+        else:
+            values[path] = value
+    return values
+
+
 class BatchTask(object):
     """
     Является контекстным менеджером и занимается накоплением функций с
-    запросами к монге. Перед выходом из контекста создается таск,
-    где и выполняются эти функции.
+    запросами к монге. Перед выходом из контекста создаются таски,
+    где и выполняются эти функции. Функции отправляются порциями по
+    task_chunk_size штук в очередь queue с приоритетом priority, которые
+    задаются в Meta sync класса.
+
+    Внутри BatchScope контекст возвращает общий батч этого sync класса,
+    поэтому таски отправляются один раз при выходе из BatchScope.
+
+    Если в Meta задан async_backend = 'thread', то функции вместо celery
+    передаются фоновому потоку msync.writebehind.
     """
 
-    def __init__(self, sync_cls):
+    def __init__(self, sync_cls, using=None):
         self._sync_cls = sync_cls
+        self._using = using
         self._async_tasks = []
+        self._scope = None
 
     def add(self, task):
         self._async_tasks.append(task)
 
     def __enter__(self):
+        self._scope = BatchScope.get_current()
+        if self._scope is not None:
+            return self._scope.get_batch(BatchTask, self._sync_cls, self._using)
+
         del self._async_tasks[:]
         return self
 
     def __exit__(self, t, value, traceback):
-        self.run()
+        if self._scope is None:
+            self.run()
+        self._scope = None
 
     def run(self):
         if not self._async_tasks:
             return
 
-        sync_task.delay(self._sync_cls, self._async_tasks)
+        if self._sync_cls._meta.async_backend == 'thread':
+            get_flusher().put(self._sync_cls, list(self._async_tasks), using=self._using)
+            return
+
+        options = self.get_task_options()
+        chunk_size = self._sync_cls._meta.task_chunk_size or len(self._async_tasks)
+        for tasks in chunks(self._async_tasks, chunk_size):
+            sync_task.apply_async(args=(self._sync_cls, tasks), **options)
+
+    def get_task_options(self):
+        meta = self._sync_cls._meta
+        options = {}
+        if meta.queue is not None:
+            options['queue'] = meta.queue
+        if meta.priority is not None:
+            options['priority'] = meta.priority
+        if self._using is not None:
+            options['kwargs'] = {'using': self._using}
+        return options
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Массовые операции с коллекциями sync классов, которые выполняются в обход
+сигналов django.
+"""
+from __future__ import unicode_literals
+import logging
+import time
+import six
+from django.core.paginator import Paginator
+from django.db.models.query import QuerySet
+from mongoengine.queryset import transform
+from .arrayfilters import get_update_statement, has_positional, run_update_statements, to_array_filters
+from .batches import BatchQuery
+from .fingerprints import forget_fragments
+from .queryset import QSPk
+from .routing import get_db_alias_for, route_to
+from .signals import save_nested_sfield, delete_nested_sfield
+from .sizing import AdaptiveBatchSizer, PageStats
+from .syncers import DocumentSync, get_document_sync_classes
+from .utils import chunks, measure_time, replace_documents
+
+
+logger = logging.getLogger(__name__)
+
+
+def resync(sync_cls, queryset_or_pks, per_page=1000, propagate=True, using=None):
+    """
+    Пересинхронизирует объекты, которые были изменены без сигналов:
+    через QuerySet.update(), bulk_create() или сырой SQL.
+
+    Документы строятся порциями через DocumentFactory.bulk_create и записываются
+    одним bulk запросом на порцию (replace с upsert). Если переданы pk, то
+    документы тех из них, которых больше нет в базе, удаляются.
+
+    :param sync_cls: sync класс, моделька которого изменилась. Это может быть
+    и EmbeddedSync, тогда обновляются только документы, в которые он встроен
+    :param queryset_or_pks: QuerySet модельки sync_cls._meta.model или список pk
+    :param per_page: размер порции
+    :param propagate: обновлять ли встроенные объекты в родительских документах
+    :param using: база django, из которой читаются объекты. Документы пишутся
+    в соединение монги этой базы (см. msync.routing)
+    """
+    model = sync_cls._meta.model
+    if isinstance(queryset_or_pks, QuerySet):
+        queryset, pks = queryset_or_pks, None
+        if using is not None:
+            queryset = queryset.using(using)
+    else:
+        pks = set(queryset_or_pks)
+        queryset = model.objects.db_manager(using).filter(pk__in=pks)
+
+    has_collection = issubclass(sync_cls, DocumentSync)
+    found_pks = set()
+    p = Paginator(queryset.order_by('pk'), per_page)
+    for i in p.page_range:
+        instances = list(p.page(i).object_list)
+        found_pks.update(ins.pk for ins in instances)
+
+        if has_collection:
+            documents = sync_cls.bulk_create_documents(instances)
+            with route_to(sync_cls._meta.document, get_db_alias_for(sync_cls, using)):
+                replace_documents(sync_cls, documents.values())
+        if propagate:
+            update_parents(model, instances, using)
+
+    if pks is not None:
+        missing_pks = list(pks - found_pks)
+        if missing_pks and has_collection:
+            delete_documents(sync_cls, missing_pks, using)
+        if missing_pks and propagate:
+            delete_from_parents(model, missing_pks, using)
+
+
+def adaptive_bulk_insert(sync_cls, sizer=None, using=None, **sizer_options):
+    """
+    Добавляет в монгу документы всех инстансов модельки порциями, размер
+    которых подбирает AdaptiveBatchSizer (см. msync.sizing). Инстансы
+    выбираются по возрастанию pk через pk__gt, а не через OFFSET.
+
+    :param sizer: AdaptiveBatchSizer, по умолчанию создается из sizer_options
+    :param using: база django, из которой читаются инстансы и в соединение
+    монги которой пишутся документы (см. msync.routing)
+    :returns int: количество вставленных документов
+    """
+    if sizer is None:
+        sizer = AdaptiveBatchSizer(**sizer_options)
+
+    queryset = sync_cls._meta.model.objects.db_manager(using).order_by('pk')
+    with route_to(sync_cls._meta.document, get_db_alias_for(sync_cls, using)):
+        collection = sync_cls._meta.document._get_collection()
+    last_pk, total = None, 0
+    while True:
+        start, timings = time.time(), {}
+        page_qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        documents = sync_cls.bulk_create_documents_from_queryset(page_qs[:sizer.page_size], timings)
+        if not documents:
+            break
+        last_pk = next(reversed(documents))
+        # выборка строк страницы замеряется отдельно, запросы bulk source'ов
+        # входят в build_seconds
+        sql_seconds = timings.get('sql_seconds', 0.0)
+        build_seconds = time.time() - start - sql_seconds
+
+        mongo_documents = [document.to_mongo() for document in documents.values() if document is not None]
+
+        document_bytes, max_document_bytes = sizer.measure_documents(mongo_documents)
+        start = time.time()
+        for chunk in chunks(mongo_documents, sizer.get_insert_chunk_size(max_document_bytes)):
+            collection.insert(chunk)
+        insert_seconds = time.time() - start
+
+        total += len(mongo_documents)
+        logger.info('{}: inserted {} documents, {} in total'.format(sync_cls, len(mongo_documents), total))
+        sizer.update(PageStats(len(documents), sql_seconds, build_seconds, insert_seconds, document_bytes))
+    return total
+
+
+def delete_documents(sync_cls, pks, using=None):
+    pk_name = sync_cls._meta.pk_sfield.name
+    logger.info('{}.filter({}__in={}).delete()'.format(sync_cls, pk_name, pks))
+    document_cls = sync_cls._meta.document
+    with route_to(document_cls, get_db_alias_for(sync_cls, using)):
+        document_cls.objects.filter(**{'%s__in' % pk_name: pks}).delete()
+
+
+def get_parent_nested_sfields(model):
+    """Возвращает пары (родительский sync класс, поле), в которые встраивается model"""
+    return [(parent_sync_cls, sfield)
+            for parent_sync_cls in get_document_sync_classes()
+            for sfield in parent_sync_cls._meta.plan.get_nested_sfields_of_model(model)]
+
+
+def update_parents(model, instances, using=None):
+    """
+    Обновляет родительские документы, в которые встраиваются instances или
+    поля которых зависят от них (depends_on). Родители, которых можно найти
+    через reverse_rel полей, перестраиваются целиком через resync, поэтому в них
+    попадают и новые объекты (например, после bulk_create), и пересчитываются
+    зависимые поля. Объекты без таких родителей и объекты, встроенные глубже
+    первого уровня, обновляются через $set там, где они уже встроены. Зависимые
+    поля вложенных sync классов не пересчитываются. Отпечатки объектов
+    сбрасываются (см. msync.fingerprints).
+
+    :param using: база django, из которой прочитаны instances
+    """
+    for parent_sync_cls in get_document_sync_classes():
+        plan = parent_sync_cls._meta.plan
+        parent_pks = set()
+        for sfield in plan.get_depends_on_sfields_of_model(model):
+            if len(plan.get_sfield_path(sfield)) == 1:
+                for pks in six.itervalues(get_parent_pks(sfield, model, instances)):
+                    parent_pks.update(pks)
+
+        for sfield in plan.get_nested_sfields_of_model(model):
+            forget_fragments(parent_sync_cls, sfield, instances, using)
+            if len(plan.get_sfield_path(sfield)) == 1:
+                instance_parent_pks = get_parent_pks(sfield, model, instances)
+                orphans = [ins for ins in instances if not instance_parent_pks[ins]]
+                for pks in six.itervalues(instance_parent_pks):
+                    parent_pks.update(pks)
+            else:
+                # reverse_rel глубоко вложенного поля возвращает промежуточные объекты,
+                # а не родительские документы
+                orphans = instances
+
+            if orphans:
+                with BatchQuery(parent_sync_cls, using=using) as b:
+                    for instance in orphans:
+                        save_nested_sfield(b, parent_sync_cls=parent_sync_cls, sfield=sfield, instance=instance,
+                                           created=False, force=True, using=using)
+
+        if parent_pks:
+            resync(parent_sync_cls, parent_pks, propagate=False, using=using)
+
+
+def get_parent_pks(sfield, model, instances):
+    """
+    Возвращает pk родителей для каждого инстанса: {instance: set(pk)}. Если reverse_rel
+    поля - связь модельки, то все pk выбираются одним запросом, иначе reverse_rel
+    вызывается для каждого инстанса
+    """
+    bulk_reverse_rel = sfield.get_bulk_reverse_rel(model)
+    if bulk_reverse_rel is not None:
+        return bulk_reverse_rel(instances)
+    reverse_rel = sfield.get_reverse_rel()
+    return {ins: {pi.pk for pi in reverse_rel(ins) if pi is not None} for ins in instances}
+
+
+def delete_from_parents(model, pks, using=None):
+    for parent_sync_cls, sfield in get_parent_nested_sfields(model):
+        with BatchQuery(parent_sync_cls, using=using) as b:
+            for pk in pks:
+                delete_nested_sfield(b, parent_sync_cls=parent_sync_cls, sfield=sfield, instance=model(pk=pk),
+                                     using=using)
+
+
+def backfill(sfield, per_page=1000, using=None):
+    """
+    Заполняет одно поле во всех документах, не перестраивая их целиком.
+    Обычно нужно после добавления нового поля в sync класс.
+
+    Значения считаются порциями через bulk_source поля и записываются $set'ом
+    только этого пути, одним bulk запросом на порцию. Если поле определено во
+    встроенном sync классе, то обновляются все документы, в которые он встроен.
+
+    :param sfield: поле sync класса, например FooSync.new_field
+    :param per_page: размер порции
+    :param using: база django, из которой читаются инстансы. Значения пишутся
+    в соединение монги этой базы (см. msync.routing)
+    """
+    model = sfield.sync_cls._meta.model
+    p = Paginator(model.objects.db_manager(using).order_by('pk'), per_page)
+    for i in p.page_range:
+        backfill_instances(sfield, list(p.page(i).object_list), using)
+
+
+def backfill_instances(sfield, instances, using=None):
+    sync_cls = sfield.sync_cls
+    instances = [ins for ins in instances if sync_cls._meta.pass_filter(ins)]
+    if not instances:
+        return
+
+    values = sfield.values_from_source(instances)
+    if issubclass(sync_cls, DocumentSync):
+        filters = [(ins, QSPk(sync_cls=sync_cls, instance=ins).get_path()) for ins in instances]
+        _write_field_values(sync_cls, sfield.name, filters, values, multi=False, using=using)
+
+    for parent_sync_cls, nested_sfield in get_parent_nested_sfields(sync_cls._meta.model):
+        if nested_sfield.get_nested_sync_cls() is not sync_cls:
+            continue
+        forget_fragments(parent_sync_cls, nested_sfield, instances, using)
+        plan = parent_sync_cls._meta.plan
+        path = QSPk.delim.join([sf.update_query_path() for sf in plan.get_sfield_path(nested_sfield)] +
+                               [sfield.name])
+        filters = [(ins, QSPk(sync_cls=parent_sync_cls, instance=ins, sfield=nested_sfield).get_path())
+                   for ins in instances]
+        _write_field_values(parent_sync_cls, path, filters, values, multi=True, using=using)
+
+
+def _write_field_values(sync_cls, path, filters, values, multi, using=None):
+    """
+    Записывает значения одним bulk запросом в соединение монги базы using. Если
+    у sync класса включен array_filters, то позиционные обновления выполняются
+    одной командой update с arrayFilters (см. msync.arrayfilters)
+    """
+    document_cls = sync_cls._meta.document
+    with route_to(document_cls, get_db_alias_for(sync_cls, using)):
+        bulk = document_cls._get_collection().initialize_unordered_bulk_op()
+        statements = []
+        for instance, pk_path in filters:
+            value = values.get(instance)
+            if isinstance(value, dict):
+                value = list(value.values())
+            query = transform.query(document_cls, **pk_path)
+            update = transform.update(document_cls, **{'set__' + path: value})
+            if sync_cls._meta.array_filters and has_positional(update):
+                update, array_filters = to_array_filters(query, update)
+                statements.append(get_update_statement(query, update, array_filters, multi=multi))
+            elif multi:
+                bulk.find(query).update(update)
+            else:
+                bulk.find(query).update_one(update)
+
+        logger.info('{}: backfill of {} for {} documents'.format(sync_cls, path, len(filters)))
+        with measure_time():
+            if statements:
+                for chunk in chunks(statements, 1000):
+                    run_update_statements(document_cls, chunk)
+            if len(statements) < len(filters):
+                bulk.execute()
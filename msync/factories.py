@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import six
 from django.db import models
-from mongoengine import fields as mfields
+from mongoengine import document, fields as mfields
 from msync import fields as sfields
-from .utils import to_dict, DefaultQuerySet
+from .routing import document_methods
+from .utils import close_old_connections, to_dict, DefaultQuerySet
 
 
 class DocumentSchemeFactory(object):
@@ -24,6 +31,8 @@ class DocumentSchemeFactory(object):
             'to_dict': to_dict,
             '__module__': self.__module__
         })
+        if issubclass(self.meta.document_type, document.Document):
+            mfields.update(document_methods)
         document_cls = type(self.name, self.meta.get_document_bases(), mfields)
 
         # since pickle wants the class in a global it can have it
@@ -46,12 +55,36 @@ class DocumentSchemeFactory(object):
         m = {'queryset_class': DefaultQuerySet}
         settings = self.meta.collection_settings
         m.update(settings)
+        if self.meta.auto_indexes and issubclass(self.meta.document_type, document.Document):
+            m['indexes'] = self.get_indexes(m.get('indexes', []))
         return m
 
+    def get_indexes(self, indexes):
+        """
+        Добавляет к заданным в Meta индексам индексы по путям, по которым
+        msync фильтрует документы. Индексы строятся в фоне, чтобы не блокировать
+        коллекцию. Индексы родительских документов не дублируются, т.к. mongoengine
+        сам их наследует
+        """
+        existing = [_get_index_fields(index) for index in indexes]
+        for base in self.meta.get_document_bases():
+            existing.extend(_get_index_fields(index) for index in getattr(base, '_meta', {}).get('indexes', []))
+        return list(indexes) + [{'fields': [index], 'background': True} for index in self.meta.get_auto_indexes()
+                                if [index] not in existing]
+
     def get_qs_managers(self):
         return self.meta._qs_managers
 
 
+def _get_index_fields(index):
+    """Возвращает список полей индекса mongoengine, заданного строкой, списком или словарем"""
+    if isinstance(index, dict):
+        index = index.get('fields', [])
+    if isinstance(index, six.string_types):
+        return [index]
+    return list(index)
+
+
 # TODO: при создании mongoengine полей было бы неплохо
 # маппить параметры django-orm полей на mongoengine поля,
 # а не просто возвращать соответствующий класс.
@@ -131,17 +164,128 @@ class DocumentFactory(object):
         if not instances:
             return documents
 
-        value_dicts = {sfield: sfield.values_from_source(instances) for sfield in self.meta.sfields}
+        value_dicts = self.get_values_from_sources(instances)
         for instance in instances:
-            field_values = {}
-            for sfield in self.meta.sfields:
-                value = value_dicts[sfield].get(instance)
-                if value is not None and sfield.is_nested() and isinstance(value, dict):
-                    value = value.values()
-                field_values[sfield.name] = value
-            documents[instance] = self.meta.document(**field_values)
+            documents[instance] = self.meta.document(**self._get_field_values(value_dicts, instance))
+        return documents
+
+    def bulk_create_from_queryset(self, queryset, timings=None):
+        """
+        Создает документы для строк queryset и возвращает OrderedDict {pk: document}
+        в порядке queryset. Для инстансов, которые не прошли filter из Meta, документ None.
+
+        Поля, которые берутся прямо из колонок таблицы, выбираются через values_list.
+        Для остальных полей инстансы тех же pk строятся только с нужными им колонками
+        (.only), а если какие колонки нужны, неизвестно, то документы строятся из
+        полных инстансов, как в bulk_create. Если строку удалили между этими
+        запросами, то вместо неполного документа для нее возвращается None.
+
+        :param timings: словарь, в который записывается время выборки строк из
+        базы (sql_seconds), без времени построения документов
+        """
+        timings = {} if timings is None else timings
+        columns = self.get_columns()
+        instance_columns = self.get_instance_columns(columns)
+        if instance_columns is None:
+            start = time.time()
+            instances = list(queryset)
+            timings['sql_seconds'] = time.time() - start
+            documents = self.sync_cls.bulk_create_documents(instances)
+            return OrderedDict((ins.pk, documents.get(ins)) for ins in instances)
+
+        sfields = list(columns)
+        rest = [sfield for sfield in self.meta.sfields if sfield not in columns]
+        start = time.time()
+        rows = list(queryset.values_list('pk', *[columns[sfield] for sfield in sfields]))
+        instances = []
+        if rest and rows:
+            # инстансы выбираются по pk из rows, а не по тому же queryset, иначе
+            # вставка или удаление строк между запросами сдвинет страницу
+            model = self.meta.model
+            instances = list(model.objects.db_manager(queryset.db).only(model._meta.pk.name, *instance_columns)
+                             .filter(pk__in=[row[0] for row in rows]))
+        timings['sql_seconds'] = time.time() - start
+
+        value_dicts = self.get_values_from_sources(instances, rest) if instances else {}
+        instances = {ins.pk: ins for ins in instances}
+        documents = OrderedDict()
+        for row in rows:
+            if rest and row[0] not in instances:
+                documents[row[0]] = None
+                continue
+            field_values = {sfield.name: value for sfield, value in zip(sfields, row[1:])}
+            if rest:
+                field_values.update(self._get_field_values(value_dicts, instances[row[0]], rest))
+            documents[row[0]] = self.meta.document(**field_values)
         return documents
 
+    def get_columns(self):
+        """
+        Возвращает OrderedDict {sfield: колонка} для полей sync класса, значения
+        которых берутся прямо из колонок таблицы, или None, если колонки не
+        выбираются вовсе (нет модельки или в Meta задан filter)
+        """
+        model = self.meta.model
+        if model is None or self.meta.filter is not None:
+            return None
+
+        columns = OrderedDict()
+        for sfield in self.meta.sfields:
+            column = sfield.get_column(model)
+            if column is not None:
+                columns[sfield] = column
+        return columns
+
+    def get_instance_columns(self, columns):
+        """
+        Возвращает колонки, с которыми нужно выбрать инстансы для полей не из
+        columns, или None, если нужны полные инстансы
+        """
+        if columns is None:
+            return None
+
+        instance_columns = []
+        for sfield in self.meta.sfields:
+            if sfield in columns:
+                continue
+            sfield_columns = sfield.get_instance_columns(self.meta.model)
+            if sfield_columns is None:
+                return None
+            instance_columns.extend(c for c in sfield_columns if c not in instance_columns)
+        return instance_columns
+
+    def _get_field_values(self, value_dicts, instance, sfields=None):
+        field_values = {}
+        for sfield in self.meta.sfields if sfields is None else sfields:
+            value = value_dicts[sfield].get(instance)
+            if value is not None and sfield.is_nested() and isinstance(value, dict):
+                value = value.values()
+            field_values[sfield.name] = value
+        return field_values
+
+    def get_values_from_sources(self, instances, sfields=None):
+        """
+        Возвращает {sfield: {instance: value}} для полей sfields (по умолчанию
+        для всех полей sync класса). Если в Meta задан
+        bulk_source_threads, то bulk source'ы полей с запросами к базе выполняются
+        одновременно в пуле потоков, у каждого из которых свое соединение с базой.
+        Поэтому они не видят незакоммиченных изменений текущего потока, и пул
+        подходит для массовых загрузок вне транзакций. Вложенные sync классы,
+        которые строятся внутри потоков пула, свои поля считают по очереди.
+        """
+        sfields = self.meta.sfields if sfields is None else sfields
+        threads = self.meta.bulk_source_threads
+        parallel = []
+        if threads and not getattr(_local, 'in_pool', False):
+            parallel = [sfield for sfield in sfields if sfield.has_bulk_query()]
+        if len(parallel) < 2:
+            return {sfield: sfield.values_from_source(instances) for sfield in sfields}
+
+        value_dicts = {sfield: sfield.values_from_source(instances) for sfield in sfields if sfield not in parallel}
+        results = get_bulk_source_pool(threads).map(_values_from_source, [(sf, instances) for sf in parallel])
+        value_dicts.update(zip(parallel, results))
+        return value_dicts
+
     @classmethod
     def get_field_values_from_sources(cls, instance, sfields, with_embedded=False):
         field_values = {}
@@ -150,3 +294,28 @@ class DocumentFactory(object):
                 value = sfield.value_from_source(instance, with_embedded=with_embedded)
                 field_values[sfield.name] = value
         return field_values
+
+
+_local = threading.local()
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_bulk_source_pool(size):
+    """Пул потоков размера size, общий для всех sync классов процесса"""
+    # после fork'а потоки пула родителя в дочернем процессе не существуют
+    key = (os.getpid(), size)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ThreadPool(size)
+        return _pools[key]
+
+
+def _values_from_source(args):
+    sfield, instances = args
+    _local.in_pool = True
+    try:
+        close_old_connections()
+        return sfield.values_from_source(instances)
+    finally:
+        _local.in_pool = False
@@ -15,11 +15,15 @@
       Пример:
           field = SyncField(mfield=IntField(), depends_on=FooModel, source=source,
                             reverse_rel=reverse_func)
+      Для счетчиков и других агрегатов по связанным объектам есть AggregateField,
+      который при массовом построении документов считает значения одним запросом.
 """
 from __future__ import unicode_literals
 from collections import defaultdict
 import six
+from bson import SON
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
 from mongoengine import fields as mfields
 from mongoengine.queryset import DO_NOTHING
 from .utils import get_from_source
@@ -118,6 +122,16 @@ class BaseField(object):
         else:
             raise TypeError('%s: What the fuck is wrong with bulk source? It\'s your fault!' % self)
 
+    def has_bulk_query(self):
+        """
+        Делает ли bulk source поля запросы к базе. Простые поля без своего
+        bulk_source берут значения из атрибутов инстансов
+        """
+        return getattr(self, '_bulk_source', None) is not None or not self.is_model_sfield()
+
+    def has_reverse_rel(self):
+        return self._reverse_rel is not None
+
     def get_reverse_rel(self):
         if hasattr(self._reverse_rel, '__call__'):
             return self._reverse_rel
@@ -132,6 +146,48 @@ class BaseField(object):
         else:
             return lambda instance: []
 
+    def get_reverse_lookup(self, model):
+        """
+        Возвращает путь от model к родительской модельке для filter()/values_list(),
+        если reverse_rel - связь model ('foo', 'foo_set.all'), или None
+        """
+        if not isinstance(self._reverse_rel, six.string_types):
+            return None
+        parts = self._reverse_rel.split('.')
+        if parts[1:] not in ([], ['all']):
+            return None
+
+        name = parts[0]
+        try:
+            field, _, direct, _ = model._meta.get_field_by_name(name)
+        except FieldDoesNotExist:
+            pass
+        else:
+            return name if not direct or field.rel is not None else None
+
+        rel_objects = model._meta.get_all_related_objects() + model._meta.get_all_related_many_to_many_objects()
+        return next((rel.field.related_query_name() for rel in rel_objects if rel.get_accessor_name() == name), None)
+
+    def get_bulk_reverse_rel(self, model):
+        """
+        Возвращает функцию, которая находит pk родителей сразу для списка инстансов
+        model одним запросом: instances -> {instance: set(pk родителей)}. Если
+        reverse_rel не является связью model, то возвращается None
+        """
+        lookup = self.get_reverse_lookup(model)
+        if lookup is None:
+            return None
+
+        def bulk_reverse_rel(instances):
+            using = instances[0]._state.db if instances else None
+            rows = model._default_manager.db_manager(using).filter(pk__in=[ins.pk for ins in instances])
+            parent_pks = defaultdict(set)
+            for pk, parent_pk in rows.order_by().values_list('pk', lookup):
+                if parent_pk is not None:
+                    parent_pks[pk].add(parent_pk)
+            return {ins: parent_pks[ins.pk] for ins in instances}
+        return bulk_reverse_rel
+
     def get_mfield(self):
         return self.mfield
 
@@ -179,6 +235,36 @@ class SyncField(BaseField):
         """
         return not self.is_nested() and not self.is_depens_on()
 
+    def get_column(self, model):
+        """
+        Возвращает колонку таблицы model, значение которой без изменений попадает
+        в поле, или None, если для значения нужен инстанс модельки (функция,
+        цепочка атрибутов, связь, свой bulk_source)
+        """
+        if not self.is_model_sfield() or getattr(self, '_bulk_source', None) is not None:
+            return None
+        if not isinstance(self._source, six.string_types) or '.' in self._source:
+            return None
+        try:
+            field = model._meta.get_field(self._source)
+        except FieldDoesNotExist:
+            return None
+        return field.attname if field.rel is None else None
+
+    def get_instance_columns(self, model):
+        """
+        Возвращает поля model, которые нужно выбрать в инстанс, чтобы посчитать
+        значение поля (кроме pk), или None, если это неизвестно (функция, свой
+        bulk_source, атрибут не из полей модельки)
+        """
+        if getattr(self, '_bulk_source', None) is not None or not isinstance(self._source, six.string_types):
+            return None
+        try:
+            field = model._meta.get_field(self._source.split('.')[0])
+        except FieldDoesNotExist:
+            return None
+        return [] if isinstance(field, models.ManyToManyField) else [field.name]
+
     def is_belongs_to_parent(self, instance):
         if self.is_belongs is not None:
             return self.is_belongs(self, instance)
@@ -233,7 +319,8 @@ class ListField(SyncField):
             ...
     """
 
-    def __init__(self, mfield=None, sfield=None, ordering=None, reverse=False, **kwargs):
+    def __init__(self, mfield=None, sfield=None, ordering=None, reverse=False, max_length=None, sort=None,
+                 **kwargs):
         """
         Принимает либо поле из mongoengine, либо sync поле
 
@@ -245,29 +332,90 @@ class ListField(SyncField):
 
         :params ordering: нужно ли сортировать список
         :params reverse: в каком порядке сортировать
+
+        :params max_length: сколько элементов хранить в списке. Новые элементы
+        добавляются через $push с $slice, поэтому список не растет бесконечно.
+        Без sort остаются последние добавленные элементы
+
+        :params sort: сортировка списка на стороне монги через $push с $sort.
+        Для списка вложенных объектов это название поля ('-date' для обратного
+        порядка) или tuple названий, для списка простых значений - 1 или -1.
+        С max_length остаются первые max_length элементов в этом порядке.
+        В отличие от ordering, список не пересортировывается при каждом to_mongo()
         """
+        if ordering and sort is not None:
+            raise TypeError('ListField: use either ordering or sort')
+
         nested_mfield, sync_cls = mfield, None
         if mfield is None:
             nested_mfield = sfield.get_mfield()
             sync_cls = sfield.get_nested_sync_cls()
 
+        self.max_length = max_length
+        self.sort = sort
         list_field = self._construct_list_mfield(nested_mfield, ordering=ordering, reverse=reverse)
         super(ListField, self).__init__(list_field, sync_cls=sync_cls, **kwargs)
 
     def value_from_source(self, instance, with_embedded=False):
         values = super(ListField, self).value_from_source(instance)
         if self.is_nested():
-            return [self.get_nested_sync_cls().create_document(value, with_embedded=with_embedded)
-                    for value in values]
-        return values
+            values = [self.get_nested_sync_cls().create_document(value, with_embedded=with_embedded)
+                      for value in values]
+        return self.bound_values(values)
 
     def values_from_source(self, instances):
         value_dict = super(ListField, self).values_from_source(instances)
         if self.is_nested():
-            return {ins: self.get_nested_sync_cls().bulk_create_documents(value_dict[ins])
-                    for ins in value_dict}
+            value_dict = {ins: self.get_nested_sync_cls().bulk_create_documents(value_dict[ins])
+                          for ins in value_dict}
+        if self.is_bounded():
+            value_dict = {ins: self.bound_values(values.values() if isinstance(values, dict) else values)
+                          for ins, values in six.iteritems(value_dict)}
         return value_dict
 
+    def get_column(self, model):
+        return None
+
+    def is_bounded(self):
+        return self.max_length is not None or self.sort is not None
+
+    def bound_values(self, values):
+        """Сортирует и обрезает список так же, как это делают модификаторы $push"""
+        if not self.is_bounded() or values is None:
+            return values
+
+        values = list(values)
+        if self.sort is not None:
+            # сортировка устойчивая, поэтому сортируем с последнего ключа
+            for name, direction in reversed(self._get_sort_fields()):
+                values.sort(key=lambda v: _sort_key(v, name), reverse=direction < 0)
+            if self.max_length is not None:
+                values = values[:self.max_length]
+        elif self.max_length is not None:
+            values = values[-self.max_length:] if self.max_length else []
+        return values
+
+    def get_push_modifiers(self):
+        """Модификаторы для $push с $each, которые держат список отсортированным и ограниченным"""
+        modifiers = {}
+        if self.sort is not None:
+            fields = self._get_sort_fields()
+            if fields[0][0] is None:
+                modifiers['$sort'] = fields[0][1]
+            else:
+                document = self.get_nested_sync_cls()._meta.document
+                modifiers['$sort'] = SON((_get_db_path(document, name), direction) for name, direction in fields)
+        if self.max_length is not None:
+            modifiers['$slice'] = self.max_length if self.sort is not None else -self.max_length
+        return modifiers
+
+    def _get_sort_fields(self):
+        if self.sort in (1, -1):
+            return [(None, self.sort)]
+
+        names = (self.sort,) if isinstance(self.sort, six.string_types) else self.sort
+        return [(name[1:], -1) if name.startswith('-') else (name, 1) for name in names]
+
     def update_query_path(self):
         return '{}__S'.format(self.name) if self.is_nested() else self.name
 
@@ -288,6 +436,21 @@ class ListField(SyncField):
         return mfields.ListField(nested_mfield)
 
 
+def _get_db_path(document, name):
+    return '.'.join(field.db_field for field in document._lookup_field(name.split('.')))
+
+
+def _sort_key(value, name):
+    """
+    Ключ сортировки по пути name ('author.name') для bound_values. Как и в монге,
+    отсутствующие значения меньше любых других, поэтому None не сравнивается
+    со значениями напрямую
+    """
+    for part in name.split('.') if name is not None else ():
+        value = getattr(value, part, None)
+    return value is not None, value
+
+
 class ReferenceField(SyncField):
     """
     Для определения ссылочных полей
@@ -346,6 +509,91 @@ class ListOfEmbeddedForeignRelatedObjectsField(ListField):
         return self.__fk_field_name
 
 
+class AggregateField(SyncField):
+    """
+    Зависимое поле-агрегат (count, sum, max, min, avg) по связанным объектам
+    модельки sync класса, например счетчик:
+
+        class PostSync(DocumentSync):
+            comments_count = AggregateField('count', 'comment', depends_on=Comment, reverse_rel='post')
+            max_rating = AggregateField('max', 'comment__rating', mfield=mfields.IntField(),
+                                        depends_on=Comment, reverse_rel='post')
+
+    При массовом построении документов значения для всей порции инстансов
+    считаются одним запросом annotate с GROUP BY, а не запросом на инстанс.
+    Запрос выполняется в той базе django, из которой загружены инстансы.
+    """
+
+    aggregates = {
+        'count': models.Count,
+        'sum': models.Sum,
+        'max': models.Max,
+        'min': models.Min,
+        'avg': models.Avg,
+    }
+
+    def __init__(self, aggregate, lookup, mfield=None, filter=None, default=None, distinct=False, **kwargs):
+        """
+        :param aggregate: 'count', 'sum', 'max', 'min' или 'avg'
+        :param lookup: путь от модельки sync класса до агрегируемого поля в формате
+        django-orm, например 'comment' или 'comment__rating'
+        :param mfield: поле mongoengine, по умолчанию IntField для count и FloatField для остальных
+        :param filter: фильтр связанных объектов в формате django-orm, например {'comment__is_public': True}
+        :param default: значение для инстансов без связанных объектов, для count - 0
+        :param distinct: считать ли только различные значения (для count)
+        """
+        if aggregate not in self.aggregates:
+            raise TypeError('AggregateField: unknown aggregate %s' % aggregate)
+
+        self.aggregate = aggregate
+        self.lookup = lookup
+        self.aggregate_filter = filter
+        self.distinct = distinct
+        self.default = default if default is not None or aggregate != 'count' else 0
+        if mfield is None:
+            mfield = mfields.IntField() if aggregate == 'count' else mfields.FloatField()
+
+        kwargs.setdefault('source', aggregate_source)
+        super(AggregateField, self).__init__(mfield, **kwargs)
+
+    def get_bulk_source(self):
+        if getattr(self, '_bulk_source', None) is None:
+            return self.bulk_aggregate
+        return super(AggregateField, self).get_bulk_source()
+
+    def has_bulk_query(self):
+        return True
+
+    def get_instance_columns(self, model):
+        # агрегат считается по pk инстансов
+        if getattr(self, '_bulk_source', None) is None:
+            return []
+        return super(AggregateField, self).get_instance_columns(model)
+
+    def get_aggregate_queryset(self, pks, using=None):
+        """
+        QuerySet пар (pk, значение) для инстансов с данными pk из базы using.
+        Инстансов без связанных объектов (или не прошедших filter) в нем может не быть
+        """
+        qs = self.sync_cls._meta.model.objects.db_manager(using).filter(pk__in=pks)
+        if self.aggregate_filter:
+            qs = qs.filter(**self.aggregate_filter)
+        aggregate = self.aggregates[self.aggregate](self.lookup, distinct=self.distinct)
+        return qs.order_by().annotate(msync_aggregate=aggregate).values_list('pk', 'msync_aggregate')
+
+    def bulk_aggregate(self, instances):
+        using = instances[0]._state.db if instances else None
+        values = dict(self.get_aggregate_queryset([ins.pk for ins in instances], using))
+        return {ins: self._get_value(values.get(ins.pk)) for ins in instances}
+
+    def _get_value(self, value):
+        return self.default if value is None else value
+
+
+def aggregate_source(sfield, instance):
+    return sfield.bulk_aggregate([instance])[instance]
+
+
 class MongoSyncField(SyncField):
     mfield_cls = None
 
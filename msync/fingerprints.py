@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Отпечатки вложенных объектов для подавления лишних обновлений родителей.
+
+save_nested_sfield обновляет всех родителей, в которые вложен сохраненный
+инстанс, даже если ни одно поле вложенного sync класса не изменилось
+(например, сохранили только несинхронизируемую колонку, а ChangeTracker не
+смог определить изменения). Если в Meta вложенного sync класса задан
+fingerprints, то от его простых полей считается md5 и запоминается для
+(база django, родительский sync класс, путь до поля, вложенный sync класс, pk). Если
+отпечаток не изменился, то обновление родителей не ставится вовсе.
+
+Новый отпечаток записывается только после успешного выполнения батча с
+обновлением родителей (BatchQuery.after_run), поэтому если запись в монгу или
+таск упали, то следующее сохранение снова обновит родителей.
+
+resync и backfill (msync.bulk) переписывают родителей в обход сигналов, поэтому
+сбрасывают отпечатки затронутых объектов. Перестроение коллекции целиком
+(msync.rebuild) отпечатки не трогает: если перед ним строки менялись без
+сигналов, то отпечатки нужно сбросить через forget_fragments.
+
+Хранилища:
+    'memory' - словарь в памяти процесса с вытеснением старых ключей. Подходит,
+               только если инстансы модельки меняются из одного процесса:
+               о чужих изменениях процесс не знает и может пропустить
+               обновление, которое возвращает старое значение;
+    'mongo'  - коллекция msync_fingerprints в базе родительского документа
+               (с учетом маршрутизации по базам django, см. msync.routing),
+               общая для всех процессов. На сохранение уходит find_one при
+               проверке и еще один update с upsert после выполнения батча, т.е.
+               два запроса, и проверка с записью не атомарны: при одновременных
+               сохранениях одного объекта может запомниться отпечаток не того
+               значения, которое последним попало в родителей.
+"""
+from __future__ import unicode_literals
+import hashlib
+import threading
+from collections import OrderedDict
+from bson import BSON, Binary, SON
+from django.db import DEFAULT_DB_ALIAS
+from mongoengine.connection import get_db
+from .routing import get_db_alias_for
+
+
+FINGERPRINTS_COLLECTION = 'msync_fingerprints'
+
+
+def get_fingerprint(sync_cls, document):
+    """md5 значений простых полей вложенного документа в формате монги"""
+    mongo_document = document.to_mongo()
+    mfields = sync_cls._meta.document._fields
+    db_fields = sorted(mfields[sfield.name].db_field for sfield in sync_cls._meta.plan.simple_sfields)
+    values = SON((db_field, mongo_document.get(db_field)) for db_field in db_fields)
+    return hashlib.md5(BSON.encode(values)).digest()
+
+
+def get_fingerprint_key(parent_sync_cls, sfield, instance, using=None):
+    path = '.'.join(sf.name for sf in parent_sync_cls._meta.plan.get_sfield_path(sfield))
+    return '%s:%s:%s:%s:%s' % (using or DEFAULT_DB_ALIAS, parent_sync_cls.__name__, path,
+                               sfield.get_nested_sync_cls().__name__, instance.pk)
+
+
+class MemoryFingerprintStore(object):
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает запомненный отпечаток или None"""
+        with self._lock:
+            return self._fingerprints.get(key)
+
+    def set(self, key, fingerprint):
+        with self._lock:
+            self._fingerprints.pop(key, None)
+            self._fingerprints[key] = fingerprint
+            if len(self._fingerprints) > self.max_size:
+                self._fingerprints.popitem(last=False)
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._fingerprints.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+
+
+class MongoFingerprintStore(object):
+    def __init__(self, db):
+        self.collection = db[FINGERPRINTS_COLLECTION]
+
+    def get(self, key):
+        document = self.collection.find_one({'_id': key}, {'fp': 1})
+        return bytes(document['fp']) if document else None
+
+    def set(self, key, fingerprint):
+        self.collection.update({'_id': key}, {'$set': {'fp': Binary(fingerprint)}}, upsert=True)
+
+    def discard(self, *keys):
+        self.collection.remove({'_id': {'$in': list(keys)}})
+
+
+memory_store = MemoryFingerprintStore()
+
+
+def get_fingerprint_store(parent_sync_cls, sfield, using=None):
+    kind = sfield.get_nested_sync_cls()._meta.fingerprints
+    if kind is None:
+        return None
+    if kind == 'memory':
+        return memory_store
+    if kind == 'mongo':
+        alias = get_db_alias_for(parent_sync_cls, using)
+        return MongoFingerprintStore(get_db(alias) if alias is not None else parent_sync_cls._meta.document._get_db())
+    raise TypeError('%s: unknown fingerprints store %s' % (sfield.get_nested_sync_cls(), kind))
+
+
+def is_fragment_changed(parent_sync_cls, sfield, instance, document, using=None):
+    """
+    Возвращает, отличается ли отпечаток документа вложенного объекта от
+    запомненного. Если отпечатки не хранятся, то всегда True
+    """
+    store = get_fingerprint_store(parent_sync_cls, sfield, using)
+    if store is None:
+        return True
+
+    fingerprint = get_fingerprint(sfield.get_nested_sync_cls(), document)
+    return store.get(get_fingerprint_key(parent_sync_cls, sfield, instance, using)) != fingerprint
+
+
+def remember_fragment(parent_sync_cls, sfield, instance, document, using=None):
+    """Запоминает отпечаток документа вложенного объекта, когда родители уже обновлены"""
+    store = get_fingerprint_store(parent_sync_cls, sfield, using)
+    if store is not None:
+        fingerprint = get_fingerprint(sfield.get_nested_sync_cls(), document)
+        store.set(get_fingerprint_key(parent_sync_cls, sfield, instance, using), fingerprint)
+
+
+def forget_fragment(parent_sync_cls, sfield, instance, using=None):
+    forget_fragments(parent_sync_cls, sfield, [instance], using)
+
+
+def forget_fragments(parent_sync_cls, sfield, instances, using=None):
+    """Сбрасывает отпечатки объектов, родителей которых переписали в обход сигналов"""
+    store = get_fingerprint_store(parent_sync_cls, sfield, using)
+    if store is not None and instances:
+        store.discard(*[get_fingerprint_key(parent_sync_cls, sfield, instance, using) for instance in instances])
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка того, что все фильтры, которые msync строит при обновлениях,
+используют индексы. Обычно запускается в тестах или при деплое против
+локального mongod:
+    assert_no_collscan(FooSync)
+"""
+from __future__ import unicode_literals
+import six
+from .queryset import QSPk
+
+
+def get_sample_filters(sync_cls, pk=0):
+    """
+    Возвращает фильтры того же вида, что строит msync: по pk документа
+    и по pk каждого вложенного объекта
+    """
+    meta = sync_cls._meta
+    filters = [QSPk(sync_cls=sync_cls, pk=pk).get_path()]
+    for sfield in meta.get_nested_sfields():
+        if sfield.get_nested_sync_cls()._meta.pk_sfield is not None:
+            filters.append(QSPk(sync_cls=sync_cls, pk=pk, sfield=sfield).get_path())
+    return filters
+
+
+def is_collscan(plan):
+    """Ищет в плане запроса полный проход по коллекции (для старых и новых версий монги)"""
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN' or plan.get('cursor') == 'BasicCursor':
+            return True
+        return any(is_collscan(v) for v in six.itervalues(plan))
+    elif isinstance(plan, (list, tuple)):
+        return any(is_collscan(v) for v in plan)
+    return False
+
+
+def find_collscans(sync_cls, pk=0):
+    """Возвращает фильтры, для которых монга выбирает полный проход по коллекции"""
+    objects = sync_cls._meta.document.objects
+    return [path for path in get_sample_filters(sync_cls, pk=pk)
+            if is_collscan(objects.filter(**path).explain())]
+
+
+def assert_no_collscan(sync_cls, pk=0):
+    collscans = find_collscans(sync_cls, pk=pk)
+    assert not collscans, '%s: filters without index: %s' % (sync_cls.__name__, collscans)
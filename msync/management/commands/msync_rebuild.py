@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from msync.rebuild import rebuild_all, format_summary
+from msync.syncers import get_document_sync_classes
+
+
+class Command(BaseCommand):
+    args = '[SyncClassName ...]'
+    help = ('Rebuilds collections of all DocumentSync classes or of the given ones. '
+            'Classes are loaded after the classes they reference, independent ones concurrently.')
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', default=4, help='How many collections to load at the same time'),
+        make_option('--per-page', type='int', default=1000, dest='per_page', help='Size of a loading chunk'),
+        make_option('--drop', action='store_true', default=False,
+                    help='Remove documents of classes without shadow_rebuild before loading '
+                         '(otherwise existing documents are replaced)'),
+        make_option('--database', dest='using', default=None,
+                    help='Django database to load documents from (see MSYNC_DB_ALIASES)'),
+    )
+
+    def handle(self, *names, **options):
+        sync_classes = [sync_cls for sync_cls in get_document_sync_classes() if sync_cls._meta.model is not None]
+        if names:
+            by_name = {sync_cls.__name__: sync_cls for sync_cls in sync_classes}
+            unknown = [name for name in names if name not in by_name]
+            if unknown:
+                raise CommandError('Unknown sync classes: %s' % ', '.join(unknown))
+            sync_classes = [by_name[name] for name in names]
+
+        results = rebuild_all(sync_classes, concurrency=options['concurrency'], per_page=options['per_page'],
+                              drop=options['drop'], using=options['using'])
+        self.stdout.write(format_summary(results))
+        if any(result.error is not None for result in results):
+            raise CommandError('Some collections failed to rebuild')
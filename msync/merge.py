@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Слияние обновлений одного документа с учетом операторов.
+
+Запросы QS* классов сначала переводятся mongoengine'ом в формат монги
+(условия $pull и RawUpdate не переводятся, см. to_mongo_update),
+а потом сливаются по путям:
+    - несколько $push/$pushAll одного списка превращаются в один $push с $each;
+    - несколько $pull одного списка превращаются в один $pull с $in по ключу
+      вложенного объекта или в $pullAll для списков простых значений;
+    - $set/$unset одного пути заменяют друг друга, побеждает последний;
+    - к $push ограниченных списков добавляются модификаторы $sort/$slice
+      (см. ListField с max_length и sort).
+Операции, которые нельзя слить и которые затрагивают пересекающиеся пути
+(например, $push и $pull одного списка), разносятся по разным обновлениям
+так, чтобы сохранить порядок и сделать как можно меньше запросов.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+import six
+from mongoengine.queryset import transform
+
+
+class RawUpdate(dict):
+    """
+    Обновление, которое уже построено в формате монги и не должно проходить
+    через transform.update. Новые версии mongoengine приводят значение $pull
+    к типу поля, поэтому условия вида {'id': {'$in': [...]}} строятся сразу
+    в формате монги.
+    """
+
+
+def get_mongo_path(document_cls, path):
+    """Переводит путь mongoengine (m2m_field__S__name) в путь монги (m2m_field.$.name)"""
+    parts = path.split('__')
+    fields = document_cls._lookup_field([part for part in parts if part != 'S'])
+    db_fields = iter(getattr(field, 'db_field', field) for field in fields)
+    return '.'.join('$' if part == 'S' else next(db_fields) for part in parts)
+
+
+def merge_updates(document_cls, paths, push_modifiers=None):
+    """
+    :param document_cls: документ mongoengine, к которому относятся запросы
+    :param paths: список запросов в формате mongoengine (set__field=value, ...)
+    или RawUpdate в порядке их поступления
+    :param push_modifiers: модификаторы $push по путям в формате монги
+    :returns list: список обновлений в формате монги, которые нужно выполнить по порядку
+    """
+    groups = []
+    for path in paths:
+        mongo_update = path if isinstance(path, RawUpdate) else to_mongo_update(document_cls, path)
+        for op, fields in six.iteritems(mongo_update):
+            for field_path, value in six.iteritems(fields):
+                update_op = UpdateOp.create(op, value)
+                if push_modifiers and field_path in push_modifiers and isinstance(update_op, PushOp):
+                    update_op.modifiers = dict(push_modifiers[field_path])
+                _add_op(groups, field_path, update_op)
+    return [group.to_mongo() for group in groups if group]
+
+
+def to_mongo_update(document_cls, path):
+    """
+    Переводит запрос mongoengine в формат монги. Условия $pull (словари)
+    переводятся только по пути, а значения $set/$unset/$push - через
+    transform.update
+    """
+    plain_path, update = {}, {}
+    for key, value in six.iteritems(path):
+        op, _, field_path = key.partition('__')
+        if op == 'pull' and isinstance(value, dict):
+            update.setdefault('$pull', {})[get_mongo_path(document_cls, field_path)] = value
+        else:
+            plain_path[key] = value
+    if plain_path:
+        for op, fields in six.iteritems(transform.update(document_cls, **plain_path)):
+            update.setdefault(op, {}).update(fields)
+    return update
+
+
+def _add_op(groups, path, update_op):
+    last_overlapping = -1
+    for i, group in enumerate(groups):
+        if group.overlaps(path):
+            last_overlapping = i
+
+    if last_overlapping >= 0 and groups[last_overlapping].merge(path, update_op):
+        return
+
+    # Операция не пересекается с группами после last_overlapping, поэтому
+    # ее можно выполнить сразу после него, не нарушая порядка
+    index = last_overlapping + 1
+    if index == len(groups):
+        groups.append(UpdateGroup())
+    groups[index].add(path, update_op)
+
+
+def _paths_overlap(path1, path2):
+    parts1, parts2 = path1.split('.'), path2.split('.')
+    n = min(len(parts1), len(parts2))
+    return parts1[:n] == parts2[:n]
+
+
+def _append_unique(values, new_values):
+    for value in new_values:
+        if value not in values:
+            values.append(value)
+    return values
+
+
+class UpdateOp(object):
+    """Одна операция над одним путем. Умеет сливаться с операцией того же вида"""
+
+    def __init__(self, op, value):
+        self.op = op
+        self.value = value
+
+    @classmethod
+    def create(cls, op, value):
+        if op in ('$set', '$unset'):
+            return AssignOp(op, value)
+        elif op in ('$push', '$pushAll'):
+            return PushOp.from_mongo(op, value)
+        elif op in ('$pull', '$pullAll'):
+            return PullOp.from_mongo(op, value)
+        return UpdateOp(op, value)
+
+    def merge(self, other):
+        return False
+
+    def to_mongo(self):
+        return self.op, self.value
+
+
+class AssignOp(UpdateOp):
+    def merge(self, other):
+        if not isinstance(other, AssignOp):
+            return False
+        self.op, self.value = other.op, other.value
+        return True
+
+
+class PushOp(UpdateOp):
+    def __init__(self, values, modifiers=None):
+        super(PushOp, self).__init__('$push', values)
+        self.modifiers = modifiers or {}
+
+    @classmethod
+    def from_mongo(cls, op, value):
+        if op == '$pushAll':
+            return cls(list(value))
+        elif isinstance(value, dict) and '$each' in value:
+            modifiers = {k: v for k, v in six.iteritems(value) if k != '$each'}
+            return cls(list(value['$each']), modifiers)
+        return cls([value])
+
+    def merge(self, other):
+        if not isinstance(other, PushOp) or self.modifiers != other.modifiers:
+            return False
+        self.value.extend(other.value)
+        return True
+
+    def to_mongo(self):
+        if len(self.value) == 1 and not self.modifiers:
+            return '$push', self.value[0]
+        value = {'$each': self.value}
+        value.update(self.modifiers)
+        return '$push', value
+
+
+class PullOp(UpdateOp):
+    """
+    $pull бывает трех видов: по значению (для списков простых значений),
+    по ключу вложенного объекта ({'id': 4} или {'id': {'$in': [4, 8]}})
+    и по произвольному условию, которое не сливается
+    """
+
+    def __init__(self, values=None, key=None, condition=None):
+        super(PullOp, self).__init__('$pull', values)
+        self.key = key
+        self.condition = condition
+
+    @classmethod
+    def from_mongo(cls, op, value):
+        if op == '$pullAll':
+            return cls(values=list(value))
+        elif not isinstance(value, dict):
+            return cls(values=[value])
+        elif len(value) == 1:
+            key, key_value = next(six.iteritems(value))
+            if not isinstance(key_value, dict):
+                return cls(values=[key_value], key=key)
+            elif list(key_value.keys()) == ['$in']:
+                return cls(values=list(key_value['$in']), key=key)
+        return cls(condition=value)
+
+    def merge(self, other):
+        if (not isinstance(other, PullOp) or self.condition is not None or other.condition is not None or
+                self.key != other.key):
+            return False
+        _append_unique(self.value, other.value)
+        return True
+
+    def to_mongo(self):
+        if self.condition is not None:
+            return '$pull', self.condition
+        elif self.key is not None:
+            value = self.value[0] if len(self.value) == 1 else {'$in': self.value}
+            return '$pull', {self.key: value}
+        elif len(self.value) == 1:
+            return '$pull', self.value[0]
+        return '$pullAll', self.value
+
+
+class UpdateGroup(object):
+    """Набор операций, которые можно выполнить одним обновлением"""
+
+    def __init__(self):
+        self._ops = OrderedDict()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def overlaps(self, path):
+        return any(_paths_overlap(path, p) for p in self._ops)
+
+    def merge(self, path, update_op):
+        """
+        Сливает операцию с операцией того же пути. Возвращает False, если
+        операция пересекается с другими путями или не сливается
+        """
+        overlapping = [p for p in self._ops if _paths_overlap(path, p)]
+        if overlapping != [path]:
+            return False
+        return self._ops[path].merge(update_op)
+
+    def add(self, path, update_op):
+        self._ops[path] = update_op
+
+    def to_mongo(self):
+        update = {}
+        for path, update_op in six.iteritems(self._ops):
+            op, value = update_op.to_mongo()
+            update.setdefault(op, {})[path] = value
+        return update
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from .batches import BatchScope
+
+
+class BatchScopeMiddleware(object):
+    """
+    Оборачивает каждый http запрос в BatchScope, чтобы все запросы к монге
+    и асинхронные таски msync, которые накопились за время запроса, были
+    слиты и отправлены один раз при формировании ответа.
+    """
+
+    def process_request(self, request):
+        # Если предыдущий запрос в этом потоке упал до process_response,
+        # то его батчи нужно выполнить, иначе новый контекст станет вложенным
+        stale_scope = BatchScope.get_current()
+        if stale_scope is not None:
+            stale_scope.__exit__(None, None, None)
+
+        request._msync_batch_scope = BatchScope()
+        request._msync_batch_scope.__enter__()
+
+    def process_response(self, request, response):
+        scope = getattr(request, '_msync_batch_scope', None)
+        if scope is not None:
+            del request._msync_batch_scope
+            scope.__exit__(None, None, None)
+        return response
@@ -4,7 +4,7 @@ from collections import defaultdict
 import six
 from django.db.models.fields import FieldDoesNotExist
 from .factories import SyncFieldFactory
-from .utils import Tree
+from .utils import FrozenDict, Tree
 
 
 class Options(object):
@@ -30,7 +30,7 @@ class Options(object):
     _collection_setting_keys = ('allow_inheritance', 'collection', 'id_field', 'max_documents',
                                 'max_size', 'indexes', 'index_options', 'index_background',
                                 'index_drop_dups', 'index_cls', 'ordering', 'shard_key', 'abstract',
-                                'queryset_class', 'auto_create_index')
+                                'queryset_class', 'auto_create_index', 'db_alias')
 
     def __init__(self, sync_cls, meta, sync_bases, document_type=None):
         """
@@ -55,6 +55,55 @@ class Options(object):
         # Нужно ли обновлять любое поле в документе ассинхронно.
         # Также можно определять это поведение только для определенных полей
         self.async = getattr(meta, 'async', False)
+        # Нужно ли отслеживать изменения простых полей между post_init и post_save,
+        # чтобы обновлять в монге только изменившиеся поля
+        self.track_changes = getattr(meta, 'track_changes', True)
+        # Создавать ли отсутствующий в монге документ повторным обновлением с
+        # upsert и $setOnInsert вместо отдельного save(). В отличие от save() это
+        # не затирает документ, который успел вставить другой процесс. Полный
+        # документ строится только тогда, когда обновление ничего не нашло
+        self.upsert = getattr(meta, 'upsert', False)
+        # Настройки асинхронных тасков: очередь celery, приоритет и сколько
+        # функций отправлять в одном таске
+        self.queue = getattr(meta, 'queue', None)
+        self.priority = getattr(meta, 'priority', None)
+        self.task_chunk_size = getattr(meta, 'task_chunk_size', 100)
+        # Чем выполнять асинхронные обновления: 'celery' или 'thread' (фоновый
+        # поток этого же процесса, см. msync.writebehind)
+        self.async_backend = getattr(meta, 'async_backend', 'celery')
+        # Нужно ли добавлять в документ индексы по путям, по которым msync
+        # ищет документы при обновлениях (pk и pk вложенных объектов). Индексы
+        # создаются mongoengine при первом обращении к коллекции, поэтому они
+        # строятся в фоне, а сама опция по умолчанию выключена
+        self.auto_indexes = getattr(meta, 'auto_indexes', False)
+        # Функция instance -> {поле: значение}, которая возвращает значения shard
+        # ключа для инстанса модельки. Если не задана, то значения вычисляются
+        # из полей sync класса, перечисленных в shard_key
+        self.shard_key_getter = getattr(meta, 'shard_key_getter', None)
+        # Функция (sfield, instance) -> {поле: значение или список значений},
+        # которая возвращает значения shard ключа документов, содержащих вложенный
+        # instance в поле sfield. Нужна для фильтров по вложенным объектам, если
+        # значения нельзя получить через reverse_rel поля (и всегда для удалений)
+        self.nested_shard_key_getter = getattr(meta, 'nested_shard_key_getter', None)
+        # Можно ли перестраивать коллекцию через теневую (см. msync.rebuild).
+        # Если включено, то каждый BatchQuery проверяет, не идет ли сейчас
+        # перестроение, и записывает в его журнал измененные документы
+        self.shadow_rebuild = getattr(meta, 'shadow_rebuild', False)
+        # Обновлять ли вложенные списки через arrayFilters вместо позиционного $
+        # (см. msync.arrayfilters). Требует MongoDB 3.6+
+        self.array_filters = getattr(meta, 'array_filters', False)
+        # Где хранить отпечатки вложенного объекта, чтобы не обновлять родителей,
+        # если его поля не изменились: None (не хранить), 'memory' или 'mongo'
+        # (см. msync.fingerprints). Задается в Meta вложенного sync класса
+        self.fingerprints = getattr(meta, 'fingerprints', None)
+        # Соответствие баз django алиасам соединений mongoengine, например
+        # {'tenant1': 'mongo_tenant1'}. Если не задано, то берется из
+        # settings.MSYNC_DB_ALIASES (см. msync.routing)
+        self.db_aliases = getattr(meta, 'db_aliases', None)
+        # Сколько потоков использовать при массовом построении документов, чтобы
+        # bulk source'ы полей с запросами к базе выполнялись одновременно
+        # (см. DocumentFactory.bulk_create). None - по очереди в текущем потоке
+        self.bulk_source_threads = getattr(meta, 'bulk_source_threads', None)
         self._field_names = self._get_field_names_from_meta_fields()
 
         # Здесь будет храниться сгенерируемый mongoengine документ, через
@@ -83,6 +132,8 @@ class Options(object):
         self.sync_tree = None
         # В own_sync_tree хранится дерево с корнем в этом классе
         self.own_sync_tree = None
+        # Предвычисленные списки и словари полей (см. SyncPlan)
+        self._plan = None
         self.collection_settings = self.get_collection_settings(meta)
         self.bases = self._get_sync_bases(sync_bases)
 
@@ -94,6 +145,7 @@ class Options(object):
         self._sfields_dict[name] = field
         self.sync_tree = None
         self.own_sync_tree = None
+        self._plan = None
         self.__sfields_dict_cache = None
         self.__sfields_cache = None
 
@@ -192,6 +244,18 @@ class Options(object):
 
     pk_sfield = property(_get_pk_sfield, _set_my_ass)
 
+    def _get_plan(self):
+        if self._plan is None:
+            self._plan = SyncPlan(self)
+        return self._plan
+
+    plan = property(_get_plan, _set_my_ass)
+
+    def build_plan(self):
+        """Вызывается метаклассом, когда sync класс создан полностью"""
+        self._plan = SyncPlan(self)
+        return self._plan
+
     def is_need_to_connect_signals(self):
         return self.model is not None or self.collection_settings.get('allow_inheritance', False)
 
@@ -206,55 +270,151 @@ class Options(object):
         return True
 
     def get_nested_sfields(self):
-        return self._filter_sfields(self.get_sync_tree(), lambda sf: sf.is_nested())
+        return list(self.plan.nested_sfields)
 
     def get_depends_on_sfields(self):
-        return self._filter_sfields(self.get_sync_tree(), lambda sf: sf.is_depens_on())
+        return list(self.plan.depends_on_sfields)
 
     def get_own_nested_sfields(self):
-        return self._filter_sfields(self.get_own_sync_tree(), lambda sf: sf.is_nested())
+        return list(self.plan.own_nested_sfields)
 
     def get_own_depends_on_sfields(self):
-        return self._filter_sfields(self.get_own_sync_tree(), lambda sf: sf.is_depens_on())
-
-    def _filter_sfields(self, sync_tree, flt):
-        all_sfields = sync_tree.get_all_sfields()
-        return list({sf for sf in all_sfields if flt(sf)})
+        return list(self.plan.own_depends_on_sfields)
 
     def get_all_models(self):
-        return list(self.get_nested_models() | self.get_depends_on_models())
+        return list(self.plan.all_models)
 
     def get_all_own_models(self):
-        return list(self.get_own_nested_models() | self.get_own_depends_on_models())
+        return list(self.plan.all_own_models)
 
     def get_nested_models(self):
-        return {sf.get_nested_sync_cls()._meta.model for sf in self.get_nested_sfields()}
+        return set(self.plan.nested_model_sfields)
 
     def get_depends_on_models(self):
-        return {sf.get_depends_on_model() for sf in self.get_depends_on_sfields()}
+        return set(self.plan.depends_on_model_sfields)
 
     def get_own_nested_models(self):
-        return {sf.get_nested_sync_cls()._meta.model for sf in self.get_own_nested_sfields()}
+        return {sf.get_nested_sync_cls()._meta.model for sf in self.plan.own_nested_sfields}
 
     def get_own_depends_on_models(self):
-        return {sf.get_depends_on_model() for sf in self.get_own_depends_on_sfields()}
+        return {sf.get_depends_on_model() for sf in self.plan.own_depends_on_sfields}
 
     def get_nested_model_sfields_dict(self):
-        # TODO: cache
-        d = defaultdict(list)
-        for sf in self.get_nested_sfields():
-            d[sf.get_nested_sync_cls()._meta.model].append(sf)
-        return d
+        return defaultdict(list, {model: list(sfields)
+                                  for model, sfields in six.iteritems(self.plan.nested_model_sfields)})
 
     def get_depends_on_model_sfields_dict(self):
-        # TODO: cache
-        d = defaultdict(list)
-        for sf in self.get_depends_on_sfields():
-            d[sf.get_depends_on_model()].append(sf)
-        return d
+        return defaultdict(list, {model: list(sfields)
+                                  for model, sfields in six.iteritems(self.plan.depends_on_model_sfields)})
+
+    def get_auto_indexes(self):
+        """
+        Возвращает индексы для всех путей, по которым строятся фильтры в QSPk:
+        pk документа и pk каждого вложенного объекта на любой глубине.
+        Индекс по pk не нужен, если pk хранится в _id
+        """
+        indexes = []
+        if self.pk_sfield is not None and not self.is_pk_id_field():
+            indexes.append(self.pk_sfield.name)
+
+        sync_tree = self.get_sync_tree()
+        for sfield in self.get_nested_sfields():
+            nested_pk_sfield = sfield.get_nested_sync_cls()._meta.pk_sfield
+            if nested_pk_sfield is None:
+                continue
+            path = [sf.name for sf in sync_tree.get_sfield_path(sfield)] + [nested_pk_sfield.name]
+            indexes.append('.'.join(path))
+        return sorted(indexes)
+
+    def is_pk_id_field(self):
+        """Хранится ли pk документа в _id"""
+        return (self.pk_sfield.name == self.collection_settings.get('id_field', 'id') or
+                getattr(self.pk_sfield.get_mfield(), 'db_field', None) == '_id')
+
+    def get_shard_key_values(self, instance):
+        """
+        Возвращает значения shard ключа документа инстанса в виде аргументов
+        для filter(), чтобы запрос уходил только на один шард. Значения
+        запоминаются в инстансе, т.к. shard ключ документа не меняется
+        """
+        shard_key = self.collection_settings.get('shard_key')
+        if not shard_key or instance is None:
+            return {}
+
+        cache = instance.__dict__.setdefault('_msync_shard_key_values', {})
+        if self._sync_cls not in cache:
+            if self.shard_key_getter is not None:
+                values = self.shard_key_getter(instance)
+            else:
+                values = {name: self._get_shard_key_value(instance, name) for name in shard_key}
+            cache[self._sync_cls] = {name.replace('.', '__'): value for name, value in six.iteritems(values)}
+        return dict(cache[self._sync_cls])
+
+    def get_shard_key_filter(self, instances):
+        """Возвращает фильтр по значениям shard ключа сразу для нескольких инстансов"""
+        values = defaultdict(list)
+        for instance in instances:
+            for name, value in six.iteritems(self.get_shard_key_values(instance)):
+                if value not in values[name]:
+                    values[name].append(value)
+        return {'%s__in' % name: vals for name, vals in six.iteritems(values)}
+
+    def get_nested_shard_key_filter(self, sfield, instances, removed=False):
+        """
+        Возвращает фильтр по значениям shard ключа документов, которые содержат
+        вложенные инстансы в поле sfield. Значения берутся из nested_shard_key_getter,
+        а для прямых вложенных полей при обновлениях - из родителей, найденных
+        через reverse_rel. Для удаленных инстансов связи уже может не быть,
+        поэтому для них нужен nested_shard_key_getter. Если значения получить
+        нельзя, то бросается TypeError, а не делается запрос на все шарды.
+
+        :param removed: инстансы удалены из базы
+        """
+        if not self.collection_settings.get('shard_key'):
+            return {}
+
+        values = defaultdict(list)
+
+        def add(name, value):
+            for v in (value if isinstance(value, (list, tuple, set)) else [value]):
+                if v not in values[name]:
+                    values[name].append(v)
+
+        if self.nested_shard_key_getter is not None:
+            for instance in instances:
+                for name, value in six.iteritems(self.nested_shard_key_getter(sfield, instance)):
+                    add(name.replace('.', '__'), value)
+        elif not removed and len(self.plan.get_sfield_path(sfield)) == 1 and sfield.has_reverse_rel():
+            reverse_rel = sfield.get_reverse_rel()
+            for instance in instances:
+                for parent in reverse_rel(instance):
+                    if parent is None:
+                        continue
+                    for name, value in six.iteritems(self.get_shard_key_values(parent)):
+                        add(name, value)
+        else:
+            raise TypeError('%s: cannot find shard key values for nested field %s. '
+                            'Define nested_shard_key_getter.' % (self._sync_cls.__name__, sfield.name))
+        if not values:
+            # документов с этими инстансами нет ни на одном шарде
+            return {'%s__in' % name.replace('.', '__'): [] for name in self.collection_settings['shard_key']}
+        return {'%s__in' % name: vals for name, vals in six.iteritems(values)}
+
+    def _get_shard_key_value(self, instance, name):
+        parts = name.split('.')
+        try:
+            sfield = self.sfields_dict[parts[0]]
+        except KeyError:
+            raise TypeError('%s: cannot find sync field for shard key %s. Define shard_key_getter.' % (
+                self._sync_cls.__name__, name))
+
+        value = sfield.value_from_source(instance, with_embedded=True)
+        for part in parts[1:]:
+            value = getattr(value, part, None)
+        return value
 
     def get_simple_sfields(self):
-        return [sfield for sfield in self.sfields if sfield.is_model_sfield()]
+        return list(self.plan.simple_sfields)
 
     def get_sync_tree(self):
         if self.sync_tree is None:
@@ -291,6 +451,15 @@ class SyncTree(object):
     def get_sfield_path(self, sfield):
         return self._get_sfield_path(self._tree, sfield)
 
+    def get_sfield_paths(self):
+        """
+        Возвращает пути ко всем полям дерева. Если поле встречается несколько
+        раз, то берется тот же путь, что и в get_sfield_path
+        """
+        paths = {}
+        self._collect_sfield_paths(self._tree, (), paths)
+        return paths
+
     def pr(self):
         for k in self._tree:
             self._pr(k, self._tree[k], 0)
@@ -306,6 +475,13 @@ class SyncTree(object):
             self._get_all_sfields(all_sfields, tree[sf])
         return all_sfields
 
+    def _collect_sfield_paths(self, tree, path, paths):
+        for sf in tree:
+            if sf not in paths:
+                paths[sf] = path + (sf,)
+        for sf in tree:
+            self._collect_sfield_paths(tree[sf], path + (sf,), paths)
+
     def _get_sfield_path(self, tree, sfield):
         if sfield in tree:
             return [sfield]
@@ -328,3 +504,81 @@ class SyncTree(object):
             nested_sync_cls = sfield.get_nested_sync_cls()
             return self._create_tree(nested_sync_cls._meta.sfields)
         return Tree()
+
+
+class SyncPlan(object):
+    """
+    Неизменяемый набор производных от Options списков и словарей полей, которые
+    нужны при каждой обработке сигнала и построении запроса. Строится один раз
+    после создания sync класса, чтобы не обходить дерево полей на каждый вызов.
+    Списки хранятся как tuple и frozenset, словари - как FrozenDict.
+    """
+
+    def __init__(self, meta):
+        all_sfields = meta.get_sync_tree().get_all_sfields()
+        own_all_sfields = meta.get_own_sync_tree().get_all_sfields()
+
+        nested_model_sfields = defaultdict(list)
+        depends_on_model_sfields = defaultdict(list)
+        for sf in self._unique(all_sfields):
+            if sf.is_nested():
+                nested_model_sfields[sf.get_nested_sync_cls()._meta.model].append(sf)
+            if sf.is_depens_on():
+                depends_on_model_sfields[sf.get_depends_on_model()].append(sf)
+
+        own_nested_sfields = frozenset(sf for sf in own_all_sfields if sf.is_nested())
+        own_depends_on_sfields = frozenset(sf for sf in own_all_sfields if sf.is_depens_on())
+        simple_sfields = tuple(sf for sf in meta.sfields if sf.is_model_sfield())
+
+        # sync классы, простые поля которых заполняются из инстансов модельки и
+        # изменения которых отслеживаются между post_init и post_save
+        tracked_sync_classes = {model: {sf.get_nested_sync_cls() for sf in sfields}
+                                for model, sfields in six.iteritems(nested_model_sfields)}
+        if (meta.model is not None and meta.model not in nested_model_sfields and
+                meta.model not in depends_on_model_sfields):
+            tracked_sync_classes[meta.model] = {meta._sync_cls}
+
+        self.__dict__.update(
+            nested_sfields=frozenset(sf for sf in all_sfields if sf.is_nested()),
+            depends_on_sfields=frozenset(sf for sf in all_sfields if sf.is_depens_on()),
+            own_nested_sfields=own_nested_sfields,
+            own_depends_on_sfields=own_depends_on_sfields,
+            nested_model_sfields=FrozenDict((k, tuple(v)) for k, v in six.iteritems(nested_model_sfields)),
+            depends_on_model_sfields=FrozenDict((k, tuple(v)) for k, v in six.iteritems(depends_on_model_sfields)),
+            all_models=frozenset(nested_model_sfields) | frozenset(depends_on_model_sfields),
+            all_own_models=(frozenset(sf.get_nested_sync_cls()._meta.model for sf in own_nested_sfields) |
+                            frozenset(sf.get_depends_on_model() for sf in own_depends_on_sfields)),
+            simple_sfields=simple_sfields,
+            simple_sfield_names=frozenset(sf.name for sf in simple_sfields),
+            sfield_names=frozenset(meta.sfields_dict),
+            sfield_paths=FrozenDict(meta.get_sync_tree().get_sfield_paths()),
+            tracked_sync_classes=FrozenDict(
+                (model, tuple(sync_cls for sync_cls in sync_classes if sync_cls._meta.track_changes))
+                for model, sync_classes in six.iteritems(tracked_sync_classes)),
+        )
+
+    def __setattr__(self, name, value):
+        raise TypeError('SyncPlan is immutable')
+
+    @staticmethod
+    def _unique(sfields):
+        seen = set()
+        for sf in sfields:
+            if sf not in seen:
+                seen.add(sf)
+                yield sf
+
+    def get_nested_sfields_of_model(self, model):
+        return self.nested_model_sfields.get(model, ())
+
+    def get_depends_on_sfields_of_model(self, model):
+        return self.depends_on_model_sfields.get(model, ())
+
+    def get_tracked_sync_classes(self, model):
+        return self.tracked_sync_classes.get(model, ())
+
+    def get_sfield_path(self, sfield):
+        return self.sfield_paths.get(sfield, ())
+
+    def has_some_field(self, fields):
+        return not self.sfield_names.isdisjoint(fields)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Профилирование обработчиков сигналов по выборке вызовов.
+
+Включается в settings:
+    MSYNC_PROFILING = {'sample_rate': 0.01, 'report_interval': 600}
+Тогда замеряется примерно sample_rate вызовов _post_save_handler,
+_post_delete_handler и _m2m_changed_handler. Время копится по ключу
+(sync класс, моделька, поле, вид операции): для всего обработчика вместе с
+запросами батча поле пустое, а вид операции - название сигнала, для
+каждого поля - save, delete, m2m_add и т.д. Раз в report_interval секунд
+отчет пишется в лог, также его можно получить через get_profiler().format_report().
+Если sample_rate равен 0, то обработчики почти ничего не теряют.
+
+С count_queries = True вместе со временем считаются SQL запросы, которые
+делают get_reverse_rel, source'ы полей и т.д. Если обработчик сделал больше
+query_threshold запросов, то в лог пишется предупреждение с разбивкой по
+полям, а с raise_on_threshold = True выбрасывается AssertionError. Для тестов
+есть контекстный менеджер max_handler_queries(n), который проверяет каждый
+вызов обработчиков внутри него.
+"""
+from __future__ import unicode_literals
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerStat(object):
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+
+    def add(self, elapsed, queries=0, query_time=0.0):
+        self.calls += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.queries += queries
+        self.query_time += query_time
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+
+class HandlerProfiler(object):
+
+    def __init__(self, sample_rate=0.0, report_interval=None, count_queries=False, query_threshold=None,
+                 raise_on_threshold=False):
+        self.sample_rate = sample_rate
+        self.report_interval = report_interval
+        self.count_queries = count_queries
+        self.query_threshold = query_threshold
+        self.raise_on_threshold = raise_on_threshold
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._last_report = time.time()
+
+    def sample(self, sync_cls, model):
+        """
+        Решает, замерять ли этот вызов обработчика. Возвращает объект с
+        контекстным менеджером measure(sfield, op)
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return NULL_SAMPLE
+        return Sample(self, sync_cls, model)
+
+    def add(self, key, elapsed, queries=0, query_time=0.0):
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = self._stats[key] = HandlerStat()
+            stat.add(elapsed, queries, query_time)
+
+        now = time.time()
+        if self.report_interval and now - self._last_report >= self.report_interval:
+            self._last_report = now
+            logger.info('msync handlers profile:\n%s' % self.format_report())
+
+    def check_queries(self, key, queries, breakdown):
+        """
+        Проверяет количество запросов одного вызова обработчика.
+        breakdown - пары (ключ поля, количество запросов)
+        """
+        if self.query_threshold is None or queries <= self.query_threshold:
+            return
+
+        message = '{} {} {}: {} SQL queries, threshold is {}. By sfields: {}'.format(
+            key[0], key[1], key[3], queries, self.query_threshold,
+            ', '.join('{} {}={}'.format(k[2] or '-', k[3], n) for k, n in breakdown) or '-')
+        if self.raise_on_threshold:
+            raise AssertionError(message)
+        logger.warning(message)
+
+    def report(self):
+        """Возвращает пары (ключ, HandlerStat) по убыванию общего времени"""
+        with self._lock:
+            items = list(self._stats.items())
+        return sorted(items, key=lambda item: item[1].total, reverse=True)
+
+    def format_report(self, limit=None):
+        lines = ['{:<30} {:<20} {:<20} {:<12} {:>8} {:>10} {:>10} {:>10} {:>12} {:>8} {:>10}'.format(
+            'sync class', 'model', 'sfield', 'op', 'calls', 'total', 'mean', 'max', 'est. total',
+            'queries', 'sql time')]
+        for (sync_name, model_name, sfield_name, op), stat in self.report()[:limit]:
+            lines.append(
+                '{:<30} {:<20} {:<20} {:<12} {:>8} {:>10.3f} {:>10.4f} {:>10.4f} {:>12.1f} {:>8} {:>10.3f}'.format(
+                    sync_name, model_name, sfield_name or '-', op, stat.calls, stat.total, stat.mean, stat.max,
+                    stat.total / self.sample_rate if self.sample_rate else 0.0, stat.queries, stat.query_time))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class Sample(object):
+    """
+    Замер одного вызова обработчика. Замеры вложены друг в друга: внешний
+    относится ко всему обработчику, внутренние - к полям
+    """
+
+    def __init__(self, profiler, sync_cls, model):
+        self.profiler = profiler
+        self._sync_name = sync_cls.__name__
+        self._model_name = model.__name__
+        self._depth = 0
+        self._breakdown = []
+
+    def measure(self, sfield, op):
+        key = (self._sync_name, self._model_name, sfield.name if sfield is not None else None, op)
+        return Measure(self, key)
+
+    def start(self):
+        self._depth += 1
+
+    def finish(self, key, elapsed, counter, failed):
+        self._depth -= 1
+        queries, query_time = (counter.count, counter.time) if counter is not None else (0, 0.0)
+        self.profiler.add(key, elapsed, queries, query_time)
+
+        if self._depth > 0:
+            self._breakdown.append((key, queries))
+        elif counter is not None and not failed:
+            self.profiler.check_queries(key, queries, self._breakdown)
+
+
+class Measure(object):
+    def __init__(self, sample, key):
+        self._sample = sample
+        self._key = key
+        self._start = None
+        self._counter = None
+
+    def __enter__(self):
+        self._sample.start()
+        if self._sample.profiler.count_queries:
+            self._counter = QueryCounter().__enter__()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, t, value, traceback):
+        elapsed = time.time() - self._start
+        if self._counter is not None:
+            self._counter.__exit__(t, value, traceback)
+        self._sample.finish(self._key, elapsed, self._counter, failed=t is not None)
+
+
+class QueryCounter(object):
+    """
+    Считает SQL запросы всех соединений django внутри контекста. Для этого
+    на время контекста включается debug курсор, а записанные им запросы
+    потом удаляются, если без него они бы не записывались
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self._state = []
+
+    def __enter__(self):
+        from django.db import connections
+
+        for connection in connections.all():
+            self._state.append((connection, connection.use_debug_cursor, len(connection.queries)))
+            connection.use_debug_cursor = True
+        return self
+
+    def __exit__(self, t, value, traceback):
+        from django.conf import settings
+
+        for connection, use_debug_cursor, start in self._state:
+            queries = connection.queries[start:]
+            self.count += len(queries)
+            self.time += sum(float(query['time']) for query in queries)
+
+            connection.use_debug_cursor = use_debug_cursor
+            if not (use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)):
+                del connection.queries[start:]
+
+
+class NullSample(object):
+    """Вызов, который не попал в выборку"""
+
+    def measure(self, sfield, op):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        pass
+
+
+NULL_SAMPLE = NullSample()
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def get_profiler():
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            from django.conf import settings
+            _profiler = HandlerProfiler(**getattr(settings, 'MSYNC_PROFILING', {}))
+    return _profiler
+
+
+@contextmanager
+def max_handler_queries(max_queries):
+    """
+    Используется в тестах: каждый вызов обработчиков сигналов внутри контекста
+    должен делать не больше max_queries SQL запросов, иначе AssertionError
+        with max_handler_queries(3):
+            foo.save()
+    """
+    profiler = get_profiler()
+    options = ('sample_rate', 'count_queries', 'query_threshold', 'raise_on_threshold')
+    old_values = [getattr(profiler, option) for option in options]
+    profiler.sample_rate, profiler.count_queries = 1, True
+    profiler.query_threshold, profiler.raise_on_threshold = max_queries, True
+    try:
+        yield profiler
+    finally:
+        for option, value in zip(options, old_values):
+            setattr(profiler, option, value)
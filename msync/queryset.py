@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 import six
 from .factories import DocumentFactory
+from .merge import RawUpdate, get_mongo_path
 
 
 class QSBase(object):
@@ -28,9 +29,20 @@ class QSBase(object):
     def instance(self):
         return self._instance
 
+    @property
+    def sfield(self):
+        return self._sfield
+
     def _get_path(self):
         return {}
 
+    def get_push_modifiers(self):
+        """
+        Возвращает модификаторы $push ($sort, $slice) для путей в формате монги,
+        которые нужно добавить к запросу при слиянии (см. msync.merge)
+        """
+        return {}
+
     def __or__(self, other):
         return self.union(other)
 
@@ -43,7 +55,7 @@ class QSBase(object):
 
     def __hash__(self):
         path = self.get_path()
-        return hash(frozenset(six.iteritems(path)))
+        return hash(frozenset((k, tuple(v) if isinstance(v, list) else v) for k, v in six.iteritems(path)))
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.get_path() == other.get_path()
@@ -53,10 +65,18 @@ class QSPk(QSBase):
     """
     Строит запросы к primary полям.
     Обычно используется для функции filter().
+    Если у sync класса есть shard_key, то в фильтр по документу инстанса
+    добавляются и значения shard ключа, а в фильтр по вложенному инстансу -
+    значения shard ключа содержащих его документов (см. Options.get_nested_shard_key_filter).
     """
 
-    def __init__(self, pk=None, **kwargs):
+    def __init__(self, pk=None, pks=None, **kwargs):
+        """
+        :param pks: список pk. Если передан, то строится фильтр по всем
+        этим pk сразу через $in
+        """
         self._pk = pk
+        self._pks = pks
         super(QSPk, self).__init__(**kwargs)
 
     def _get_path(self):
@@ -71,10 +91,20 @@ class QSPk(QSBase):
             sfield_name = '{}{}{}'.format(sfield_name, self.delim,
                                           sfield.get_nested_sync_cls()._meta.pk_sfield.name)
 
-        return {sfield_name: pk_value}
+        if self._pks is not None:
+            return {'{}{}in'.format(sfield_name, self.delim): pk_value}
+
+        path = {sfield_name: pk_value}
+        if self._sfield is None:
+            path.update(self._sync_cls._meta.get_shard_key_values(self._instance))
+        elif self._instance is not None:
+            path.update(self._sync_cls._meta.get_nested_shard_key_filter(self._sfield, [self._instance]))
+        return path
 
     def _get_instance_pk_value(self):
-        if self._pk is not None:
+        if self._pks is not None:
+            return list(self._pks)
+        elif self._pk is not None:
             return self._pk
         elif self._instance is not None:
             pk_field = self._instance._meta.pk
@@ -83,23 +113,37 @@ class QSPk(QSBase):
             return None
 
     def _get_find_sfield_name(self, sfield):
-        return self.delim.join([sf.name for sf in self._sync_cls._meta.get_sync_tree().get_sfield_path(sfield)])
+        return self.delim.join([sf.name for sf in self._sync_cls._meta.plan.get_sfield_path(sfield)])
 
 
 class QSUpdate(QSBase):
     """Занимается обновлением вложенных полей"""
 
+    def __init__(self, fields=None, **kwargs):
+        """
+        :param fields: названия простых полей, которые нужно обновить.
+        Если None, то обновляются все простые поля
+        """
+        super(QSUpdate, self).__init__(**kwargs)
+        self._fields = fields
+
     def _get_path(self):
         sfield_path = self._get_sfield_path()
         return self._build_path_of_simple_sfields(sfield_path)
 
     def _build_path_of_simple_sfields(self, sfield_path, op='set'):
         return {op + self.delim + sfield_path + self.delim + sf.name: getattr(self._document, sf.name)
-                for sf in self._sfield.get_nested_sync_cls()._meta.get_simple_sfields()}
+                for sf in self._get_simple_sfields(self._sfield.get_nested_sync_cls())}
+
+    def _get_simple_sfields(self, sync_cls):
+        sfields = sync_cls._meta.plan.simple_sfields
+        if self._fields is None:
+            return sfields
+        return [sf for sf in sfields if sf.name in self._fields]
 
     def _get_sfield_path(self):
         parts = [sf.update_query_path()
-                 for sf in self._sync_cls._meta.get_sync_tree().get_sfield_path(self._sfield)]
+                 for sf in self._sync_cls._meta.plan.get_sfield_path(self._sfield)]
         return self.delim.join(parts)
 
 
@@ -108,7 +152,7 @@ class QSUpdateParent(QSUpdate):
 
     def _build_path_of_simple_sfields(self, sfield_path, op='set'):
         return {op + self.delim + sf.name: getattr(self._document, sf.name)
-                for sf in self._sync_cls._meta.get_simple_sfields()}
+                for sf in self._get_simple_sfields(self._sync_cls)}
 
     def _get_sfield_path(self):
         return None
@@ -124,7 +168,7 @@ class QSUpdateDependentField(QSBase):
         return {op + self.delim + sfield_path: field_values[self._sfield.name]}
 
     def _get_sfield_path(self):
-        parts = [sf.name for sf in self._sync_cls._meta.get_sync_tree().get_sfield_path(self._sfield)]
+        parts = [sf.name for sf in self._sync_cls._meta.plan.get_sfield_path(self._sfield)]
         return self.delim.join(parts)
 
     def _get_field_values(self):
@@ -160,13 +204,27 @@ class QSCreate(QSBase):
         else:
             raise TypeError('At least one document should be supplied to QSCreate')
 
+    @property
+    def documents(self):
+        return [self._document] if self._document is not None else list(self._documents)
+
     def _get_path(self):
         sfield_path = self._get_sfield_path()
         op = self._sfield.update_operation(new=True, many=self._many)
         return {op + self.delim + sfield_path: self._value}
 
+    def get_push_modifiers(self):
+        get_modifiers = getattr(self._sfield, 'get_push_modifiers', None)
+        modifiers = get_modifiers() if get_modifiers is not None else None
+        if not modifiers:
+            return {}
+
+        document_cls = self._sync_cls._meta.document
+        mfields = document_cls._lookup_field(self._get_sfield_path().split(self.delim))
+        return {'.'.join(mfield.db_field for mfield in mfields): modifiers}
+
     def _get_sfield_path(self):
-        parts = [sf.name for sf in self._sync_cls._meta.get_sync_tree().get_sfield_path(self._sfield)]
+        parts = [sf.name for sf in self._sync_cls._meta.plan.get_sfield_path(self._sfield)]
         return self.delim.join(parts)
 
 
@@ -193,8 +251,40 @@ class QSDelete(QSBase):
     def _get_path(self):
         op = self._sfield.remove_operation(many=self._many)
         if op in ('pull', 'pull_all'):
-            pk = QSPk(sync_cls=self._sync_cls, pk=self._value, instance=self._instance,
-                      sfield=self._sfield).get_path()
+            # инстанс не передается, чтобы в условие $pull не попал shard ключ
+            value = self._value if self._value is not None else self._instance.pk
+            pk = QSPk(sync_cls=self._sync_cls, pk=value, sfield=self._sfield).get_path()
         else:
             pk = QSPk(sync_cls=self._sync_cls, sfield=self._sfield).get_path()
         return {op + self.delim + k: v for k, v in six.iteritems(pk)}
+
+
+class QSDeleteIn(QSBase):
+    """
+    Занимается удалением сразу нескольких вложенных объектов по списку pk.
+    Для списков строится один $pull с $in сразу в формате монги (RawUpdate),
+    а встроенные объекты удаляются через unset.
+    """
+
+    def __init__(self, pks=None, **kwargs):
+        super(QSDeleteIn, self).__init__(**kwargs)
+        if not pks:
+            raise TypeError('At least one pk should be supplied to QSDeleteIn')
+        self._pks = list(pks)
+
+    def _get_path(self):
+        sfield_path = self._get_sfield_path()
+        op = self._sfield.remove_operation()
+        if op == 'pull':
+            nested_meta = self._sfield.get_nested_sync_cls()._meta
+            pk_db_field = nested_meta.document._fields[nested_meta.pk_sfield.name].db_field
+            mongo_path = get_mongo_path(self._sync_cls._meta.document, sfield_path)
+            return RawUpdate({'$pull': {mongo_path: {pk_db_field: {'$in': self._pks}}}})
+        return {op + self.delim + sfield_path: None}
+
+    def _get_sfield_path(self):
+        # списки выше по дереву адресуются позиционно, чтобы удалять и из
+        # списков внутри списков (см. msync.arrayfilters)
+        path = self._sync_cls._meta.plan.get_sfield_path(self._sfield)
+        parts = [sf.update_query_path() for sf in path[:-1]] + [self._sfield.name]
+        return self.delim.join(parts)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Перестроение коллекции sync класса без простоя.
+
+do_bulk_insert_of_sync_cls пишет прямо в живую коллекцию, поэтому пока идет
+загрузка, читатели видят неполную коллекцию. rebuild() вместо этого:
+    1. включает журнал изменений (RebuildLog), куда BatchQuery всех процессов
+       записывает фильтры документов, которые он менял в живой коллекции;
+    2. загружает документы в теневую коллекцию без индексов, кроме _id;
+    3. строит индексы документа на теневой коллекции;
+    4. проигрывает журнал: документы, которые менялись во время загрузки,
+       строятся заново из базы и заменяют собой загруженные;
+    5. переименовывает теневую коллекцию в живую через renameCollection
+       с dropTarget, что для читателей происходит атомарно;
+    6. проигрывает то, что успело попасть в журнал между шагами 4 и 5.
+
+Журнал включается только для sync классов с shadow_rebuild = True в Meta,
+остальные классы не делают лишних запросов. renameCollection не работает для
+шардированных коллекций, поэтому для них rebuild() не подходит.
+
+rebuild_all() перестраивает коллекции всех DocumentSync классов: класс
+загружается после тех, на которые он ссылается через ReferenceField, а
+независимые коллекции загружаются параллельно в concurrency потоков.
+Доступно как management команда msync_rebuild.
+"""
+from __future__ import unicode_literals
+import datetime
+import logging
+import threading
+import time
+from bson import BSON, Binary
+from django.core.paginator import Paginator
+from mongoengine.context_managers import switch_collection
+from .routing import get_db_alias_for, get_routed_alias, route_to
+from .utils import chunks, get_pk_db_field, measure_time, replace_documents
+
+
+logger = logging.getLogger(__name__)
+
+REBUILDS_COLLECTION = 'msync_rebuilds'
+SHADOW_SUFFIX = '__shadow'
+LOG_SUFFIX = '__rebuild_log'
+
+
+class RebuildLog(object):
+    """
+    Журнал фильтров документов, которые менялись, пока строится теневая
+    коллекция. Хранится в монге, т.к. обработчики сигналов работают в других
+    процессах. Идет ли перестроение, процессы узнают из коллекции
+    msync_rebuilds и запоминают ответ на check_interval секунд.
+    """
+
+    check_interval = 5
+    _active_cache = {}
+
+    def __init__(self, sync_cls):
+        self._sync_cls = sync_cls
+
+    @property
+    def collection_name(self):
+        return self._sync_cls._meta.document._get_collection_name()
+
+    @property
+    def db(self):
+        return self._sync_cls._meta.document._get_db()
+
+    @property
+    def log_collection(self):
+        return self.db[self.collection_name + LOG_SUFFIX]
+
+    @property
+    def cache_key(self):
+        # коллекции с одним названием в разных соединениях (см. msync.routing) перестраиваются независимо
+        return get_routed_alias(self._sync_cls._meta.document), self.collection_name
+
+    def is_active(self):
+        name = self.collection_name
+        checked_at, active = self._active_cache.get(self.cache_key, (None, False))
+        now = time.time()
+        if checked_at is None or now - checked_at > self.check_interval:
+            active = self.db[REBUILDS_COLLECTION].find_one({'_id': name}) is not None
+            self._active_cache[self.cache_key] = (now, active)
+        return active
+
+    def start(self):
+        name = self.collection_name
+        self.log_collection.drop()
+        self.db[REBUILDS_COLLECTION].save({'_id': name, 'started_at': datetime.datetime.utcnow()})
+        self._active_cache[self.cache_key] = (time.time(), True)
+
+    def stop(self):
+        name = self.collection_name
+        self.db[REBUILDS_COLLECTION].remove({'_id': name})
+        self.log_collection.drop()
+        self._active_cache[self.cache_key] = (time.time(), False)
+
+    def record(self, query):
+        """
+        Записывает фильтр в формате монги. Фильтр хранится закодированным в BSON,
+        т.к. в его ключах бывают точки и операторы
+        """
+        if self.is_active():
+            self.log_collection.insert({'query': Binary(BSON.encode(query))})
+
+    def pop(self):
+        """Возвращает фильтры в порядке записи и удаляет их из журнала"""
+        entries = list(self.log_collection.find().sort('_id', 1))
+        if entries:
+            self.log_collection.remove({'_id': {'$lte': entries[-1]['_id']}})
+        return [BSON(entry['query']).decode() for entry in entries]
+
+
+def rebuild(sync_cls, per_page=1000, max_replays=10, using=None):
+    """
+    Перестраивает коллекцию sync класса через теневую коллекцию, не прерывая
+    работу читателей и сигналов.
+
+    :param sync_cls: DocumentSync с shadow_rebuild = True в Meta
+    :param per_page: размер порции при загрузке и при проигрывании журнала
+    :param max_replays: сколько раз проигрывать журнал до переименования, если
+    в него продолжают приходить изменения
+    :param using: база django, из которой строятся документы. Коллекция
+    перестраивается в соединении монги этой базы (см. msync.routing)
+    :returns int: количество загруженных документов
+    """
+    meta = sync_cls._meta
+    if not meta.shadow_rebuild:
+        raise TypeError('%s: set shadow_rebuild = True in Meta to rebuild it through a shadow collection' %
+                        sync_cls)
+
+    with route_to(meta.document, get_db_alias_for(sync_cls, using)):
+        return _rebuild(sync_cls, per_page, max_replays, using)
+
+
+def _rebuild(sync_cls, per_page, max_replays, using):
+    meta = sync_cls._meta
+
+    document_cls = meta.document
+    db = document_cls._get_db()
+    live_name = document_cls._get_collection_name()
+    shadow = db[live_name + SHADOW_SUFFIX]
+    shadow.drop()
+
+    log = RebuildLog(sync_cls)
+    log.start()
+    try:
+        # ждем, пока остальные процессы заметят, что журнал включен
+        time.sleep(log.check_interval)
+        count = load_documents(sync_cls, shadow, per_page, using=using)
+
+        logger.info('%s: building indexes on %s' % (sync_cls, shadow.name))
+        with measure_time():
+            with switch_collection(document_cls, shadow.name):
+                document_cls.ensure_indexes()
+
+        for i in range(max_replays):
+            if not replay(sync_cls, log, shadow, per_page, using):
+                break
+
+        logger.info('%s: renaming %s to %s' % (sync_cls, shadow.name, live_name))
+        shadow.rename(live_name, dropTarget=True)
+        replay(sync_cls, log, db[live_name], per_page, using)
+    finally:
+        log.stop()
+    return count
+
+
+def load_documents(sync_cls, collection, per_page=1000, replace=False, using=None):
+    """
+    Загружает документы всех инстансов модельки в collection порциями.
+    Возвращает количество загруженных документов
+
+    :param replace: заменять документы через replace с upsert, а не вставлять.
+    Нужно, если в collection уже есть документы
+    :param using: база django, из которой читаются инстансы
+    """
+    model = sync_cls._meta.model
+    count = 0
+    p = Paginator(model.objects.db_manager(using).order_by('pk'), per_page)
+    for i in p.page_range:
+        documents = [d for d in sync_cls.bulk_create_documents_from_queryset(p.page(i).object_list).values() if d]
+        if documents:
+            logger.info('{}: insert of {} documents into {}'.format(sync_cls, len(documents), collection.name))
+            if replace:
+                replace_documents(sync_cls, documents, collection=collection)
+            else:
+                with measure_time():
+                    collection.insert([document.to_mongo() for document in documents])
+            count += len(documents)
+    return count
+
+
+def replay(sync_cls, log, collection, per_page=1000, using=None):
+    """
+    Строит заново документы, которые попадают под фильтры из журнала в живой
+    коллекции или в collection, и записывает их в collection. Документы тех pk,
+    которых больше нет в базе или которые не проходят filter, удаляются.
+
+    :param using: база django, из которой читаются инстансы
+    :returns int: количество проигранных фильтров
+    """
+    queries = log.pop()
+    if not queries:
+        return 0
+
+    meta = sync_cls._meta
+    pk_db_field = get_pk_db_field(sync_cls)
+    collections = [collection]
+    live = meta.document._get_collection()
+    if live.name != collection.name:
+        collections.append(live)
+
+    pks = set()
+    for query in queries:
+        for c in collections:
+            pks.update(d[pk_db_field] for d in c.find(query, {pk_db_field: 1}))
+
+    logger.info('{}: replaying {} changes for {} documents'.format(sync_cls, len(queries), len(pks)))
+    for pks_chunk in chunks(sorted(pks), per_page):
+        documents = sync_cls.bulk_create_documents(list(meta.model.objects.db_manager(using).filter(pk__in=pks_chunk)))
+        replace_documents(sync_cls, documents.values(), collection=collection)
+
+        missing_pks = set(pks_chunk) - {instance.pk for instance in documents}
+        if missing_pks:
+            collection.remove({pk_db_field: {'$in': list(missing_pks)}})
+    return len(queries)
+
+
+class RebuildResult(object):
+    def __init__(self, sync_cls):
+        self.sync_cls = sync_cls
+        self.rows = 0
+        self.seconds = 0.0
+        self.error = None
+        self.skipped = False
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def get_rebuild_dependencies(sync_classes):
+    """
+    Возвращает словарь {sync класс: множество sync классов из sync_classes,
+    на которые он ссылается через ReferenceField на любой глубине вложенности}
+    """
+    from .fields import ReferenceField
+
+    dependencies = {}
+    for sync_cls in sync_classes:
+        sfields = sync_cls._meta.get_sync_tree().get_all_sfields()
+        dependencies[sync_cls] = {sf.ref_sync_cls for sf in sfields
+                                  if isinstance(sf, ReferenceField) and sf.ref_sync_cls in sync_classes and
+                                  sf.ref_sync_cls is not sync_cls}
+    return dependencies
+
+
+def get_rebuild_order(sync_classes):
+    """
+    Разбивает sync классы на уровни: классы одного уровня не зависят друг от
+    друга, а зависят только от классов предыдущих уровней
+    """
+    dependencies = get_rebuild_dependencies(sync_classes)
+    levels, done = [], set()
+    while len(done) < len(sync_classes):
+        level = [sync_cls for sync_cls in sync_classes
+                 if sync_cls not in done and dependencies[sync_cls] <= done]
+        if not level:
+            raise TypeError('Cyclic ReferenceField dependencies between %s' % ', '.join(
+                sync_cls.__name__ for sync_cls in sync_classes if sync_cls not in done))
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+def rebuild_all(sync_classes=None, concurrency=4, per_page=1000, drop=False, using=None):
+    """
+    Перестраивает коллекции sync классов с учетом зависимостей между ними.
+    Классы с shadow_rebuild перестраиваются через rebuild(), остальные
+    загружаются прямо в живую коллекцию, как в do_bulk_insert_of_sync_cls.
+
+    :param sync_classes: список sync классов, по умолчанию все DocumentSync классы
+    :param concurrency: сколько коллекций загружать одновременно
+    :param per_page: размер порции
+    :param drop: удалять ли документы живой коллекции перед загрузкой, если у класса нет
+    shadow_rebuild. Без drop документы заменяются через replace с upsert, а документы
+    удаленных из базы строк остаются в коллекции
+    :param using: база django, из которой строятся документы (см. msync.routing)
+    :returns list: список RebuildResult в порядке загрузки
+    """
+    from .syncers import get_document_sync_classes
+
+    if sync_classes is None:
+        sync_classes = [sync_cls for sync_cls in get_document_sync_classes()
+                        if sync_cls._meta.model is not None]
+    levels = get_rebuild_order(sync_classes)
+    dependencies = get_rebuild_dependencies(sync_classes)
+
+    results = {sync_cls: RebuildResult(sync_cls) for sync_cls in sync_classes}
+    finished = {sync_cls: threading.Event() for sync_cls in sync_classes}
+    semaphore = threading.BoundedSemaphore(concurrency)
+
+    def run(sync_cls):
+        result = results[sync_cls]
+        try:
+            for dependency in dependencies[sync_cls]:
+                finished[dependency].wait()
+            if any(results[dependency].error or results[dependency].skipped
+                   for dependency in dependencies[sync_cls]):
+                result.skipped = True
+                return
+
+            with semaphore:
+                start = time.time()
+                try:
+                    result.rows = _rebuild_sync_cls(sync_cls, per_page, drop, using)
+                except Exception as e:
+                    logger.exception('%s: rebuild failed' % sync_cls)
+                    result.error = e
+                finally:
+                    result.seconds = time.time() - start
+                    _close_connections()
+        finally:
+            finished[sync_cls].set()
+
+    ordered = [sync_cls for level in levels for sync_cls in level]
+    threads = [threading.Thread(target=run, args=(sync_cls,), name='msync-rebuild-%s' % sync_cls.__name__)
+               for sync_cls in ordered]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[sync_cls] for sync_cls in ordered]
+
+
+def _rebuild_sync_cls(sync_cls, per_page, drop, using=None):
+    if sync_cls._meta.shadow_rebuild:
+        return rebuild(sync_cls, per_page=per_page, using=using)
+
+    document_cls = sync_cls._meta.document
+    with route_to(document_cls, get_db_alias_for(sync_cls, using)):
+        collection = document_cls._get_collection()
+        if drop:
+            collection.remove()
+        # без drop в живой коллекции уже есть документы, поэтому они заменяются
+        return load_documents(sync_cls, collection, per_page, replace=not drop, using=using)
+
+
+def _close_connections():
+    from django.db import connection
+    connection.close()
+
+
+def format_summary(results):
+    lines = ['{:<40} {:>12} {:>10} {:>12}  {}'.format('sync class', 'rows', 'seconds', 'rows/sec', 'status')]
+    for result in results:
+        if result.error is not None:
+            status = 'failed: %s' % result.error
+        elif result.skipped:
+            status = 'skipped'
+        else:
+            status = 'ok'
+        lines.append('{:<40} {:>12} {:>10.1f} {:>12.1f}  {}'.format(
+            result.sync_cls.__name__, result.rows, result.seconds, result.rows_per_second, status))
+    total_rows = sum(result.rows for result in results)
+    lines.append('{:<40} {:>12}'.format('total', total_rows))
+    return '\n'.join(lines)
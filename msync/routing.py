@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Маршрутизация записей в монгу по базам django.
+
+Документ sync класса пишется в соединение mongoengine из db_alias в Meta
+(по умолчанию 'default'). Если несколько баз django (например, тенанты)
+нужно синхронизировать в разные кластеры монги, то в Meta sync класса или
+в settings.MSYNC_DB_ALIASES задается соответствие:
+    MSYNC_DB_ALIASES = {'tenant1': 'mongo_tenant1', 'tenant2': 'mongo_tenant2'}
+Алиасы монги регистрируются как обычно через mongoengine.register_connection,
+поэтому у каждого кластера свой MongoClient и свой пул соединений.
+
+Обработчики сигналов передают using в BatchQuery и BatchTask, для каждой
+базы накапливается свой батч, а при выполнении батча документ sync класса
+в текущем потоке переключается на нужное соединение через route_to().
+Переключение хранится в threading.local, поэтому остальные потоки, которые
+читают те же документы, продолжают работать со своим соединением.
+"""
+from __future__ import unicode_literals
+import threading
+from contextlib import contextmanager
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, get_db
+from mongoengine.document import Document
+
+
+_local = threading.local()
+
+
+def get_routed_alias(document_cls):
+    """Алиас, на который документ переключен в текущем потоке, или None"""
+    return getattr(_local, 'aliases', {}).get(document_cls)
+
+
+@contextmanager
+def route_to(document_cls, alias):
+    """
+    Переключает document_cls на соединение alias в текущем потоке.
+    Если alias None, то документ работает со своим db_alias
+    """
+    if alias is None:
+        yield
+        return
+
+    aliases = _local.__dict__.setdefault('aliases', {})
+    previous = aliases.get(document_cls)
+    aliases[document_cls] = alias
+    try:
+        yield
+    finally:
+        if previous is None:
+            del aliases[document_cls]
+        else:
+            aliases[document_cls] = previous
+
+
+def get_db_alias_for(sync_cls, using):
+    """
+    Возвращает алиас монги для базы django using или None, если документ
+    нужно писать в его собственный db_alias
+    """
+    if using is None:
+        return None
+
+    aliases = sync_cls._meta.db_aliases
+    if aliases is None:
+        from django.conf import settings
+        aliases = getattr(settings, 'MSYNC_DB_ALIASES', {})
+    return aliases.get(using)
+
+
+def _get_db(cls):
+    alias = get_routed_alias(cls)
+    return get_db(alias if alias is not None else cls._meta.get('db_alias', DEFAULT_CONNECTION_NAME))
+
+
+def _get_collection(cls):
+    alias = get_routed_alias(cls)
+    if alias is None:
+        return Document._get_collection.__func__(cls)
+
+    if '_routed_collections' not in cls.__dict__:
+        cls._routed_collections = {}
+    collections = cls._routed_collections
+    # название коллекции входит в ключ, чтобы работал switch_collection
+    key = (alias, cls._get_collection_name())
+    if key not in collections:
+        collections[key] = get_db(alias)[key[1]]
+        if cls._meta.get('auto_create_index', True):
+            cls.ensure_indexes()
+    return collections[key]
+
+
+# методы, которые добавляются в генерируемые документы DocumentSync классов
+document_methods = {
+    '_get_db': classmethod(_get_db),
+    '_get_collection': classmethod(_get_collection),
+}
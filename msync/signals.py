@@ -3,8 +3,11 @@ from __future__ import unicode_literals
 import logging
 from functools import partial
 from django.db.models import signals
-from .queryset import QSUpdate, QSUpdateDependentField, QSUpdateParent, QSPk, QSClear, QSDelete, QSCreate
+from .queryset import QSUpdate, QSUpdateDependentField, QSUpdateParent, QSClear, QSDeleteIn, QSCreate
 from .batches import BatchTask, BatchQuery
+from .fingerprints import is_fragment_changed, remember_fragment, forget_fragment
+from .profiling import get_profiler, NULL_SAMPLE
+from .tracking import ChangeTracker
 
 
 logger = logging.getLogger(__name__)
@@ -18,8 +21,9 @@ class SignalConnector(object):
         self.parent_sync_cls = sync_cls
         self.parent_meta = sync_cls._meta
         # FIXME: maybe here we can use only own sfields?
-        self.nested_model_sfields_dict = self.parent_meta.get_nested_model_sfields_dict()
-        self.depends_on_model_sfields_dict = self.parent_meta.get_depends_on_model_sfields_dict()
+        self.plan = self.parent_meta.plan
+        self.tracker = ChangeTracker(sync_cls)
+        self.profiler = get_profiler()
 
     def is_m2m_through_model_of_parent(self, model):
         rel_objects = model._meta.get_all_related_many_to_many_objects()
@@ -33,12 +37,13 @@ class SignalConnector(object):
         """
         Здесь происходит подключение сигналов моделек, определенных во вложенных и 
         зависимых полях, и самой модельки sync_cls._meta.model. 
-        Подключаются post_save, post_delete и m2m_changed.
+        Подключаются post_init, post_save, post_delete и m2m_changed.
         """
-        for model in self.parent_meta.get_all_own_models():
+        for model in self.plan.all_own_models:
             if model is None:
                 continue
 
+            self.connect_signal(signals.post_init, self._post_init_handler, model)
             self.connect_signal(signals.post_save, self._post_save_handler, model)
             self.connect_signal(signals.post_delete, self._post_delete_handler, model)
 
@@ -47,6 +52,7 @@ class SignalConnector(object):
                 self.connect_signal(signals.m2m_changed, self._m2m_changed_handler, through_model)
 
         if self.parent_meta.model is not None:
+            self.connect_signal(signals.post_init, self._post_init_handler, self.parent_sync_cls._meta.model)
             self.connect_signal(signals.post_save, self._post_save_handler, self.parent_sync_cls._meta.model)
             self.connect_signal(signals.post_delete, self._post_delete_handler, self.parent_sync_cls._meta.model)
 
@@ -67,25 +73,52 @@ class SignalConnector(object):
     def _is_parent_sync_async(self):
         return self.parent_sync_cls._meta.async
 
+    def _get_changed_fields(self, sync_cls, instance, created, update_fields):
+        """
+        Возвращает названия изменившихся простых полей sync_cls или None,
+        если нужно обновить все поля
+        """
+        if created or update_fields or not sync_cls._meta.track_changes:
+            return None
+        return self.tracker.get_changed_fields(instance, sync_cls)
+
+    def _post_init_handler(self, instance, **kwargs):
+        for sync_cls in self.plan.get_tracked_sync_classes(instance.__class__):
+            self.tracker.snapshot(instance, sync_cls)
+
     def _post_save_handler(self, instance, raw, created, using, update_fields, **kwargs):
         if self.is_m2m_through_model_of_parent(instance.__class__) and created:
             return
 
-        with BatchQuery(self.parent_sync_cls) as b, BatchTask(self.parent_sync_cls) as t:
-            nested_sfields = self.nested_model_sfields_dict[instance.__class__]
+        sample = self.profiler.sample(self.parent_sync_cls, instance.__class__)
+        try:
+            with sample.measure(None, 'post_save'):
+                self._handle_post_save(instance, created, update_fields, sample, using=using)
+        finally:
+            self._post_init_handler(instance)
+
+    def _handle_post_save(self, instance, created, update_fields, sample=NULL_SAMPLE, using=None):
+        with BatchQuery(self.parent_sync_cls, using) as b, BatchTask(self.parent_sync_cls, using) as t:
+            nested_sfields = self.plan.get_nested_sfields_of_model(instance.__class__)
             for sfield in nested_sfields:
-                if update_fields and not sfield.get_nested_sync_cls().has_some_field(update_fields):
+                sync_cls = sfield.get_nested_sync_cls()
+                if update_fields and not sync_cls.has_some_field(update_fields):
+                    continue
+
+                fields = self._get_changed_fields(sync_cls, instance, created, update_fields)
+                if fields is not None and not fields:
                     continue
 
                 task = partial(save_nested_sfield, parent_sync_cls=self.parent_sync_cls, sfield=sfield,
-                               instance=instance, created=created)
+                               instance=instance, created=created, fields=fields, using=using)
 
                 if self._is_nested_sfield_async(sfield):
                     t.add(task)
                 else:
-                    task(b)
+                    with sample.measure(sfield, 'save'):
+                        task(b)
 
-            dependent_sfields = self.depends_on_model_sfields_dict[instance.__class__]
+            dependent_sfields = self.plan.get_depends_on_sfields_of_model(instance.__class__)
             for sfield in dependent_sfields:
                 if sfield.is_belongs_to_parent(instance):
 
@@ -95,34 +128,46 @@ class SignalConnector(object):
                     if self._is_dependent_sfield_async(sfield):
                         t.add(task)
                     else:
-                        task(b)
+                        with sample.measure(sfield, 'save'):
+                            task(b)
 
             if not nested_sfields and not dependent_sfields and self.parent_meta.pass_filter(instance):
                 if update_fields and not self.parent_sync_cls.has_some_field(update_fields):
                     return
 
+                fields = self._get_changed_fields(self.parent_sync_cls, instance, created, update_fields)
+                if fields is not None and not fields:
+                    return
+
                 task = partial(save_parent_sfields, parent_sync_cls=self.parent_sync_cls, instance=instance,
-                               created=created)
+                               created=created, fields=fields)
 
                 if self._is_parent_sync_async():
                     t.add(task)
                 else:
-                    task(b)
+                    with sample.measure(None, 'save'):
+                        task(b)
 
     def _post_delete_handler(self, instance, using, **kwargs):
-        with BatchQuery(self.parent_sync_cls) as b, BatchTask(self.parent_sync_cls) as t:
-            nested_sfields = self.nested_model_sfields_dict[instance.__class__]
+        sample = self.profiler.sample(self.parent_sync_cls, instance.__class__)
+        with sample.measure(None, 'post_delete'):
+            self._handle_post_delete(instance, sample, using=using)
+
+    def _handle_post_delete(self, instance, sample=NULL_SAMPLE, using=None):
+        with BatchQuery(self.parent_sync_cls, using) as b, BatchTask(self.parent_sync_cls, using) as t:
+            nested_sfields = self.plan.get_nested_sfields_of_model(instance.__class__)
             for sfield in nested_sfields:
 
                 task = partial(delete_nested_sfield, parent_sync_cls=self.parent_sync_cls, sfield=sfield,
-                               instance=instance)
+                               instance=instance, using=using)
 
                 if self._is_nested_sfield_async(sfield):
                     t.add(task)
                 else:
-                    task(b)
+                    with sample.measure(sfield, 'delete'):
+                        task(b)
 
-            dependent_sfields = self.depends_on_model_sfields_dict[instance.__class__]
+            dependent_sfields = self.plan.get_depends_on_sfields_of_model(instance.__class__)
             for sfield in dependent_sfields:
                 if sfield.is_belongs_to_parent(instance):
 
@@ -132,7 +177,8 @@ class SignalConnector(object):
                     if self._is_dependent_sfield_async(sfield):
                         t.add(task)
                     else:
-                        task(b)
+                        with sample.measure(sfield, 'delete'):
+                            task(b)
 
             if not nested_sfields and not dependent_sfields and self.parent_meta.pass_filter(instance):
                 task = partial(delete_parent, parent_sync_cls=self.parent_sync_cls, instance=instance,
@@ -141,20 +187,26 @@ class SignalConnector(object):
                 if self._is_parent_sync_async():
                     t.add(task)
                 else:
-                    task(b)
+                    with sample.measure(None, 'delete'):
+                        task(b)
 
-    def _m2m_changed_handler(self, action, instance, model, pk_set, **kwargs):
+    def _m2m_changed_handler(self, action, instance, model, pk_set, using=None, **kwargs):
         if action not in ('post_add', 'post_remove', 'post_clear'):
             return
 
-        with BatchQuery(self.parent_sync_cls) as b, BatchTask(self.parent_sync_cls) as t:
-            nested_sfields = self.nested_model_sfields_dict[model]
+        sample = self.profiler.sample(self.parent_sync_cls, model)
+        with sample.measure(None, 'm2m_changed'):
+            self._handle_m2m_changed(action, instance, model, pk_set, sample, using=using)
+
+    def _handle_m2m_changed(self, action, instance, model, pk_set, sample=NULL_SAMPLE, using=None):
+        with BatchQuery(self.parent_sync_cls, using) as b, BatchTask(self.parent_sync_cls, using) as t:
+            nested_sfields = self.plan.get_nested_sfields_of_model(model)
             for sfield in nested_sfields:
                 task = None
 
                 if action == 'post_add':
                     task = partial(m2m_post_add, parent_sync_cls=self.parent_sync_cls, sfield=sfield,
-                                   pk_set=pk_set, model=model, instance=instance)
+                                   pk_set=pk_set, model=model, instance=instance, using=using)
                 elif action == 'post_remove':
                     task = partial(m2m_post_remove, parent_sync_cls=self.parent_sync_cls, sfield=sfield,
                                    pk_set=pk_set, instance=instance)
@@ -166,12 +218,26 @@ class SignalConnector(object):
                     if self._is_nested_sfield_async(sfield):
                         t.add(task)
                     else:
-                        task(b)
+                        with sample.measure(sfield, action.replace('post_', 'm2m_')):
+                            task(b)
 
 
-def save_nested_sfield(batch, parent_sync_cls=None, sfield=None, instance=None, created=None):
+def save_nested_sfield(batch, parent_sync_cls=None, sfield=None, instance=None, created=None, fields=None,
+                       force=False, using=None):
+    """
+    :param force: обновить родителей, даже если отпечаток вложенного объекта
+    не изменился (см. msync.fingerprints)
+    :param using: база django, из которой сохранен инстанс
+    """
     sync_cls = sfield.get_nested_sync_cls()
     document = sync_cls.create_document(instance, with_embedded=created)
+    changed = is_fragment_changed(parent_sync_cls, sfield, instance, document, using)
+    if not changed and not (created or force):
+        return
+    if changed:
+        # отпечаток запоминается и для нового объекта, чтобы следующее сохранение
+        # без изменений не обновляло родителей, но только когда батч выполнится
+        batch.after_run(partial(remember_fragment, parent_sync_cls, sfield, instance, document, using))
 
     if created:
         par_ins = sfield.get_reverse_rel()(instance)
@@ -179,7 +245,7 @@ def save_nested_sfield(batch, parent_sync_cls=None, sfield=None, instance=None,
             batch[pi] = QSCreate(sync_cls=parent_sync_cls, document=document, sfield=sfield)
     else:
         batch[(instance, sfield)] = QSUpdate(sync_cls=parent_sync_cls, document=document,
-                                             sfield=sfield)
+                                             sfield=sfield, fields=fields)
 
 
 def save_dependent_sfield(batch, parent_sync_cls=None, sfield=None, instance=None):
@@ -189,17 +255,17 @@ def save_dependent_sfield(batch, parent_sync_cls=None, sfield=None, instance=Non
                                            sfield=sfield)
 
 
-def save_parent_sfields(batch, parent_sync_cls=None, instance=None, created=None):
+def save_parent_sfields(batch, parent_sync_cls=None, instance=None, created=None, fields=None):
     document = parent_sync_cls.create_document(instance, with_embedded=created)
     if created:
-        logger.info('{}.save()'.format(parent_sync_cls))
-        document.save()
+        batch.insert(document)
     else:
-        batch[instance] = QSUpdateParent(sync_cls=parent_sync_cls, document=document)
+        batch[instance] = QSUpdateParent(sync_cls=parent_sync_cls, document=document, fields=fields)
 
 
-def delete_nested_sfield(batch, parent_sync_cls=None, sfield=None, instance=None):
-    batch[(instance, sfield)] = QSDelete(sync_cls=parent_sync_cls, sfield=sfield, instance=instance)
+def delete_nested_sfield(batch, parent_sync_cls=None, sfield=None, instance=None, using=None):
+    forget_fragment(parent_sync_cls, sfield, instance, using)
+    batch.delete(instance, sfield=sfield)
 
 
 def delete_dependent_sfield(batch, parent_sync_cls=None, instance=None, sfield=None):
@@ -208,15 +274,13 @@ def delete_dependent_sfield(batch, parent_sync_cls=None, instance=None, sfield=N
         batch[pi] = QSUpdateDependentField(sync_cls=parent_sync_cls, instance=pi, sfield=sfield)
 
 
-def delete_parent(_, parent_sync_cls=None, parent_meta=None, instance=None):
-    pk_path = QSPk(sync_cls=parent_sync_cls, instance=instance).get_path()
-    logger.info('{}.filter({}).delete()'.format(parent_sync_cls, pk_path))
-    parent_meta.document.objects.filter(**pk_path).delete()
+def delete_parent(batch, parent_sync_cls=None, parent_meta=None, instance=None):
+    batch.delete(instance)
 
 
-def m2m_post_add(_, parent_sync_cls=None, sfield=None, pk_set=None, model=None, instance=None):
+def m2m_post_add(_, parent_sync_cls=None, sfield=None, pk_set=None, model=None, instance=None, using=None):
     sync_cls = sfield.get_nested_sync_cls()
-    model_instances = model.objects.filter(pk__in=pk_set)
+    model_instances = model.objects.db_manager(using).filter(pk__in=pk_set)
 
     documents = [sync_cls.create_document(model_instance, with_embedded=True)
                  for model_instance in model_instances]
@@ -224,14 +288,13 @@ def m2m_post_add(_, parent_sync_cls=None, sfield=None, pk_set=None, model=None,
     if not documents:
         return
 
-    with BatchQuery(parent_sync_cls) as b:
+    with BatchQuery(parent_sync_cls, using) as b:
         b[instance] = QSCreate(sync_cls=parent_sync_cls, documents=documents, sfield=sfield)
 
 
-def m2m_post_remove(_, parent_sync_cls=None, sfield=None, pk_set=None, instance=None):
-    for pk in pk_set:
-        with BatchQuery(parent_sync_cls) as b:
-            b[instance] = QSDelete(sync_cls=parent_sync_cls, sfield=sfield, pk=pk)
+def m2m_post_remove(batch, parent_sync_cls=None, sfield=None, pk_set=None, instance=None):
+    if pk_set:
+        batch[instance] = QSDeleteIn(sync_cls=parent_sync_cls, sfield=sfield, pks=pk_set)
 
 
 def m2m_post_clear(batch, parent_sync_cls=None, sfield=None, instance=None):
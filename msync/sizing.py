@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Подбор размера порций при массовой загрузке документов.
+
+Фиксированный per_page не подходит всем sync классам сразу: для тонких
+документов 1000 инстансов - это лишние запросы, а документы с большими
+вложенными списками упираются в лимит сообщения монги (48MB) и съедают память.
+AdaptiveBatchSizer после каждой порции смотрит на время SQL, построения
+документов и вставки, а также на размер документов в BSON, и выбирает:
+    - page_size: сколько инстансов брать в следующей порции, чтобы порция
+      обрабатывалась примерно target_seconds и занимала не больше max_page_bytes;
+    - размер insert'а: сколько документов отправлять в монгу одним запросом,
+      чтобы он был не больше max_message_bytes и шел примерно insert_target_seconds.
+Порция растет не больше чем в max_growth раз за шаг, а уменьшается сразу.
+"""
+from __future__ import unicode_literals
+import logging
+from bson import BSON
+
+
+logger = logging.getLogger(__name__)
+
+
+class PageStats(object):
+    """Замеры одной порции"""
+
+    def __init__(self, count, sql_seconds=0.0, build_seconds=0.0, insert_seconds=0.0, document_bytes=0):
+        """
+        :param count: количество инстансов в порции
+        :param document_bytes: средний размер документа в BSON
+        """
+        self.count = count
+        self.sql_seconds = sql_seconds
+        self.build_seconds = build_seconds
+        self.insert_seconds = insert_seconds
+        self.document_bytes = document_bytes
+
+    @property
+    def seconds(self):
+        return self.sql_seconds + self.build_seconds + self.insert_seconds
+
+
+class AdaptiveBatchSizer(object):
+
+    def __init__(self, page_size=1000, target_seconds=5.0, min_page_size=10, max_page_size=50000,
+                 max_growth=2.0, max_page_bytes=64 * 1024 * 1024, max_message_bytes=16 * 1024 * 1024,
+                 insert_target_seconds=1.0, sample_size=100):
+        """
+        :param page_size: размер первой порции
+        :param target_seconds: сколько должна обрабатываться одна порция
+        :param max_page_bytes: сколько документов порции может занимать в памяти
+        :param max_message_bytes: максимальный размер одного insert'а
+        :param insert_target_seconds: сколько должен идти один insert
+        :param sample_size: по скольким документам порции оценивать их размер
+        """
+        self.page_size = page_size
+        self.target_seconds = target_seconds
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.max_growth = max_growth
+        self.max_page_bytes = max_page_bytes
+        self.max_message_bytes = max_message_bytes
+        self.insert_target_seconds = insert_target_seconds
+        self.sample_size = sample_size
+        self.insert_chunk_size = None
+        self.last_stats = None
+
+    def measure_documents(self, mongo_documents):
+        """
+        Оценивает средний и максимальный размер документов в BSON по выборке
+        из sample_size документов, равномерно взятых из порции
+        """
+        if not mongo_documents:
+            return 0, 0
+        step = max(len(mongo_documents) // self.sample_size, 1)
+        sizes = [len(BSON.encode(d)) for d in mongo_documents[::step][:self.sample_size]]
+        return sum(sizes) // len(sizes), max(sizes)
+
+    def get_insert_chunk_size(self, max_document_bytes):
+        """Сколько документов отправлять одним insert'ом"""
+        by_message = max(int(self.max_message_bytes // max(max_document_bytes, 1)), 1)
+        if self.insert_chunk_size is None:
+            return by_message
+        return max(min(self.insert_chunk_size, by_message), 1)
+
+    def update(self, stats):
+        """Выбирает размер следующей порции и insert'а по замерам stats"""
+        self.last_stats = stats
+        if not stats.count:
+            return self.page_size
+
+        limits = {'growth': int(self.page_size * self.max_growth), 'max': self.max_page_size}
+        if stats.seconds > 0:
+            limits['time'] = int(self.target_seconds * stats.count / stats.seconds)
+        if stats.document_bytes:
+            limits['memory'] = int(self.max_page_bytes // stats.document_bytes)
+        reason = min(limits, key=lambda k: limits[k])
+        new_size = max(limits[reason], self.min_page_size)
+
+        if stats.insert_seconds > 0:
+            self.insert_chunk_size = max(int(self.insert_target_seconds * stats.count / stats.insert_seconds), 1)
+
+        logger.info('page of {} took {:.2f}s (sql {:.2f}s, build {:.2f}s, insert {:.2f}s), {} bytes per document: '
+                    'page size {} -> {} (limited by {}), insert chunk {}'.format(
+                        stats.count, stats.seconds, stats.sql_seconds, stats.build_seconds, stats.insert_seconds,
+                        stats.document_bytes, self.page_size, new_size, reason, self.insert_chunk_size))
+        self.page_size = new_size
+        return new_size
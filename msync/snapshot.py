@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Выгрузка документов sync класса в BSON файлы без записи в монгу и их загрузка.
+
+export_snapshot() строит документы через DocumentFactory порциями и пишет их
+в формате mongodump:
+    <path>/<db>/<collection>.bson            документы
+    <path>/<db>/<collection>.metadata.json   индексы документа
+Такой каталог можно восстановить через mongorestore, а с compress=True файлы
+сжимаются gzip'ом и восстанавливаются через mongorestore --gzip.
+
+Если задан shard_size, то документы, отсортированные по pk, разбиваются на
+файлы <collection>.0000.bson, <collection>.0001.bson, ... по shard_size штук,
+т.е. каждый файл хранит свой диапазон pk. Диапазоны записываются в
+<collection>.manifest.json. Такие файлы восстанавливаются по одному через
+mongorestore -c <collection> или все вместе через import_snapshot().
+
+Документы можно строить с реплики базы django, а монгу нагружает только
+финальная загрузка.
+"""
+from __future__ import unicode_literals
+import gzip
+import io
+import logging
+import os
+import six
+import bson
+from bson import json_util, ObjectId, SON
+from django.core.paginator import Paginator
+from mongoengine.connection import DEFAULT_CONNECTION_NAME, _connection_settings
+from .routing import get_db_alias_for, route_to
+from .utils import measure_time
+
+
+logger = logging.getLogger(__name__)
+
+
+def export_snapshot(sync_cls, path, per_page=1000, shard_size=None, compress=False, db_name=None,
+                    queryset=None, using=None):
+    """
+    :param sync_cls: DocumentSync, документы которого выгружаются
+    :param path: каталог выгрузки
+    :param per_page: размер порции при построении документов
+    :param shard_size: сколько документов писать в один файл. Если None, то все в один
+    :param compress: сжимать ли файлы gzip'ом
+    :param db_name: название базы в монге, по умолчанию берется из настроек подключения
+    :param queryset: QuerySet модельки, по умолчанию все инстансы
+    :param using: база django, из которой читаются инстансы. По умолчанию название
+    базы в монге берется из соединения этой базы (см. msync.routing)
+    :returns list: описания файлов: {'file': ..., 'count': ..., 'min_pk': ..., 'max_pk': ...}
+    """
+    document_cls = sync_cls._meta.document
+    collection_name = document_cls._get_collection_name()
+    directory = get_snapshot_dir(sync_cls, path, db_name, using)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    if queryset is None:
+        queryset = sync_cls._meta.model.objects.db_manager(using).all()
+    elif using is not None:
+        queryset = queryset.using(using)
+
+    writer = SnapshotWriter(directory, collection_name, shard_size, compress)
+    p = Paginator(queryset.order_by('pk'), per_page)
+    try:
+        for i in p.page_range:
+            documents = sync_cls.bulk_create_documents_from_queryset(p.page(i).object_list)
+            for pk, document in six.iteritems(documents):
+                if document is not None:
+                    writer.write(pk, document.to_mongo())
+            logger.info('{}: exported {} documents'.format(sync_cls, writer.total))
+    finally:
+        writer.close()
+
+    suffix = '.gz' if compress else ''
+    with _open(os.path.join(directory, '%s.metadata.json%s' % (collection_name, suffix)), 'wb', compress) as f:
+        f.write(json_util.dumps(get_metadata(document_cls, os.path.basename(directory))).encode('utf-8'))
+
+    if shard_size:
+        with io.open(os.path.join(directory, '%s.manifest.json' % collection_name), 'wb') as f:
+            f.write(json_util.dumps({'collection': collection_name, 'files': writer.files}, indent=2).encode('utf-8'))
+    return writer.files
+
+
+def import_snapshot(sync_cls, path, batch_size=1000, db_name=None, collection_name=None, drop=False, using=None):
+    """
+    Загружает выгрузку export_snapshot() в коллекцию и строит индексы после загрузки.
+
+    :param collection_name: куда загружать, по умолчанию в коллекцию документа.
+    Например, в теневую коллекцию, которую потом можно переименовать
+    :param drop: удалить ли коллекцию перед загрузкой
+    :param using: база django, в соединение монги которой загружаются документы
+    (см. msync.routing)
+    :returns int: количество загруженных документов
+    """
+    document_cls = sync_cls._meta.document
+    source_name = document_cls._get_collection_name()
+    directory = get_snapshot_dir(sync_cls, path, db_name, using)
+    with route_to(document_cls, get_db_alias_for(sync_cls, using)):
+        collection = document_cls._get_db()[collection_name or source_name]
+    if drop:
+        collection.drop()
+
+    count = 0
+    for file_name in get_snapshot_files(directory, source_name):
+        compress = file_name.endswith('.gz')
+        with _open(os.path.join(directory, file_name), 'rb', compress) as f:
+            batch = []
+            for document in bson.decode_file_iter(f):
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    count += _insert(collection, batch)
+                    batch = []
+            count += _insert(collection, batch)
+        logger.info('{}: imported {}, {} documents in total'.format(sync_cls, file_name, count))
+
+    logger.info('{}: building indexes on {}'.format(sync_cls, collection.name))
+    with measure_time():
+        for index in get_metadata(document_cls, collection.database.name)['indexes']:
+            if index['name'] != '_id_':
+                options = {k: v for k, v in index.items() if k not in ('key', 'ns', 'v')}
+                collection.create_index(list(index['key'].items()), **options)
+    return count
+
+
+def get_snapshot_dir(sync_cls, path, db_name=None, using=None):
+    if db_name is None:
+        alias = get_db_alias_for(sync_cls, using)
+        if alias is None:
+            alias = sync_cls._meta.document._meta.get('db_alias', DEFAULT_CONNECTION_NAME)
+        db_name = _connection_settings.get(alias, {}).get('name')
+        if db_name is None:
+            raise TypeError('%s: cannot find database name for alias %s. Pass db_name.' % (sync_cls, alias))
+    return os.path.join(path, db_name)
+
+
+def get_snapshot_files(directory, collection_name):
+    """Возвращает файлы с документами коллекции в порядке pk"""
+    manifest = os.path.join(directory, '%s.manifest.json' % collection_name)
+    if os.path.exists(manifest):
+        with io.open(manifest, 'rb') as f:
+            return [item['file'] for item in json_util.loads(f.read().decode('utf-8'))['files']]
+
+    for file_name in ('%s.bson' % collection_name, '%s.bson.gz' % collection_name):
+        if os.path.exists(os.path.join(directory, file_name)):
+            return [file_name]
+    return []
+
+
+def get_metadata(document_cls, db_name):
+    """Описание индексов документа в формате metadata.json mongodump"""
+    ns = '%s.%s' % (db_name, document_cls._get_collection_name())
+    indexes = [SON([('v', 1), ('key', SON([('_id', 1)])), ('name', '_id_'), ('ns', ns)])]
+    for spec in document_cls._meta.get('index_specs') or []:
+        key = SON(spec['fields'])
+        if list(key.keys()) == ['_id']:
+            continue
+        index = SON([('v', 1), ('key', key), ('name', '_'.join('%s_%s' % item for item in spec['fields'])),
+                     ('ns', ns)])
+        index.update((k, v) for k, v in spec.items() if k not in ('fields', 'cls', 'types'))
+        indexes.append(index)
+    return {'options': {}, 'indexes': indexes}
+
+
+class SnapshotWriter(object):
+    """Пишет документы в файлы по shard_size штук и запоминает диапазоны pk"""
+
+    def __init__(self, directory, collection_name, shard_size=None, compress=False):
+        self.directory = directory
+        self.collection_name = collection_name
+        self.shard_size = shard_size
+        self.compress = compress
+        self.files = []
+        self.total = 0
+        self._file = None
+
+    def write(self, pk, mongo_document):
+        if self._file is None or (self.shard_size and self.files[-1]['count'] >= self.shard_size):
+            self._open_next()
+
+        if '_id' not in mongo_document:
+            mongo_document['_id'] = ObjectId()
+        self._file.write(bson.BSON.encode(mongo_document))
+
+        info = self.files[-1]
+        if info['count'] == 0:
+            info['min_pk'] = pk
+        info['max_pk'] = pk
+        info['count'] += 1
+        self.total += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open_next(self):
+        self.close()
+        if self.shard_size:
+            file_name = '%s.%04d.bson' % (self.collection_name, len(self.files))
+        else:
+            file_name = '%s.bson' % self.collection_name
+        if self.compress:
+            file_name += '.gz'
+
+        self._file = _open(os.path.join(self.directory, file_name), 'wb', self.compress)
+        self.files.append({'file': file_name, 'count': 0, 'min_pk': None, 'max_pk': None})
+
+
+def _open(file_path, mode, compress):
+    if compress:
+        return gzip.open(file_path, mode)
+    return io.open(file_path, mode)
+
+
+def _insert(collection, documents):
+    if not documents:
+        return 0
+    with measure_time():
+        collection.insert(documents, manipulate=False)
+    return len(documents)
@@ -57,6 +57,9 @@ class SyncMC(type):
         # create document factory
         new_class._document_factory = DocumentFactory(new_class)
 
+        # precompute lookups used by signals and queries
+        meta.build_plan()
+
         # connect signals
         new_class.connect_signals()
 
@@ -100,6 +103,15 @@ class SyncBase(six.with_metaclass(SyncMC)):
         passed_instances = filter(cls._meta.pass_filter, instances)
         return cls._document_factory.bulk_create(passed_instances)
 
+    @classmethod
+    def bulk_create_documents_from_queryset(cls, queryset, timings=None):
+        """
+        То же, что bulk_create_documents, но принимает QuerySet модельки и
+        возвращает OrderedDict {pk: document или None}. Простые поля выбираются
+        через values_list без инстансов (см. DocumentFactory.bulk_create_from_queryset)
+        """
+        return cls._document_factory.bulk_create_from_queryset(queryset, timings)
+
     @classmethod
     def connect_signals(cls):
         """
@@ -120,11 +132,11 @@ class SyncBase(six.with_metaclass(SyncMC)):
         которые не нужно обновлять, т.к. нет такого поля
         в монге
         """
-        return field in cls._meta.sfields_dict
+        return field in cls._meta.plan.sfield_names
 
     @classmethod
     def has_some_field(cls, fields):
-        return any(cls.has_field(field) for field in fields)
+        return cls._meta.plan.has_some_field(fields)
 
 
 class DocumentSync(SyncBase):
@@ -164,3 +176,17 @@ class DynamicEmbeddedSync(EmbeddedSync):
     DynamicEmbeddedDocument из mongoengine не пропал :)
     """
     document_type = document.DynamicEmbeddedDocument
+
+
+def get_document_sync_classes():
+    """
+    Возвращает все sync классы, у которых есть своя коллекция в монге,
+    т.е. наследников DocumentSync и DynamicDocumentSync
+    """
+    sync_classes, stack = [], [DocumentSync]
+    while stack:
+        cls = stack.pop()
+        stack.extend(cls.__subclasses__())
+        if hasattr(cls, '_meta') and cls not in sync_classes:
+            sync_classes.append(cls)
+    return sync_classes
@@ -4,9 +4,9 @@ from celery import task
 
 
 @task.task()
-def sync_task(parent_sync_cls, tasks):
+def sync_task(parent_sync_cls, tasks, using=None):
     from .batches import BatchQuery
 
-    with BatchQuery(parent_sync_cls) as b:
+    with BatchQuery(parent_sync_cls, using=using) as b:
         for t in tasks:
             t(b)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import six
+
+
+class ChangeTracker(object):
+    """
+    Отслеживает изменения простых полей sync классов.
+
+    На post_init запоминаются значения простых полей, а на post_save
+    по ним вычисляется список изменившихся полей. Так обновление в монге
+    содержит только реально изменившиеся значения, а сохранение, которое
+    не затронуло ни одного синхронизируемого поля, в монгу вообще не идет.
+
+    Отслеживаются только поля, у которых source является названием
+    атрибута модельки (без точек и не функция). Значения берутся прямо из
+    instance.__dict__, чтобы не делать запросов к базе при инициализации
+    (например, для отложенных полей или ForeignKey). Остальные поля
+    всегда считаются изменившимися.
+    """
+
+    attr_name = '_msync_snapshots'
+
+    def __init__(self, owner):
+        """
+        :param owner: sync класс, сигналы которого пользуются трекером.
+        Снимки хранятся отдельно для каждого владельца, чтобы обработчики
+        разных sync классов не перетирали друг другу состояние
+        """
+        self.owner = owner
+
+    def snapshot(self, instance, sync_cls):
+        snapshots = instance.__dict__.setdefault(self.attr_name, {})
+        snapshots[(self.owner, sync_cls)] = self._get_values(instance, sync_cls)
+
+    def get_changed_fields(self, instance, sync_cls):
+        """
+        Возвращает множество названий простых полей sync_cls, которые изменились
+        с момента последнего снимка, или None, если снимка нет
+        """
+        snapshot = instance.__dict__.get(self.attr_name, {}).get((self.owner, sync_cls))
+        if snapshot is None:
+            return None
+
+        values = self._get_values(instance, sync_cls)
+        changed = set()
+        for sfield in sync_cls._meta.plan.simple_sfields:
+            name = sfield.name
+            if name not in values or name not in snapshot or values[name] != snapshot[name]:
+                changed.add(name)
+        return changed
+
+    def _get_values(self, instance, sync_cls):
+        values = {}
+        for sfield in sync_cls._meta.plan.simple_sfields:
+            source = sfield._source
+            if self.is_trackable_source(source) and source in instance.__dict__:
+                values[sfield.name] = instance.__dict__[source]
+        return values
+
+    @staticmethod
+    def is_trackable_source(source):
+        return isinstance(source, six.string_types) and '.' not in source
@@ -26,6 +26,20 @@ def islist(obj):
     return isinstance(obj, (list, tuple))
 
 
+class FrozenDict(dict):
+    """Словарь, который нельзя изменить после создания"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+
+def chunks(lst, size):
+    """Разбивает список на части по size элементов"""
+    return [lst[i:i + size] for i in range(0, len(lst), size)]
+
+
 def to_dict(document):
     """
     Удаляет ObjectId и _cls поля и переводит документ в словарь
@@ -81,21 +95,57 @@ def queryset_manager(func):
     return manager
 
 
-def do_bulk_insert_of_sync_cls(sync_cls, per_page=1000):
+def do_bulk_insert_of_sync_cls(sync_cls, per_page=1000, adaptive=False, **sizer_options):
     """
     Добавляет в монгу инстансы модельки sync_cls._meta.model порциями
-    в per_page штук за раз
+    в per_page штук за раз. С adaptive=True per_page - это размер первой
+    порции, а следующие подбираются по замерам (см. msync.bulk.adaptive_bulk_insert)
     """
+    if adaptive:
+        from .bulk import adaptive_bulk_insert
+        return adaptive_bulk_insert(sync_cls, page_size=per_page, **sizer_options)
+
     model = sync_cls._meta.model
     document = sync_cls._meta.document
 
-    p = Paginator(model.objects.all(), per_page)
+    p = Paginator(model.objects.order_by('pk'), per_page)
     for i in p.page_range:
         page = p.page(i)
-        documents = sync_cls.bulk_create_documents(page.object_list)
+        documents = [d for d in sync_cls.bulk_create_documents_from_queryset(page.object_list).values() if d]
         if documents:
             print('%s: %s' % (model, len(documents)))
-            document.objects.insert(documents.values())
+            document.objects.insert(documents)
+
+
+def replace_documents(sync_cls, documents, collection=None):
+    """
+    Заменяет документы в коллекции одним bulk запросом, вставляя отсутствующие.
+    Документы ищутся по pk и по shard ключу, если он есть
+
+    :param collection: коллекция pymongo, если писать нужно не в коллекцию документа
+    """
+    if not documents:
+        return
+
+    document_cls = sync_cls._meta.document
+    key_db_fields = [get_pk_db_field(sync_cls)]
+    key_db_fields.extend(document_cls._db_field_map.get(name, name)
+                         for name in document_cls._meta.get('shard_key', ()) if '.' not in name)
+
+    if collection is None:
+        collection = document_cls._get_collection()
+    bulk = collection.initialize_unordered_bulk_op()
+    for document in documents:
+        mongo_document = document.to_mongo()
+        bulk.find({k: mongo_document.get(k) for k in key_db_fields}).upsert().replace_one(mongo_document)
+
+    logger.info('{}: bulk replace of {} documents'.format(sync_cls, len(documents)))
+    with measure_time():
+        bulk.execute()
+
+
+def get_pk_db_field(sync_cls):
+    return sync_cls._meta.document._fields[sync_cls._meta.pk_sfield.name].db_field
 
 
 def with_disabled_msync(f):
@@ -120,6 +170,15 @@ def disabled_msync():
     BatchTask.run = old_bt
 
 
+def close_old_connections():
+    """Закрывает устаревшие соединения django в потоках, которые живут дольше запроса"""
+    try:
+        from django.db import close_old_connections as close
+    except ImportError:
+        return
+    close()
+
+
 @contextmanager
 def measure_time():
     start = time.time()
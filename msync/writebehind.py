@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Отложенная запись в монгу из фонового потока того же процесса.
+
+Это третий режим обновления наряду с синхронным и через celery. Включается
+в Meta sync класса:
+    class FooSync(DocumentSync):
+        class Meta:
+            async = True
+            async_backend = 'thread'
+
+Функции с запросами складываются в ограниченную очередь, а фоновый поток
+забирает их, сливает в один BatchQuery на sync класс и базу django и
+выполняет, когда накопилось flush_size функций или прошло flush_interval
+секунд. При выходе из процесса очередь выполняется до конца. Если очередь
+переполнена, вызывающий поток ждет место в ней put_timeout секунд, потом
+ждет, пока фоновый поток допишет текущую порцию, и сам выполняет все, что
+накопилось у потока и в очереди, а свои функции после них, чтобы более старые
+записи не затерли новые.
+
+Функции не сериализуются, как в celery, поэтому ссылаются на те же инстансы
+моделек, что и обработчики сигналов.
+
+Настраивается через settings.MSYNC_WRITE_BEHIND = {'max_size': ..., 'flush_size': ...,
+'flush_interval': ..., 'put_timeout': ...}.
+"""
+from __future__ import unicode_literals
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from six.moves import queue
+from .utils import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriteBehindFlusher(object):
+
+    def __init__(self, max_size=10000, flush_size=500, flush_interval=1.0, put_timeout=5.0):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # функции, которые фоновый поток уже забрал из очереди, но еще не выполнил.
+        # Поток держит _flush_lock, пока забирает и выполняет их
+        self._pending = []
+        self._flush_lock = threading.RLock()
+
+    def put(self, sync_cls, tasks, using=None):
+        self._ensure_started()
+        for i, task in enumerate(tasks):
+            try:
+                self._queue.put((sync_cls, using, task), timeout=self.put_timeout)
+            except queue.Full:
+                logger.warning('%s: write-behind queue is full. Running tasks synchronously.' % sync_cls)
+                self.flush([(sync_cls, using, t) for t in tasks[i:]])
+                return
+
+    def flush(self, items=()):
+        """
+        Дожидается, пока фоновый поток выполнит текущую порцию, и выполняет все,
+        что осталось у него и в очереди, а затем items
+        """
+        with self._flush_lock:
+            pending = self._pending + self._drain() + list(items)
+            del self._pending[:]
+            self.run_tasks(pending)
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                items.append(item)
+        return items
+
+    def stop(self, timeout=None):
+        """Останавливает поток и выполняет оставшиеся в очереди функции"""
+        thread = self._thread
+        self._stop_event.set()
+        if thread is not None and thread.is_alive():
+            # будим поток, если он ждет новых функций. В полной очереди поток
+            # и так не ждет, поэтому _STOP можно не класть
+            try:
+                self._queue.put_nowait(_STOP)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.warning('write-behind thread is still running. Queue is not flushed.')
+                return
+        self.flush()
+
+    @staticmethod
+    def run_tasks(items):
+        from .batches import BatchQuery
+
+        tasks_by_sync_cls = OrderedDict()
+        for sync_cls, using, task in items:
+            tasks_by_sync_cls.setdefault((sync_cls, using), []).append(task)
+
+        for (sync_cls, using), tasks in tasks_by_sync_cls.items():
+            try:
+                with BatchQuery(sync_cls, using=using) as b:
+                    for task in tasks:
+                        task(b)
+            except Exception:
+                logger.exception('%s: write-behind flush failed' % sync_cls)
+
+    def _ensure_started(self):
+        # после fork'а поток родителя в дочернем процессе не существует
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name='msync-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        deadline = None
+        while not self._stop_event.is_set():
+            # функция забирается из очереди под блокировкой, чтобы flush не мог
+            # выполнить более новые функции раньше нее
+            with self._flush_lock:
+                if not self._pending:
+                    deadline = None
+                timeout = self.flush_interval if deadline is None else max(deadline - time.time(), 0)
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    break
+                elif item is not None:
+                    self._pending.append(item)
+                    if deadline is None:
+                        deadline = time.time() + self.flush_interval
+
+                if self._pending and (len(self._pending) >= self.flush_size or time.time() >= deadline):
+                    self.run_tasks(self._pending)
+                    del self._pending[:]
+                    close_old_connections()
+                    deadline = None
+
+        with self._flush_lock:
+            self.run_tasks(self._pending)
+            del self._pending[:]
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def get_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            from django.conf import settings
+            _flusher = WriteBehindFlusher(**getattr(settings, 'MSYNC_WRITE_BEHIND', {}))
+            atexit.register(_flusher.stop)
+    return _flusher
@@ -9,7 +9,7 @@ setup(
     author='readly',
     license='MIT',
     keywords='django orm mongo mongoengine sync',
-    packages=['msync'],
+    packages=find_packages(exclude=['tests']),
     install_requires=['django', 'mongoengine', 'celery'],
     classifiers=[
         'Development Status :: 3 - Alpha',
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+import pytest
+from pymongo.errors import OperationFailure
+from msync.arrayfilters import has_positional, to_array_filters, update_with_array_filters
+from msync.batches import BatchQuery
+from msync.queryset import QSUpdate
+from .utils import NP, DbSetup
+
+
+class TestToArrayFilters(object):
+    def test_multi_level_list(self):
+        update, array_filters = to_array_filters({'bs.cs.id': 4}, {'$set': {'bs.$.cs.$.n': 'x', 'bs.$.cs.$.m': 1}})
+        assert update == {'$set': {'bs.$[e0].cs.$[e1].n': 'x', 'bs.$[e0].cs.$[e1].m': 1}}
+        assert array_filters == [{'e0.cs.id': 4}, {'e1.id': 4}]
+
+    def test_pull_from_inner_list(self):
+        update, array_filters = to_array_filters({'bs.cs.id': {'$in': [4, 8]}},
+                                                 {'$pull': {'bs.$.cs': {'id': {'$in': [4, 8]}}}})
+        assert update == {'$pull': {'bs.$[e0].cs': {'id': {'$in': [4, 8]}}}}
+        assert array_filters == [{'e0.cs.id': {'$in': [4, 8]}}]
+
+    def test_unconstrained_list_updates_all_elements(self):
+        update, array_filters = to_array_filters({'id': 4}, {'$set': {'bs.$.n': 'x'}})
+        assert update == {'$set': {'bs.$[].n': 'x'}}
+        assert array_filters == []
+
+    def test_has_positional(self):
+        assert has_positional({'$set': {'bs.$.n': 'x'}})
+        assert not has_positional({'$set': {'bs': []}})
+
+
+class TestUpdateWithArrayFilters(DbSetup):
+    def test_update_command(self):
+        document = self.sync_cls._meta.document
+        with patch.object(document, '_get_collection') as collection_mock:
+            collection_mock.return_value.name = 'foos'
+            command_mock = collection_mock.return_value.database.command
+            command_mock.return_value = {'ok': 1, 'n': 2}
+            assert update_with_array_filters(document, {'m2m_field.id': 4}, {'$set': {'m2m_field.$[e0].s': 1}},
+                                             [{'e0.id': 4}]) == 2
+
+        command = command_mock.call_args[0][0]
+        assert list(command.keys()) == ['update', 'updates']
+        assert command['updates'] == [{'q': {'m2m_field.id': 4}, 'u': {'$set': {'m2m_field.$[e0].s': 1}},
+                                       'multi': True, 'upsert': False, 'arrayFilters': [{'e0.id': 4}]}]
+
+    def test_write_errors_are_raised(self):
+        document = self.sync_cls._meta.document
+        with patch.object(document, '_get_collection') as collection_mock:
+            collection_mock.return_value.database.command.return_value = {
+                'ok': 1, 'n': 0, 'writeErrors': [{'code': 2, 'errmsg': 'No array filter found'}]}
+            with pytest.raises(OperationFailure):
+                update_with_array_filters(document, {}, {'$set': {'a.$[e0]': 1}}, [])
+
+    def test_batch_query_uses_array_filters(self):
+        self.sync_cls._meta.array_filters = True
+        ins = NP(self.bar, id=15, str_field='foo')
+        document = self.bar_sync.create_document(ins)
+        with patch('msync.batches.update_with_array_filters', return_value=1) as update_mock:
+            with BatchQuery(self.sync_cls) as b:
+                b[(ins, self.sync_cls.m2m_field)] = QSUpdate(sync_cls=self.sync_cls, document=document,
+                                                            sfield=self.sync_cls.m2m_field, fields={'str_field'})
+
+        query, update, array_filters = update_mock.call_args[0][1:]
+        assert query == {'m2m_field.id': 15}
+        assert update == {'$set': {'m2m_field.$[e0].str_field': 'foo'}}
+        assert array_filters == [{'e0.id': 15}]
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
-from mock import Mock, call
-from msync.queryset import QSPk, QSUpdateDependentField, QSUpdate, QSUpdateParent
-from msync.batches import BatchQuery
+from mock import Mock, call, patch
+import pytest
+from mongoengine.errors import NotUniqueError
+from msync.queryset import QSPk, QSUpdateDependentField, QSUpdate, QSUpdateParent, QSCreate, QSDeleteIn
+from msync.batches import BatchQuery, BatchScope, BatchTask
 from .utils import NP, DbSetup
 
 
 class TestBatchQuery(DbSetup):
     def setup(self):
         super(TestBatchQuery, self).setup()
-        self.sync_cls._meta.document = Mock()
-        self.filter_mock = self.sync_cls._meta.document.objects.filter
+        self.document = self.sync_cls._meta.document
+        self.patcher = patch.object(self.document, 'objects')
+        self.filter_mock = self.patcher.start().filter
         self.batch = BatchQuery(self.sync_cls)
 
+    def teardown(self):
+        self.patcher.stop()
+
     def test_saving_dependent_fields_of_same_parent(self):
         pi = NP(self.model, id=4)
         ins = NP(self.bar)
@@ -86,8 +92,159 @@ class TestBatchQuery(DbSetup):
         pk = QSPk(sync_cls=self.sync_cls, instance=ins)
         assert len(self.batch._qs_collection) == 1 and len(self.batch._qs_collection[pk]) == 2
 
+    def test_upsert_parent_update(self):
+        self.sync_cls._meta.upsert = True
+        pi = NP(self.model, id=42, int_field=4)
+        pi_document = self.sync_cls.create_document(pi)
+        self.batch[pi] = QSUpdateParent(sync_cls=self.sync_cls, document=pi_document, fields={'int_field'})
+
+        self.sync_cls.create_document = Mock(return_value=pi_document)
+        self.filter_mock.return_value.update.side_effect = [0, 1]
+        self.batch.run()
+
+        first_kwargs, update_kwargs = [c[1] for c in self.filter_mock.return_value.update.call_args_list]
+        assert first_kwargs['upsert'] is False and '$setOnInsert' not in first_kwargs['__raw__']
+        assert update_kwargs['upsert'] is True
+        assert update_kwargs['__raw__']['$set'] == {'int_field': 4}
+        insert_values = update_kwargs['__raw__']['$setOnInsert']
+        assert 'int_field' not in insert_values and '_id' not in insert_values
+
+    def test_upsert_document_is_built_only_for_missing(self):
+        self.sync_cls._meta.upsert = True
+        pi = NP(self.model, id=42, int_field=4)
+        self.batch[pi] = QSUpdateParent(sync_cls=self.sync_cls, document=self.sync_cls.create_document(pi),
+                                        fields={'int_field'})
+
+        self.sync_cls.create_document = Mock()
+        self.filter_mock.return_value.update.return_value = 1
+        self.batch.run()
+
+        assert not self.sync_cls.create_document.called
+        self.filter_mock.return_value.update.assert_called_once_with(upsert=False, __raw__={'$set': {'int_field': 4}})
+
+    def test_empty_set_on_insert_is_omitted(self):
+        self.sync_cls._meta.upsert = True
+        pi = NP(self.model, id=42, int_field=4)
+        self.batch[pi] = QSUpdateParent(sync_cls=self.sync_cls, document=self.sync_cls.create_document(pi),
+                                        fields={'int_field'})
+
+        self.sync_cls.create_document = Mock(**{'return_value.to_mongo.return_value': {'_id': 42, 'int_field': 4}})
+        self.filter_mock.return_value.update.side_effect = [0, 1]
+        self.batch.run()
+
+        self.filter_mock.return_value.update.assert_called_with(upsert=True, __raw__={'$set': {'int_field': 4}})
+
+    def test_insert_values_exclude_exact_filter_paths(self):
+        pi = NP(self.model, id=42)
+        document = Mock(**{'to_mongo.return_value': {'_id': 42, 'int_field': 4,
+                                                     'emb_field': {'id': 7, 'str_field': 'egg'}}})
+        self.sync_cls.create_document = Mock(return_value=document)
+
+        insert_values = self.batch.get_insert_values(pi, {'id': 42, 'emb_field__id': 7}, {'$set': {'int_field': 4}})
+        assert insert_values == {'emb_field.str_field': 'egg'}
+
+    def test_no_upsert_for_push(self):
+        pi = NP(self.model, id=42)
+        ins_document = self.bar_sync.create_document(NP(self.bar, id=15))
+        self.sync_cls._meta.upsert = True
+        self.batch[pi] = QSCreate(sync_cls=self.sync_cls, document=ins_document, sfield=self.sync_cls.m2m_field)
+
+        self.filter_mock.return_value.update.return_value = 1
+        self.batch.run()
+
+        update_kwargs = self.filter_mock.return_value.update.call_args[1]
+        assert update_kwargs['upsert'] is False and '$setOnInsert' not in update_kwargs['__raw__']
+
+    def test_conflicting_updates_are_split(self):
+        pi = NP(self.model, id=42)
+        ins_document = self.bar_sync.create_document(NP(self.bar, id=15))
+        self.batch[pi] = QSCreate(sync_cls=self.sync_cls, document=ins_document, sfield=self.sync_cls.m2m_field)
+        self.batch[pi] = QSDeleteIn(sync_cls=self.sync_cls, sfield=self.sync_cls.m2m_field, pks=[16])
+
+        self.filter_mock.return_value.update.return_value = 1
+        self.batch.run()
+
+        updates = [c[1]['__raw__'] for c in self.filter_mock.return_value.update.call_args_list]
+        assert updates == [{'$push': {'m2m_field': ins_document.to_mongo()}},
+                           {'$pull': {'m2m_field': {'id': 16}}}]
+
+    def test_nested_removals_are_coalesced(self):
+        with BatchQuery(self.sync_cls) as b:
+            b.delete(NP(self.bar, id=15), sfield=self.sync_cls.m2m_field)
+            b.delete(NP(self.bar, id=16), sfield=self.sync_cls.m2m_field)
+
+        self.filter_mock.assert_called_once_with(m2m_field__id__in=[15, 16])
+        self.filter_mock.return_value.update.assert_called_once_with(
+            upsert=False, __raw__={'$pull': {'m2m_field': {'id': {'$in': [15, 16]}}}})
+
+    def test_nested_removals_with_shard_key(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        self.sync_cls._meta.nested_shard_key_getter = lambda sfield, ins: {'int_field': ins.id % 2}
+        with BatchQuery(self.sync_cls) as b:
+            b.delete(NP(self.bar, id=15), sfield=self.sync_cls.m2m_field)
+            b.delete(NP(self.bar, id=16), sfield=self.sync_cls.m2m_field)
+
+        self.filter_mock.assert_called_once_with(m2m_field__id__in=[15, 16], int_field__in=[1, 0])
+
+    def test_nested_removals_need_shard_key_getter(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        with pytest.raises(TypeError):
+            with BatchQuery(self.sync_cls) as b:
+                b.delete(NP(self.bar, id=15), sfield=self.sync_cls.m2m_field)
+        assert not self.filter_mock.called
+
+    def test_nested_emb_removals_are_unset(self):
+        with BatchQuery(self.sync_cls) as b:
+            b.delete(NP(self.bar, id=15), sfield=self.sync_cls.emb_field)
+
+        self.filter_mock.assert_called_once_with(emb_field__id__in=[15])
+        self.filter_mock.return_value.update.assert_called_once_with(
+            upsert=False, __raw__={'$unset': {'emb_field': 1}})
+
+    def test_after_run_callbacks(self):
+        callback = Mock()
+        with BatchQuery(self.sync_cls) as b:
+            b.after_run(callback)
+            assert not callback.called
+        callback.assert_called_once_with()
+
+        callback.reset_mock()
+        self.filter_mock.return_value.delete.side_effect = RuntimeError()
+        with pytest.raises(RuntimeError):
+            with BatchQuery(self.sync_cls) as b:
+                b.delete(NP(self.model, id=4))
+                b.after_run(callback)
+        assert not callback.called
+
+    def test_delete_and_create_in_scope_keeps_document(self):
+        document = self.sync_cls.create_document(NP(self.model, id=4))
+        with BatchScope():
+            with BatchQuery(self.sync_cls) as b:
+                b[NP(self.model, id=4)] = QSUpdateParent(sync_cls=self.sync_cls, document=document)
+                b.delete(NP(self.model, id=4))
+                b.delete(NP(self.model, id=8))
+            with BatchQuery(self.sync_cls) as b:
+                b.insert(document)
+
+        self.document.objects.insert.assert_called_once_with([document], load_bulk=False)
+        self.filter_mock.assert_called_once_with(id__in=[8])
+        assert not self.filter_mock.return_value.update.called
+
+    def test_nested_remove_and_create_keeps_object(self):
+        parent = NP(self.model, id=4)
+        document = self.bar_sync.create_document(NP(self.bar, id=15))
+        with BatchQuery(self.sync_cls) as b:
+            b.delete(NP(self.bar, id=15), sfield=self.sync_cls.m2m_field)
+            b[parent] = QSCreate(sync_cls=self.sync_cls, document=document, sfield=self.sync_cls.m2m_field)
+
+        self.filter_mock.assert_called_once_with(id=4)
+        self.filter_mock.return_value.update.assert_called_once_with(
+            upsert=False, __raw__={'$push': {'m2m_field': document.to_mongo()}})
+
     def _mock_update_number(self, count):
-        self.batch._sync_cls = Mock(**{'_meta.model': self.sync_cls._meta.model})
+        self.batch._sync_cls = Mock(**{'_meta.model': self.sync_cls._meta.model, '_meta.upsert': False,
+                                       '_meta.shadow_rebuild': False, '_meta.array_filters': False,
+                                       '_meta.document': self.document})
         update_mock = self._get_update_mock()
         update_mock.return_value = count
         return update_mock
@@ -97,3 +254,96 @@ class TestBatchQuery(DbSetup):
 
     def _get_update_mock(self):
         return self._get_filter_mock().return_value.update
+
+
+class TestBatchQueryInsertsAndDeletes(DbSetup):
+    def setup(self):
+        super(TestBatchQueryInsertsAndDeletes, self).setup()
+        self.sync_cls._meta.document = Mock()
+        self.filter_mock = self.sync_cls._meta.document.objects.filter
+
+    def test_inserts_are_coalesced(self):
+        documents = [Mock(), Mock()]
+        with BatchQuery(self.sync_cls) as b:
+            for document in documents:
+                b.insert(document)
+
+        self.sync_cls._meta.document.objects.insert.assert_called_once_with(documents, load_bulk=False)
+
+    def test_insert_falls_back_to_upsert(self):
+        documents = [Mock()]
+        self.sync_cls._meta.document.objects.insert.side_effect = NotUniqueError()
+        with patch('msync.batches.replace_documents') as replace_mock:
+            with BatchQuery(self.sync_cls) as b:
+                b.insert(documents[0])
+        replace_mock.assert_called_once_with(self.sync_cls, documents)
+
+    def test_parent_deletes_are_coalesced(self):
+        with BatchQuery(self.sync_cls) as b:
+            b.delete(NP(self.model, id=4))
+            b.delete(NP(self.model, id=8))
+
+        self.filter_mock.assert_called_once_with(id__in=[4, 8])
+        self.filter_mock.return_value.delete.assert_called_once_with()
+
+    def test_parent_deletes_with_shard_key(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        with BatchQuery(self.sync_cls) as b:
+            for i, int_value in ((4, 1), (8, 2), (15, 1)):
+                b.delete(NP(self.model, id=i, int_field=int_value))
+
+        self.filter_mock.assert_called_once_with(id__in=[4, 8, 15], int_field__in=[1, 2])
+
+    def test_scope_runs_batches_once(self):
+        with BatchScope():
+            for i in (4, 8, 15):
+                with BatchQuery(self.sync_cls) as b:
+                    b.delete(NP(self.model, id=i))
+            assert not self.filter_mock.called
+
+        self.filter_mock.assert_called_once_with(id__in=[4, 8, 15])
+
+    def test_nested_scopes(self):
+        with BatchScope():
+            with BatchScope():
+                with BatchQuery(self.sync_cls) as b:
+                    b.delete(NP(self.model, id=4))
+            assert not self.filter_mock.called
+        self.filter_mock.assert_called_once_with(id__in=[4])
+
+
+class TestBatchTask(DbSetup):
+    def setup(self):
+        super(TestBatchTask, self).setup()
+        patcher = patch('msync.batches.sync_task')
+        self.task_mock = patcher.start()
+        self.patcher = patcher
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def test_tasks_are_chunked(self):
+        self.sync_cls._meta.task_chunk_size = 2
+        with BatchTask(self.sync_cls) as t:
+            for i in range(5):
+                t.add(i)
+
+        calls = self.task_mock.apply_async.call_args_list
+        assert [c[1]['args'][1] for c in calls] == [[0, 1], [2, 3], [4]]
+
+    def test_routing(self):
+        self.sync_cls._meta.queue = 'foos'
+        self.sync_cls._meta.priority = 8
+        with BatchTask(self.sync_cls) as t:
+            t.add(4)
+
+        self.task_mock.apply_async.assert_called_once_with(args=(self.sync_cls, [4]), queue='foos', priority=8)
+
+    def test_scope_aggregates_tasks(self):
+        with BatchScope():
+            for i in range(3):
+                with BatchTask(self.sync_cls) as t:
+                    t.add(i)
+            assert not self.task_mock.apply_async.called
+
+        self.task_mock.apply_async.assert_called_once_with(args=(self.sync_cls, [0, 1, 2]))
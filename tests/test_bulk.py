@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from django.db.models import Count
+from mock import MagicMock, Mock, patch
+import pytest
+from msync import fields as sfields
+from msync.bulk import (replace_documents, get_parent_nested_sfields, get_parent_pks, update_parents,
+                        backfill_instances, adaptive_bulk_insert)
+from msync.sizing import AdaptiveBatchSizer
+from msync.syncers import DocumentSync
+from .utils import NP, DbSetup
+
+
+class TestResync(DbSetup):
+    def test_replace_documents(self):
+        documents = [self.sync_cls.create_document(NP(self.model, id=i)) for i in (4, 8)]
+        with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+            replace_documents(self.sync_cls, documents)
+
+        bulk = collection_mock.return_value.initialize_unordered_bulk_op.return_value
+        assert [c[0][0] for c in bulk.find.call_args_list] == [{'id': 4}, {'id': 8}]
+        assert bulk.find.return_value.upsert.return_value.replace_one.call_count == 2
+        bulk.execute.assert_called_once_with()
+
+    def test_replace_no_documents(self):
+        with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+            replace_documents(self.sync_cls, [])
+        assert not collection_mock.called
+
+    def test_parent_nested_sfields(self):
+        assert (self.sync_cls, self.sync_cls.m2m_field) in get_parent_nested_sfields(self.bar)
+        assert (self.sync_cls, self.sync_cls.emb_field) not in get_parent_nested_sfields(self.bar)
+
+    def test_update_parents(self):
+        ins = NP(self.bar, id=15)
+        with patch('msync.bulk.get_parent_pks', return_value={ins: set()}), \
+                patch.object(self.sync_cls._meta.document, 'objects') as objects_mock:
+            with patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+                update_parents(self.bar, [ins])
+
+        objects_mock.filter.assert_called_once_with(m2m_field__id=15)
+        update = objects_mock.filter.return_value.update.call_args[1]['__raw__']
+        assert set(update['$set']) == {'m2m_field.$.id', 'm2m_field.$.str_field'}
+
+    def test_parents_of_dependent_fields_are_resynced(self):
+        ins = NP(self.bar, id=15)
+        parent_pks = {self.sync_cls.dep_field: {4}, self.sync_cls.dep_field2: {8}, self.sync_cls.m2m_field: {8}}
+        with patch('msync.bulk.get_parent_pks', side_effect=lambda sf, model, instances: {ins: parent_pks[sf]}), \
+                patch('msync.bulk.resync') as resync_mock, \
+                patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+            update_parents(self.bar, [ins], using='tenant')
+
+        resync_mock.assert_called_once_with(self.sync_cls, {4, 8}, propagate=False, using='tenant')
+
+    def test_reverse_lookup(self):
+        assert self.sync_cls.m2m_field.get_reverse_lookup(self.bar) == 'foo'
+        assert self.sync_cls.fk_field.get_reverse_lookup(self.qux) is None
+        assert self.sync_cls.emb_field.get_reverse_lookup(self.egg) is None
+
+    def test_parent_pks_are_found_with_one_query(self):
+        instances = [NP(self.bar, id=15), NP(self.bar, id=16), NP(self.bar, id=23)]
+        with patch.object(self.bar, '_default_manager') as manager_mock:
+            qs = manager_mock.db_manager.return_value.filter.return_value.order_by.return_value
+            qs.values_list.return_value = [(15, 4), (15, 8), (16, 4), (23, None)]
+            parent_pks = get_parent_pks(self.sync_cls.m2m_field, self.bar, instances)
+
+        assert parent_pks == {instances[0]: {4, 8}, instances[1]: {4}, instances[2]: set()}
+        manager_mock.db_manager.return_value.filter.assert_called_once_with(pk__in=[15, 16, 23])
+        qs.values_list.assert_called_once_with('pk', 'foo')
+
+    def test_new_child_is_added_to_parent(self):
+        parent, child = NP(self.model, id=4), NP(self.bar, id=15)
+        sources = {self.sync_cls.m2m_field: [child], self.sync_cls.fk_field: [],
+                   self.sync_cls.emb_field: NP(self.egg, id=23), self.sync_cls.dep_field: 10,
+                   self.sync_cls.dep_field2: 'bar'}
+        patchers = [patch.object(sf, 'get_bulk_source', return_value=lambda _, value=value: {parent: value})
+                    for sf, value in sources.items()]
+        for patcher in patchers:
+            patcher.start()
+        try:
+            with patch('msync.bulk.get_parent_pks', return_value={child: {4}}), \
+                    patch.object(self.model, 'objects') as objects_mock, \
+                    patch('msync.bulk.replace_documents') as replace_mock, \
+                    patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+                objects_mock.db_manager.return_value.filter.return_value.order_by.return_value = [parent]
+                update_parents(self.bar, [child])
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+
+        objects_mock.db_manager.return_value.filter.assert_called_once_with(pk__in={4})
+        documents = list(replace_mock.call_args[0][1])
+        assert [d.id for d in documents] == [4]
+        assert [d.id for d in documents[0].m2m_field] == [15]
+
+
+class TestBackfill(DbSetup):
+    def test_backfill_document_field(self):
+        instances = [NP(self.model, id=4, int_field=15), NP(self.model, id=8, int_field=16)]
+        with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+            with patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+                backfill_instances(self.sync_cls.int_field, instances)
+
+        bulk = collection_mock.return_value.initialize_unordered_bulk_op.return_value
+        assert [c[0][0] for c in bulk.find.call_args_list] == [{'id': 4}, {'id': 8}]
+        assert [c[0][0] for c in bulk.find.return_value.update_one.call_args_list] == [
+            {'$set': {'int_field': 15}}, {'$set': {'int_field': 16}}]
+        bulk.execute.assert_called_once_with()
+
+    def test_backfill_embedded_field(self):
+        instances = [NP(self.bar, id=4, str_field='foo')]
+        with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+            with patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+                backfill_instances(self.bar_sync.str_field, instances)
+
+        bulk = collection_mock.return_value.initialize_unordered_bulk_op.return_value
+        bulk.find.assert_called_once_with({'m2m_field.id': 4})
+        bulk.find.return_value.update.assert_called_once_with({'$set': {'m2m_field.$.str_field': 'foo'}})
+
+    def test_backfill_embedded_field_with_array_filters(self):
+        self.sync_cls._meta.array_filters = True
+        instances = [NP(self.bar, id=4, str_field='foo'), NP(self.bar, id=8, str_field='bar')]
+        with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+            with patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+                collection_mock.return_value.database.command.return_value = {'n': 2}
+                backfill_instances(self.bar_sync.str_field, instances)
+
+        command = collection_mock.return_value.database.command.call_args[0][0]
+        assert [s['u'] for s in command['updates']] == [{'$set': {'m2m_field.$[e0].str_field': 'foo'}},
+                                                         {'$set': {'m2m_field.$[e0].str_field': 'bar'}}]
+        assert command['updates'][1]['arrayFilters'] == [{'e0.id': 8}]
+        assert command['updates'][1]['multi'] is True
+        assert not collection_mock.return_value.initialize_unordered_bulk_op.return_value.execute.called
+
+
+class TestAggregateField(DbSetup):
+    def setup(self):
+        super(TestAggregateField, self).setup()
+
+        class FooCountSync(DocumentSync):
+            qux_count = sfields.AggregateField('count', 'qux', depends_on=self.qux, reverse_rel='fk_field')
+            max_qux = sfields.AggregateField('max', 'qux__str_field', filter={'qux__str_field__gt': ''},
+                                             depends_on=self.qux, reverse_rel='fk_field')
+
+            class Meta:
+                model = self.foo
+                collection = 'foo_counts'
+                fields = ('id', 'qux_count', 'max_qux')
+
+        self.count_sync = FooCountSync
+
+    def test_page_is_aggregated_with_one_query(self):
+        instances = [NP(self.foo, id=4), NP(self.foo, id=8)]
+        for instance in instances:
+            instance._state.db = 'tenant'
+        with patch.object(self.foo, 'objects') as objects_mock:
+            manager = objects_mock.db_manager.return_value
+            qs = manager.filter.return_value.order_by.return_value
+            qs.annotate.return_value.values_list.return_value = [(4, 2)]
+            values = self.count_sync.qux_count.values_from_source(instances)
+
+        assert values == {instances[0]: 2, instances[1]: 0}
+        objects_mock.db_manager.assert_called_once_with('tenant')
+        manager.filter.assert_called_once_with(pk__in=[4, 8])
+        aggregate = qs.annotate.call_args[1]['msync_aggregate']
+        assert isinstance(aggregate, Count) and aggregate.lookup == 'qux'
+
+    def test_filter_and_default(self):
+        instance = NP(self.foo, id=4)
+        with patch.object(self.foo, 'objects') as objects_mock:
+            manager = objects_mock.db_manager.return_value
+            qs = manager.filter.return_value.filter.return_value.order_by.return_value
+            qs.annotate.return_value.values_list.return_value = []
+            assert self.count_sync.max_qux.value_from_source(instance) is None
+
+        manager.filter.return_value.filter.assert_called_once_with(qux__str_field__gt='')
+
+    def test_unknown_aggregate(self):
+        with pytest.raises(TypeError):
+            sfields.AggregateField('median', 'qux')
+
+
+class TestAdaptiveBulkInsert(DbSetup):
+    def test_pages_follow_sizer(self):
+        pages = [[NP(self.model, id=i) for i in (4, 8)], [NP(self.model, id=15)], []]
+        queryset = MagicMock()
+        queryset.__getitem__.side_effect = lambda s: pages.pop(0)
+        queryset.filter.return_value = queryset
+
+        sizer = AdaptiveBatchSizer(page_size=2, max_message_bytes=1)
+        documents = lambda instances: {ins: Mock(**{'to_mongo.return_value': {'_id': ins.pk}}) for ins in instances}
+        with patch.object(self.model, 'objects') as objects_mock:
+            objects_mock.db_manager.return_value.order_by.return_value = queryset
+            with patch.object(self.sync_cls, 'bulk_create_documents', side_effect=documents):
+                with patch.object(self.sync_cls._meta.document, '_get_collection') as collection_mock:
+                    assert adaptive_bulk_insert(self.sync_cls, sizer) == 3
+
+        assert queryset.filter.call_args_list[-1][1] == {'pk__gt': 15}
+        assert queryset.__getitem__.call_args_list[0][0][0] == slice(None, 2)
+        # max_message_bytes меньше документа, поэтому insert на каждый документ
+        assert [len(c[0][0]) for c in collection_mock.return_value.insert.call_args_list] == [1, 1, 1]
+        assert sizer.last_stats.count == 1
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from mock import MagicMock, patch
+import pytest
+from msync.fingerprints import MongoFingerprintStore, get_fingerprint, get_fingerprint_store, memory_store
+from msync.bulk import update_parents
+from msync.signals import save_nested_sfield, delete_nested_sfield
+from .utils import NP, DbSetup
+
+
+class TestFingerprints(DbSetup):
+    def setup(self):
+        super(TestFingerprints, self).setup()
+        memory_store.clear()
+        self.bar_sync._meta.fingerprints = 'memory'
+
+    def _save(self, instance, created=False, using=None, succeeded=True):
+        batch = MagicMock()
+        with patch.object(self.sync_cls.m2m_field, 'get_reverse_rel', return_value=lambda i: []):
+            save_nested_sfield(batch, parent_sync_cls=self.sync_cls, sfield=self.sync_cls.m2m_field,
+                               instance=instance, created=created, using=using)
+        if succeeded:
+            for c in batch.after_run.call_args_list:
+                c[0][0]()
+        return batch.__setitem__.called
+
+    def test_fingerprint_depends_on_simple_fields(self):
+        doc1 = self.bar_sync.create_document(NP(self.bar, id=4, str_field='a'))
+        doc2 = self.bar_sync.create_document(NP(self.bar, id=4, str_field='b'))
+        assert get_fingerprint(self.bar_sync, doc1) != get_fingerprint(self.bar_sync, doc2)
+        assert get_fingerprint(self.bar_sync, doc1) == get_fingerprint(self.bar_sync, doc1)
+
+    def test_unchanged_fragment_is_not_fanned_out(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        assert self._save(instance)
+        assert not self._save(instance)
+
+        instance.str_field = 'b'
+        assert self._save(instance)
+
+    def test_failed_update_is_not_remembered(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        assert self._save(instance, succeeded=False)
+        assert self._save(instance)
+        assert not self._save(instance)
+
+    def test_resync_forgets_fragments(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        self._save(instance)
+        parent = NP(self.model, id=8)
+        with patch('msync.bulk.get_parent_pks', return_value={instance: {parent.pk}}), \
+                patch('msync.bulk.resync') as resync_mock, \
+                patch('msync.bulk.get_document_sync_classes', return_value=[self.sync_cls]):
+            update_parents(self.bar, [instance])
+        resync_mock.assert_called_once_with(self.sync_cls, {8}, propagate=False, using=None)
+        assert self._save(instance)
+
+    def test_created_fragment_is_remembered(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        self._save(instance, created=True)
+        assert not self._save(instance)
+
+    def test_deleted_fragment_is_forgotten(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        self._save(instance)
+        delete_nested_sfield(MagicMock(), parent_sync_cls=self.sync_cls, sfield=self.sync_cls.m2m_field,
+                             instance=instance)
+        assert self._save(instance)
+
+    def test_databases_are_fingerprinted_separately(self):
+        instance = NP(self.bar, id=4, str_field='a')
+        assert self._save(instance, using='tenant1')
+        assert self._save(instance, using='tenant2')
+        assert not self._save(instance, using='tenant1')
+
+    def test_disabled_by_default(self):
+        self.bar_sync._meta.fingerprints = None
+        instance = NP(self.bar, id=4, str_field='a')
+        assert self._save(instance)
+        assert self._save(instance)
+
+    def test_mongo_store(self):
+        self.bar_sync._meta.fingerprints = 'mongo'
+        with patch.object(self.sync_cls._meta.document, '_get_db', MagicMock()):
+            store = get_fingerprint_store(self.sync_cls, self.sync_cls.m2m_field)
+        assert isinstance(store, MongoFingerprintStore)
+
+        store.collection = MagicMock()
+        store.collection.find_one.return_value = {'_id': 'key', 'fp': b'old'}
+        assert store.get('key') == b'old'
+        store.set('key', b'new')
+        assert store.collection.update.call_args[0][0] == {'_id': 'key'}
+        store.discard('key1', 'key2')
+        store.collection.remove.assert_called_once_with({'_id': {'$in': ['key1', 'key2']}})
+
+    def test_mongo_store_is_routed(self):
+        self.bar_sync._meta.fingerprints = 'mongo'
+        self.sync_cls._meta.db_aliases = {'tenant': 'mongo_tenant'}
+        with patch('msync.fingerprints.get_db') as get_db_mock:
+            get_fingerprint_store(self.sync_cls, self.sync_cls.m2m_field, using='tenant')
+        get_db_mock.assert_called_once_with('mongo_tenant')
+
+    def test_unknown_store(self):
+        self.bar_sync._meta.fingerprints = 'redis'
+        with pytest.raises(TypeError):
+            get_fingerprint_store(self.sync_cls, self.sync_cls.m2m_field)
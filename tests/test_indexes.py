@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import pytest
+from mock import Mock
+from msync.factories import DocumentSchemeFactory
+from msync.indexes import get_sample_filters, is_collscan, assert_no_collscan
+from .utils import DbSetup
+
+
+class TestIndexes(DbSetup):
+    def test_auto_indexes(self):
+        assert self.sync_cls._meta.get_auto_indexes() == ['emb_field.id', 'fk_field.id', 'm2m_field.id']
+
+    def test_auto_indexes_with_pk_not_in_id(self):
+        self.sync_cls._meta.collection_settings['id_field'] = 'int_field'
+        assert self.sync_cls._meta.get_auto_indexes() == ['emb_field.id', 'fk_field.id', 'id', 'm2m_field.id']
+
+    def test_document_indexes_are_disabled_by_default(self):
+        assert not self.sync_cls._meta.document._meta.get('indexes')
+
+    def test_document_indexes_are_built_in_background(self):
+        self.sync_cls._meta.auto_indexes = True
+        factory = DocumentSchemeFactory('FooDocument', self.sync_cls._meta)
+        assert factory.get_indexes(['fk_field.id']) == ['fk_field.id',
+                                                         {'fields': ['emb_field.id'], 'background': True},
+                                                         {'fields': ['m2m_field.id'], 'background': True}]
+
+    def test_sample_filters(self):
+        filters = get_sample_filters(self.sync_cls, pk=4)
+        assert sorted(filters) == sorted([{'id': 4}, {'m2m_field__id': 4}, {'fk_field__id': 4},
+                                          {'emb_field__id': 4}])
+
+    def test_is_collscan(self):
+        assert is_collscan({'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                                                             'inputStage': {'stage': 'COLLSCAN'}}}})
+        assert is_collscan({'cursor': 'BasicCursor'})
+        assert not is_collscan({'queryPlanner': {'winningPlan': {'stage': 'FETCH',
+                                                                 'inputStage': {'stage': 'IXSCAN'}}}})
+
+    def test_assert_no_collscan(self):
+        self.sync_cls._meta.document = Mock()
+        explain_mock = self.sync_cls._meta.document.objects.filter.return_value.explain
+        explain_mock.return_value = {'cursor': 'BtreeCursor id_1'}
+        assert_no_collscan(self.sync_cls)
+
+        explain_mock.return_value = {'cursor': 'BasicCursor'}
+        with pytest.raises(AssertionError):
+            assert_no_collscan(self.sync_cls)
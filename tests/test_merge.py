@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from msync.merge import merge_updates, get_mongo_path, RawUpdate
+from .utils import NP, DbSetup
+
+
+class TestMergeUpdates(DbSetup):
+    def setup(self):
+        super(TestMergeUpdates, self).setup()
+        self.document = self.sync_cls._meta.document
+        self.bar_docs = [self.bar_sync.create_document(NP(self.bar, id=i)) for i in (4, 8, 15)]
+
+    def _merge(self, *paths):
+        return merge_updates(self.document, list(paths))
+
+    def test_sets(self):
+        updates = self._merge({'set__int_field': 4}, {'set__dep_field': 8}, {'set__int_field': 15})
+        assert updates == [{'$set': {'int_field': 15, 'dep_field': 8}}]
+
+    def test_pushes_are_folded(self):
+        d1, d2, d3 = self.bar_docs
+        updates = self._merge({'push__m2m_field': d1}, {'push_all__m2m_field': [d2, d3]})
+        assert updates == [{'$push': {'m2m_field': {'$each': [d1.to_mongo(), d2.to_mongo(), d3.to_mongo()]}}}]
+
+    def test_push_modifiers(self):
+        d1, d2, _ = self.bar_docs
+        updates = merge_updates(self.document, [{'push__m2m_field': d1}, {'push__m2m_field': d2}],
+                                {'m2m_field': {'$slice': -10}})
+        assert updates == [{'$push': {'m2m_field': {'$each': [d1.to_mongo(), d2.to_mongo()], '$slice': -10}}}]
+
+    def test_pulls_are_folded(self):
+        updates = self._merge({'pull__m2m_field__id': 4}, {'pull__m2m_field': {'id': {'$in': [8, 15]}}})
+        assert updates == [{'$pull': {'m2m_field': {'id': {'$in': [4, 8, 15]}}}}]
+
+    def test_raw_pulls_are_folded(self):
+        raw = RawUpdate({'$pull': {'m2m_field': {'id': {'$in': [8, 15]}}}})
+        updates = self._merge({'pull__m2m_field__id': 4}, raw, {'set__int_field': 16})
+        assert updates == [{'$pull': {'m2m_field': {'id': {'$in': [4, 8, 15]}}}, '$set': {'int_field': 16}}]
+
+    def test_push_and_pull_are_split(self):
+        d1 = self.bar_docs[0]
+        updates = self._merge({'push__m2m_field': d1}, {'set__int_field': 4}, {'pull__m2m_field__id': 8})
+        assert updates == [{'$push': {'m2m_field': d1.to_mongo()}, '$set': {'int_field': 4}},
+                           {'$pull': {'m2m_field': {'id': 8}}}]
+
+    def test_order_is_kept_after_conflict(self):
+        d1, d2, _ = self.bar_docs
+        updates = self._merge({'push__m2m_field': d1}, {'set__m2m_field': []}, {'push__m2m_field': d2})
+        assert updates == [{'$push': {'m2m_field': d1.to_mongo()}},
+                           {'$set': {'m2m_field': []}},
+                           {'$push': {'m2m_field': d2.to_mongo()}}]
+
+    def test_unset_and_set(self):
+        updates = self._merge({'unset__emb_field': None}, {'set__emb_field__id': 4})
+        assert updates == [{'$unset': {'emb_field': 1}}, {'$set': {'emb_field.id': 4}}]
+
+
+class TestGetMongoPath(DbSetup):
+    def test_positional_path(self):
+        assert get_mongo_path(self.sync_cls._meta.document, 'm2m_field__S__id') == 'm2m_field.$.id'
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from django.db import connection
+from mock import patch
+import pytest
+from msync.profiling import HandlerProfiler, QueryCounter, NULL_SAMPLE, max_handler_queries
+from msync.signals import SignalConnector
+from .utils import NP, DbSetup
+
+
+class TestHandlerProfiler(DbSetup):
+    def test_disabled_profiler_does_not_sample(self):
+        profiler = HandlerProfiler()
+        assert profiler.sample(self.sync_cls, self.model) is NULL_SAMPLE
+
+    def test_stats_are_aggregated_by_key(self):
+        profiler = HandlerProfiler(sample_rate=1)
+        sample = profiler.sample(self.sync_cls, self.bar)
+        for i in range(2):
+            with sample.measure(self.sync_cls.m2m_field, 'save'):
+                pass
+        with sample.measure(None, 'post_save'):
+            pass
+
+        stats = dict(profiler.report())
+        assert stats[('FooSync', 'Bar', 'm2m_field', 'save')].calls == 2
+        assert stats[('FooSync', 'Bar', None, 'post_save')].calls == 1
+        assert 'm2m_field' in profiler.format_report()
+
+    def test_report_is_sorted_by_total_time(self):
+        profiler = HandlerProfiler(sample_rate=1)
+        profiler.add(('FooSync', 'Foo', None, 'save'), 0.1)
+        profiler.add(('FooSync', 'Bar', 'm2m_field', 'save'), 0.5)
+        assert [key[1] for key, stat in profiler.report()] == ['Bar', 'Foo']
+
+
+class TestProfiledHandlers(DbSetup):
+    @patch('msync.signals.delete_parent')
+    def test_sampled_handler_is_measured(self, delete_mock):
+        connector = SignalConnector(self.sync_cls)
+        connector.profiler = HandlerProfiler(sample_rate=1)
+        connector._post_delete_handler(instance=NP(self.model, id=4), using='default')
+
+        keys = [key for key, stat in connector.profiler.report()]
+        assert set(keys) == {('FooSync', 'Foo', None, 'post_delete'), ('FooSync', 'Foo', None, 'delete')}
+        assert delete_mock.called
+
+
+def _fake_queries(n):
+    connection.queries.extend({'sql': 'SELECT 1', 'time': '0.010'} for i in range(n))
+
+
+class TestQueryCounting(DbSetup):
+    def test_counter_counts_and_cleans_queries(self):
+        start = len(connection.queries)
+        with QueryCounter() as counter:
+            assert connection.use_debug_cursor
+            _fake_queries(3)
+
+        assert counter.count == 3
+        assert round(counter.time, 3) == 0.03
+        assert len(connection.queries) == start
+        assert connection.use_debug_cursor is None
+
+    def test_queries_are_aggregated_by_sfield(self):
+        profiler = HandlerProfiler(sample_rate=1, count_queries=True)
+        sample = profiler.sample(self.sync_cls, self.bar)
+        with sample.measure(None, 'post_save'):
+            with sample.measure(self.sync_cls.m2m_field, 'save'):
+                _fake_queries(2)
+            _fake_queries(1)
+
+        stats = dict(profiler.report())
+        assert stats[('FooSync', 'Bar', 'm2m_field', 'save')].queries == 2
+        assert stats[('FooSync', 'Bar', None, 'post_save')].queries == 3
+
+    @patch('msync.profiling.logger')
+    def test_threshold_is_reported(self, logger_mock):
+        profiler = HandlerProfiler(sample_rate=1, count_queries=True, query_threshold=2)
+        sample = profiler.sample(self.sync_cls, self.bar)
+        with sample.measure(None, 'post_save'):
+            with sample.measure(self.sync_cls.m2m_field, 'save'):
+                _fake_queries(3)
+
+        message = logger_mock.warning.call_args[0][0]
+        assert '3 SQL queries' in message
+        assert 'm2m_field save=3' in message
+
+    def test_assertion_mode(self):
+        connector = SignalConnector(self.sync_cls)
+        connector.profiler = HandlerProfiler()
+        with patch('msync.profiling._profiler', connector.profiler):
+            with patch('msync.signals.delete_parent', side_effect=lambda *a, **kw: _fake_queries(2)):
+                with max_handler_queries(1):
+                    with pytest.raises(AssertionError):
+                        connector._post_delete_handler(instance=NP(self.model, id=4), using='default')
+                # вне контекста обработчики не проверяются
+                connector._post_delete_handler(instance=NP(self.model, id=4), using='default')
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from mock import Mock
+import pytest
+from mock import Mock, patch
 from msync.queryset import (QSPk, QSUpdate, QSUpdateParent, QSUpdateDependentField, QSClear, QSCreate,
-                            QSDelete, QSBase)
+                            QSDelete, QSDeleteIn, QSBase)
+from msync.merge import RawUpdate
 from .utils import NP, DbSetup
 
 
@@ -25,6 +27,44 @@ class TestQSPk(DbSetup):
         pk_path = QSPk(sync_cls=self.sync_cls, sfield=self.sync_cls.emb_field).get_path()
         assert pk_path == {'emb_field': None}
 
+    def test_shard_key(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        pk_path = QSPk(sync_cls=self.sync_cls, instance=NP(self.model, id=1, int_field=8)).get_path()
+        assert pk_path == {'id': 1, 'int_field': 8}
+
+    def test_shard_key_getter(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('emb_field.id',)
+        self.sync_cls._meta.shard_key_getter = lambda ins: {'emb_field.id': 15}
+        pk_path = QSPk(sync_cls=self.sync_cls, instance=NP(self.model, id=1)).get_path()
+        assert pk_path == {'id': 1, 'emb_field__id': 15}
+
+    def test_shard_key_values_are_cached(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        getter = self.sync_cls._meta.shard_key_getter = Mock(return_value={'int_field': 8})
+        instance = NP(self.model, id=1)
+        QSPk(sync_cls=self.sync_cls, instance=instance).get_path()
+        assert QSPk(sync_cls=self.sync_cls, instance=instance).get_path() == {'id': 1, 'int_field': 8}
+        getter.assert_called_once_with(instance)
+
+    def test_nested_shard_key_from_parents(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        parents = [NP(self.model, id=4, int_field=8), NP(self.model, id=5, int_field=15)]
+        with patch.object(self.sync_cls.fk_field, 'get_reverse_rel', return_value=lambda ins: parents):
+            pk_path = QSPk(sync_cls=self.sync_cls, instance=NP(self.qux, id=1), sfield=self.sync_cls.fk_field)
+            assert pk_path.get_path() == {'fk_field__id': 1, 'int_field__in': [8, 15]}
+
+    def test_nested_shard_key_getter(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        self.sync_cls._meta.nested_shard_key_getter = lambda sfield, ins: {'int_field': 8}
+        pk_path = QSPk(sync_cls=self.sync_cls, instance=NP(self.bar, id=1), sfield=self.sync_cls.m2m_field)
+        assert pk_path.get_path() == {'m2m_field__id': 1, 'int_field__in': [8]}
+
+    def test_nested_shard_key_cannot_be_found(self):
+        self.sync_cls._meta.collection_settings['shard_key'] = ('int_field',)
+        pk_path = QSPk(sync_cls=self.sync_cls, instance=NP(self.egg, id=1), sfield=self.sync_cls.emb_field)
+        with pytest.raises(TypeError):
+            pk_path.get_path()
+
     def test_hash(self):
         npk = lambda i: QSPk(sync_cls=self.sync_cls, pk=i)
         assert hash(npk(4)) == hash(npk(4))
@@ -57,6 +97,12 @@ class TestQSUpdateParent(DbSetup):
         path = QSUpdateParent(sync_cls=self.sync_cls, document=document).get_path()
         assert set(path.keys()) == set(['set__id', 'set__int_field'])
 
+    def test_update_parent_only_given_fields(self):
+        instance = NP(self.model)
+        document = self.sync_cls.create_document(instance)
+        path = QSUpdateParent(sync_cls=self.sync_cls, document=document, fields={'int_field'}).get_path()
+        assert set(path.keys()) == set(['set__int_field'])
+
 
 class TestQSUpdateDependentField(DbSetup):
     def test_update_dependent_field(self):
@@ -88,6 +134,38 @@ class TestQSCreate(DbSetup):
                         documents=[doc1, doc2]).get_path()
         assert path == {'push_all__m2m_field': [doc1, doc2]}
 
+    def test_bounded_list_push_modifiers(self):
+        sfield = self.sync_cls.m2m_field
+        sfield.max_length, sfield.sort = 2, '-str_field'
+        document = self.bar_sync.create_document(NP(self.bar))
+        modifiers = QSCreate(sync_cls=self.sync_cls, sfield=sfield, document=document).get_push_modifiers()
+        assert modifiers == {'m2m_field': {'$sort': {'str_field': -1}, '$slice': 2}}
+
+    def test_unbounded_list_has_no_push_modifiers(self):
+        document = self.bar_sync.create_document(NP(self.bar))
+        qs = QSCreate(sync_cls=self.sync_cls, sfield=self.sync_cls.m2m_field, document=document)
+        assert qs.get_push_modifiers() == {}
+
+    def test_bounded_values_are_sorted_and_trimmed(self):
+        sfield = self.sync_cls.m2m_field
+        docs = [self.bar_sync.create_document(NP(self.bar, str_field=s)) for s in ('b', 'c', 'a')]
+        sfield.max_length = 2
+        assert [d.str_field for d in sfield.bound_values(docs)] == ['c', 'a']
+        sfield.sort = '-str_field'
+        assert [d.str_field for d in sfield.bound_values(docs)] == ['c', 'b']
+
+    def test_bounded_values_with_missing_and_dotted_keys(self):
+        sfield = self.sync_cls.m2m_field
+        docs = [self.bar_sync.create_document(NP(self.bar, id=i, str_field=s)) for i, s in ((4, 'b'), (8, None))]
+        sfield.sort = 'str_field'
+        assert [d.id for d in sfield.bound_values(docs)] == [8, 4]
+        sfield.sort = '-str_field'
+        assert [d.id for d in sfield.bound_values(docs)] == [4, 8]
+
+        values = [Mock(author=Mock(age=age)) for age in (30, None, 20)]
+        sfield.sort = 'author.age'
+        assert [v.author.age for v in sfield.bound_values(values)] == [None, 20, 30]
+
 
 class TestQSDelete(DbSetup):
     def test_m2m_deleting(self):
@@ -129,3 +207,18 @@ class TestQSBase(DbSetup):
 
         qs = qs1 | qs2
         assert qs.get_path() == {'key1': 15, 'key2': 16, 'key3': 23, 'key4': 42}
+
+
+class TestQSDeleteIn(DbSetup):
+    def test_list_deleting(self):
+        path = QSDeleteIn(sync_cls=self.sync_cls, sfield=self.sync_cls.m2m_field, pks=[15, 16]).get_path()
+        assert path == {'$pull': {'m2m_field': {'id': {'$in': [15, 16]}}}}
+        assert isinstance(path, RawUpdate)
+
+    def test_emb_deleting(self):
+        path = QSDeleteIn(sync_cls=self.sync_cls, sfield=self.sync_cls.emb_field, pks=[15, 16]).get_path()
+        assert path == {'unset__emb_field': None}
+
+    def test_pk_filter(self):
+        path = QSPk(sync_cls=self.sync_cls, sfield=self.sync_cls.emb_field, pks=[15, 16]).get_path()
+        assert path == {'emb_field__id__in': [15, 16]}
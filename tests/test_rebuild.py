@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+from mock import MagicMock, Mock, patch
+import pytest
+from msync import fields as sfields
+from msync.batches import BatchQuery
+from msync.rebuild import (RebuildLog, rebuild, replay, get_rebuild_order, rebuild_all, format_summary,
+                           _rebuild_sync_cls)
+from msync.syncers import DocumentSync
+from .utils import NP, DbSetup
+
+
+class TestRebuildLog(DbSetup):
+    def setup(self):
+        super(TestRebuildLog, self).setup()
+        RebuildLog._active_cache.clear()
+        self.db = MagicMock()
+        self.db_patch = patch.object(self.sync_cls._meta.document, '_get_db', return_value=self.db)
+        self.db_patch.start()
+
+    def teardown(self):
+        self.db_patch.stop()
+        RebuildLog._active_cache.clear()
+
+    def test_record_is_skipped_without_rebuild(self):
+        self.db['msync_rebuilds'].find_one.return_value = None
+        RebuildLog(self.sync_cls).record({'id': 4})
+        assert not self.db['foos__rebuild_log'].insert.called
+
+    def test_record_and_pop(self):
+        log = RebuildLog(self.sync_cls)
+        log.start()
+        log.record({'m2m_field.id': {'$in': [4, 8]}})
+
+        inserted = self.db['foos__rebuild_log'].insert.call_args[0][0]
+        self.db['foos__rebuild_log'].find.return_value.sort.return_value = [dict(inserted, _id=1)]
+        assert log.pop() == [{'m2m_field.id': {'$in': [4, 8]}}]
+        self.db['foos__rebuild_log'].remove.assert_called_once_with({'_id': {'$lte': 1}})
+
+    def test_active_state_is_cached(self):
+        log = RebuildLog(self.sync_cls)
+        log.is_active()
+        log.is_active()
+        assert self.db['msync_rebuilds'].find_one.call_count == 1
+
+
+class TestRebuild(DbSetup):
+    def test_option_is_required(self):
+        with pytest.raises(TypeError):
+            rebuild(self.sync_cls)
+
+    def test_batch_query_captures_filters(self):
+        self.sync_cls._meta.shadow_rebuild = True
+        with patch.object(self.sync_cls._meta.document, 'objects') as objects_mock:
+            with patch.object(RebuildLog, 'record') as record_mock:
+                with BatchQuery(self.sync_cls) as b:
+                    b.delete(NP(self.bar, id=4), self.sync_cls.m2m_field)
+                    b.delete(NP(self.model, id=8))
+
+        assert objects_mock.filter.call_count == 2
+        assert [c[0][0] for c in record_mock.call_args_list] == [{'m2m_field.id': {'$in': [4]}},
+                                                                {'id': {'$in': [8]}}]
+
+    def test_replay_rebuilds_touched_documents(self):
+        log = Mock(**{'pop.return_value': [{'m2m_field.id': 4}]})
+        shadow = Mock(**{'name': 'foos__shadow', 'find.return_value': [{'id': 8}]})
+        live = Mock(**{'name': 'foos', 'find.return_value': [{'id': 15}]})
+        instance = NP(self.model, id=8)
+
+        with patch.object(self.sync_cls._meta.document, '_get_collection', return_value=live):
+            with patch.object(self.model, 'objects') as objects_mock:
+                objects_mock.db_manager.return_value.filter.return_value = [instance]
+                with patch.object(self.sync_cls, 'bulk_create_documents', return_value={instance: Mock()}):
+                    with patch('msync.rebuild.replace_documents') as replace_mock:
+                        assert replay(self.sync_cls, log, shadow) == 1
+
+        objects_mock.db_manager.return_value.filter.assert_called_once_with(pk__in=[8, 15])
+        assert replace_mock.call_args[1] == {'collection': shadow}
+        shadow.remove.assert_called_once_with({'id': {'$in': [15]}})
+
+    def test_rebuild_without_drop_replaces_documents(self):
+        instances = [NP(self.model, id=i) for i in (4, 8)]
+        documents = {ins: self.sync_cls.create_document(ins) for ins in instances}
+        collection = Mock()
+        with patch.object(self.sync_cls._meta.document, '_get_collection', return_value=collection), \
+                patch.object(self.model, 'objects', **{'db_manager.return_value.order_by.return_value': instances}), \
+                patch.object(self.sync_cls, 'bulk_create_documents_from_queryset', return_value=documents), \
+                patch('msync.rebuild.replace_documents') as replace_mock:
+            assert _rebuild_sync_cls(self.sync_cls, per_page=10, drop=False) == 2
+
+        assert not collection.remove.called
+        assert not collection.insert.called
+        assert replace_mock.call_args[1] == {'collection': collection}
+
+        with patch.object(self.sync_cls._meta.document, '_get_collection', return_value=collection), \
+                patch.object(self.model, 'objects', **{'db_manager.return_value.order_by.return_value': instances}), \
+                patch.object(self.sync_cls, 'bulk_create_documents_from_queryset', return_value=documents):
+            assert _rebuild_sync_cls(self.sync_cls, per_page=10, drop=True) == 2
+
+        collection.remove.assert_called_once_with()
+        assert collection.insert.call_count == 1
+
+    def test_replay_empty_log(self):
+        log = Mock(**{'pop.return_value': []})
+        assert replay(self.sync_cls, log, Mock()) == 0
+
+
+class TestRebuildAll(DbSetup):
+    def setup(self):
+        super(TestRebuildAll, self).setup()
+
+        class QuxDocSync(DocumentSync):
+            foo = sfields.ReferenceField(self.sync_cls, source='fk_field')
+
+            class Meta:
+                model = self.qux
+                collection = 'quxs'
+                fields = ('id', 'foo')
+
+        class EggDocSync(DocumentSync):
+            class Meta:
+                model = self.egg
+                collection = 'eggs'
+                fields = ('id', 'str_field')
+
+        self.qux_doc_sync = QuxDocSync
+        self.egg_doc_sync = EggDocSync
+        self.sync_classes = [self.qux_doc_sync, self.sync_cls, self.egg_doc_sync]
+
+    def test_order_by_references(self):
+        levels = get_rebuild_order(self.sync_classes)
+        assert levels == [[self.sync_cls, self.egg_doc_sync], [self.qux_doc_sync]]
+
+    def test_cyclic_references(self):
+        with patch('msync.rebuild.get_rebuild_dependencies', return_value={
+                self.sync_cls: {self.egg_doc_sync}, self.egg_doc_sync: {self.sync_cls}}):
+            with pytest.raises(TypeError):
+                get_rebuild_order([self.sync_cls, self.egg_doc_sync])
+
+    def test_rebuild_all(self):
+        loaded = []
+
+        def rebuild_sync_cls(sync_cls, per_page, drop, using):
+            loaded.append(sync_cls)
+            return 10
+
+        with patch('msync.rebuild._rebuild_sync_cls', side_effect=rebuild_sync_cls):
+            with patch('msync.rebuild._close_connections'):
+                results = rebuild_all(self.sync_classes, concurrency=2)
+
+        assert loaded.index(self.qux_doc_sync) > loaded.index(self.sync_cls)
+        assert [r.sync_cls for r in results] == [self.sync_cls, self.egg_doc_sync, self.qux_doc_sync]
+        assert all(r.rows == 10 and r.error is None for r in results)
+        assert 'QuxDocSync' in format_summary(results)
+
+    def test_dependents_of_failed_class_are_skipped(self):
+        def rebuild_sync_cls(sync_cls, per_page, drop, using):
+            if sync_cls is self.sync_cls:
+                raise ValueError('boom')
+            return 1
+
+        with patch('msync.rebuild._rebuild_sync_cls', side_effect=rebuild_sync_cls):
+            with patch('msync.rebuild._close_connections'):
+                results = {r.sync_cls: r for r in rebuild_all(self.sync_classes)}
+
+        assert isinstance(results[self.sync_cls].error, ValueError)
+        assert results[self.qux_doc_sync].skipped
+        assert results[self.egg_doc_sync].rows == 1
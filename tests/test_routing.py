@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import threading
+from django.test.utils import override_settings
+from mock import MagicMock, patch
+from mongoengine.context_managers import switch_collection
+from msync.bulk import resync
+from msync.batches import BatchQuery, BatchScope, BatchTask
+from msync.routing import get_db_alias_for, get_routed_alias, route_to
+from .utils import NP, DbSetup
+
+
+class TestRouting(DbSetup):
+    def test_route_to_is_thread_local(self):
+        document = self.sync_cls._meta.document
+        seen = []
+        with route_to(document, 'tenant'):
+            thread = threading.Thread(target=lambda: seen.append(get_routed_alias(document)))
+            thread.start()
+            thread.join()
+            assert get_routed_alias(document) == 'tenant'
+        assert seen == [None]
+        assert get_routed_alias(document) is None
+
+    def test_routed_collection(self):
+        document = self.sync_cls._meta.document
+        document._meta['auto_create_index'] = False
+        with patch('msync.routing.get_db', MagicMock()) as get_db_mock:
+            with route_to(document, 'tenant'):
+                collection = document._get_collection()
+                assert document._get_db() is get_db_mock.return_value
+
+        get_db_mock.assert_called_with('tenant')
+        assert collection is get_db_mock.return_value.__getitem__.return_value
+        get_db_mock.return_value.__getitem__.assert_called_with('foos')
+
+    def test_routed_collection_is_switched(self):
+        document = self.sync_cls._meta.document
+        document._meta['auto_create_index'] = False
+        with patch('msync.routing.get_db', MagicMock()) as get_db_mock:
+            with route_to(document, 'tenant'):
+                with switch_collection(document, 'foos__shadow'):
+                    document._get_collection()
+                document._get_collection()
+
+        names = [c[0][0] for c in get_db_mock.return_value.__getitem__.call_args_list]
+        assert sorted(set(names)) == ['foos', 'foos__shadow']
+
+    def test_resync_is_routed(self):
+        self.sync_cls._meta.db_aliases = {'tenant': 'mongo_tenant'}
+        document = self.sync_cls._meta.document
+        instance = NP(self.model, id=4)
+        aliases = []
+        with patch.object(self.model, 'objects') as objects_mock, \
+                patch.object(self.sync_cls, 'bulk_create_documents', return_value={}), \
+                patch('msync.bulk.replace_documents', lambda *args: aliases.append(get_routed_alias(document))):
+            objects_mock.db_manager.return_value.filter.return_value.order_by.return_value = [instance]
+            resync(self.sync_cls, [4], propagate=False, using='tenant')
+
+        objects_mock.db_manager.assert_called_once_with('tenant')
+        assert aliases == ['mongo_tenant']
+
+    def test_db_aliases(self):
+        self.sync_cls._meta.db_aliases = {'tenant': 'mongo_tenant'}
+        assert get_db_alias_for(self.sync_cls, 'tenant') == 'mongo_tenant'
+        assert get_db_alias_for(self.sync_cls, 'default') is None
+        assert get_db_alias_for(self.sync_cls, None) is None
+
+    @override_settings(MSYNC_DB_ALIASES={'tenant': 'mongo_settings'})
+    def test_db_aliases_from_settings(self):
+        assert get_db_alias_for(self.sync_cls, 'tenant') == 'mongo_settings'
+
+    def test_batch_query_is_routed(self):
+        self.sync_cls._meta.db_aliases = {'tenant': 'mongo_tenant'}
+        document = self.sync_cls._meta.document
+        aliases = []
+        with patch.object(BatchQuery, 'run_inserts', lambda b: aliases.append(get_routed_alias(document))):
+            with BatchQuery(self.sync_cls, using='tenant'):
+                pass
+            with BatchQuery(self.sync_cls):
+                pass
+        assert aliases == ['mongo_tenant', None]
+
+    def test_scope_keeps_batch_per_database(self):
+        with BatchScope() as scope:
+            with BatchQuery(self.sync_cls, using='tenant') as b1, BatchQuery(self.sync_cls) as b2:
+                assert b1 is not b2 and b1._using == 'tenant'
+            with BatchQuery(self.sync_cls, using='tenant') as b3:
+                assert b3 is b1
+            scope._batches.clear()
+
+    @patch('msync.batches.sync_task')
+    def test_task_gets_database(self, task_mock):
+        with BatchTask(self.sync_cls, using='tenant') as t:
+            t.add(4)
+        task_mock.apply_async.assert_called_once_with(args=(self.sync_cls, [4]), kwargs={'using': 'tenant'})
+
+    @patch('msync.signals.m2m_post_add')
+    def test_signal_passes_database(self, add_mock):
+        from msync.signals import SignalConnector
+        connector = SignalConnector(self.sync_cls)
+        with patch('msync.signals.BatchQuery') as batch_mock:
+            connector._m2m_changed_handler('post_add', NP(self.model, id=4), self.bar, {8}, using='tenant')
+        assert batch_mock.call_args[0] == (self.sync_cls, 'tenant')
+        assert add_mock.call_args[1]['using'] == 'tenant'
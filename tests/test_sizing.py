@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from msync.sizing import AdaptiveBatchSizer, PageStats
+
+MB = 1024 * 1024
+
+
+class TestAdaptiveBatchSizer(object):
+    def test_fast_pages_grow_gradually(self):
+        sizer = AdaptiveBatchSizer(page_size=1000, target_seconds=5)
+        assert sizer.update(PageStats(1000, sql_seconds=0.05, build_seconds=0.05)) == 2000
+        assert sizer.update(PageStats(2000, build_seconds=0.1)) == 4000
+
+    def test_slow_pages_shrink_to_target(self):
+        sizer = AdaptiveBatchSizer(page_size=1000, target_seconds=5)
+        assert sizer.update(PageStats(1000, sql_seconds=2, build_seconds=6, insert_seconds=2)) == 500
+
+    def test_large_documents_are_limited_by_memory(self):
+        sizer = AdaptiveBatchSizer(page_size=1000, max_page_bytes=64 * MB)
+        assert sizer.update(PageStats(1000, build_seconds=0.1, document_bytes=MB)) == 64
+
+    def test_min_page_size(self):
+        sizer = AdaptiveBatchSizer(page_size=100, min_page_size=10)
+        assert sizer.update(PageStats(100, build_seconds=1000)) == 10
+
+    def test_insert_chunk_size(self):
+        sizer = AdaptiveBatchSizer(max_message_bytes=16 * MB, insert_target_seconds=1)
+        assert sizer.get_insert_chunk_size(MB) == 16
+
+        sizer.update(PageStats(1000, insert_seconds=100))
+        assert sizer.get_insert_chunk_size(MB) == 10
+        assert sizer.get_insert_chunk_size(0) == 10
+
+    def test_measure_documents(self):
+        sizer = AdaptiveBatchSizer(sample_size=4)
+        average, largest = sizer.measure_documents([{'a': 1}, {'a': 'x' * 100}, {'a': 2}, {'a': 3}])
+        assert largest > average > 0
+        assert sizer.measure_documents([]) == (0, 0)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import bson
+from mock import MagicMock, patch
+from msync.snapshot import export_snapshot, import_snapshot, get_metadata
+from .utils import NP, DbSetup
+
+
+class TestSnapshot(DbSetup):
+    def setup(self):
+        super(TestSnapshot, self).setup()
+        self.instances = [NP(self.model, id=i, int_field=i * 10) for i in range(1, 6)]
+        self.patches = [
+            patch.object(self.model, 'objects',
+                         **{'db_manager.return_value.all.return_value.order_by.return_value': self.instances}),
+            patch.object(self.sync_cls, 'bulk_create_documents',
+                         side_effect=lambda ins: {i: self.sync_cls.create_document(i) for i in ins}),
+            patch.dict(self.sync_cls._meta.document._meta, index_specs=[
+                {'fields': [(name, 1)], 'background': True}
+                for name in ('emb_field.id', 'fk_field.id', 'm2m_field.id')]),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def teardown(self):
+        for p in self.patches:
+            p.stop()
+
+    def _read(self, file_path):
+        with open(file_path, 'rb') as f:
+            return list(bson.decode_file_iter(f))
+
+    def test_export_single_file(self, tmpdir):
+        files = export_snapshot(self.sync_cls, str(tmpdir), per_page=2, db_name='test')
+
+        directory = os.path.join(str(tmpdir), 'test')
+        assert files == [{'file': 'foos.bson', 'count': 5, 'min_pk': 1, 'max_pk': 5}]
+        assert [d['int_field'] for d in self._read(os.path.join(directory, 'foos.bson'))] == [10, 20, 30, 40, 50]
+        assert os.path.exists(os.path.join(directory, 'foos.metadata.json'))
+
+    def test_export_sharded_by_pk_range(self, tmpdir):
+        files = export_snapshot(self.sync_cls, str(tmpdir), per_page=2, shard_size=2, db_name='test')
+
+        assert [(f['file'], f['min_pk'], f['max_pk']) for f in files] == [
+            ('foos.0000.bson', 1, 2), ('foos.0001.bson', 3, 4), ('foos.0002.bson', 5, 5)]
+        assert os.path.exists(os.path.join(str(tmpdir), 'test', 'foos.manifest.json'))
+
+    def test_export_and_import_compressed(self, tmpdir):
+        export_snapshot(self.sync_cls, str(tmpdir), shard_size=3, compress=True, db_name='test')
+        assert sorted(os.listdir(os.path.join(str(tmpdir), 'test'))) == [
+            'foos.0000.bson.gz', 'foos.0001.bson.gz', 'foos.manifest.json', 'foos.metadata.json.gz']
+
+        db = MagicMock()
+        with patch.object(self.sync_cls._meta.document, '_get_db', return_value=db):
+            assert import_snapshot(self.sync_cls, str(tmpdir), batch_size=2, db_name='test') == 5
+
+        collection = db['foos']
+        inserted = [d['_id'] for c in collection.insert.call_args_list for d in c[0][0]]
+        assert inserted == [1, 2, 3, 4, 5]
+        assert collection.create_index.call_count == 3
+
+    def test_metadata_indexes(self):
+        indexes = get_metadata(self.sync_cls._meta.document, 'test')['indexes']
+        assert [index['name'] for index in indexes] == ['_id_', 'emb_field.id_1', 'fk_field.id_1', 'm2m_field.id_1']
+        assert all(index['ns'] == 'test.foos' for index in indexes)
+        assert all(index['background'] for index in indexes[1:])
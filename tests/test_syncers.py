@@ -1,11 +1,12 @@
+import threading
 import pytest
-from mock import Mock, MagicMock
+from mock import Mock, MagicMock, patch
 from django.db import models
 from mongoengine import fields as mfields
 from msync import fields as sfields
 from msync.syncers import DocumentSync, EmbeddedSync
 from msync.options import Options
-from .utils import DbSetup
+from .utils import DbSetup, NP
 
 
 class TestOptions(DbSetup):
@@ -32,3 +33,158 @@ class TestOptions(DbSetup):
 
     def test_collection_settings(self):
         assert self.sync_cls._meta.collection_settings == {'collection': 'foos', 'id_field': 'id'}
+
+    def test_plan_is_built_with_class(self):
+        plan = self.sync_cls._meta._plan
+        assert plan is not None
+        assert plan.nested_sfields == {self.sync_cls.m2m_field, self.sync_cls.fk_field, self.sync_cls.emb_field}
+        assert plan.depends_on_sfields == {self.sync_cls.dep_field, self.sync_cls.dep_field2}
+        assert set(plan.get_depends_on_sfields_of_model(self.bar)) == {self.sync_cls.dep_field,
+                                                                      self.sync_cls.dep_field2}
+        assert plan.get_nested_sfields_of_model(self.model) == ()
+        assert plan.all_models == {self.bar, self.qux, self.egg}
+        assert plan.simple_sfield_names == {'id', 'int_field'}
+
+    def test_plan_tracked_sync_classes(self):
+        plan = self.sync_cls._meta.plan
+        assert plan.get_tracked_sync_classes(self.model) == (self.sync_cls,)
+        assert plan.get_tracked_sync_classes(self.bar) == (self.bar_sync,)
+        assert plan.get_tracked_sync_classes(self.egg) == (self.egg_sync,)
+        assert plan.get_tracked_sync_classes(self.foo.m2m_field.through) == ()
+
+    def test_plan_sfield_paths(self):
+        plan = self.sync_cls._meta.plan
+        tree = self.sync_cls._meta.get_sync_tree()
+        for sfield in tree.get_all_sfields():
+            assert list(plan.get_sfield_path(sfield)) == tree.get_sfield_path(sfield)
+
+    def test_plan_is_immutable(self):
+        plan = self.sync_cls._meta.plan
+        with pytest.raises(TypeError):
+            plan.simple_sfields = ()
+        with pytest.raises(TypeError):
+            plan.nested_model_sfields[self.model] = ()
+
+    def test_has_some_field(self):
+        assert self.sync_cls.has_some_field(['not_included_field', 'int_field'])
+        assert not self.sync_cls.has_some_field(['not_included_field'])
+
+
+class TestBulkSourceThreads(DbSetup):
+    def _bulk_create(self, instances):
+        threads = {}
+        parallel = (self.sync_cls.m2m_field, self.sync_cls.fk_field, self.sync_cls.emb_field,
+                    self.sync_cls.dep_field, self.sync_cls.dep_field2)
+
+        def values_from_source(sfield):
+            def values(instances):
+                threads[sfield.name] = threading.current_thread()
+                return {ins: None for ins in instances}
+            return values
+
+        patchers = [patch.object(sf, 'values_from_source', side_effect=values_from_source(sf)) for sf in parallel]
+        for patcher in patchers:
+            patcher.start()
+        try:
+            with patch('msync.factories.close_old_connections'):
+                documents = self.sync_cls.bulk_create_documents(instances)
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+        return documents, threads
+
+    def test_sources_run_in_pool(self):
+        self.sync_cls._meta.bulk_source_threads = 2
+        instances = [NP(self.model, id=4, int_field=15)]
+        documents, threads = self._bulk_create(instances)
+
+        assert documents[instances[0]].int_field == 15
+        assert set(threads) == {'m2m_field', 'fk_field', 'emb_field', 'dep_field', 'dep_field2'}
+        assert all(thread is not threading.current_thread() for thread in threads.values())
+
+    def test_sources_run_in_order_by_default(self):
+        documents, threads = self._bulk_create([NP(self.model, id=4)])
+        assert all(thread is threading.current_thread() for thread in threads.values())
+
+    def test_model_sfields_have_no_bulk_query(self):
+        assert not self.sync_cls.int_field.has_bulk_query()
+        assert self.sync_cls.m2m_field.has_bulk_query()
+
+
+class TestColumnarBulkCreate(DbSetup):
+    def setup(self):
+        super(TestColumnarBulkCreate, self).setup()
+
+        class EggDocSync(DocumentSync):
+            class Meta:
+                model = self.egg
+                collection = 'eggs'
+                id_field = 'id'
+                fields = ('id', 'str_field')
+
+        class FooBarsSync(DocumentSync):
+            m2m_field = sfields.ListField(sfield=sfields.EmbeddedField(self.bar_sync), source='m2m_field.all')
+
+            class Meta:
+                model = self.foo
+                collection = 'foo_bars'
+                id_field = 'id'
+                fields = ('id', 'int_field', 'm2m_field')
+
+        self.egg_doc_sync = EggDocSync
+        self.foo_bars_sync = FooBarsSync
+
+    def test_simple_sync_class_uses_values_list(self):
+        queryset = MagicMock()
+        queryset.values_list.return_value = [(4, 4, 'a'), (8, 8, 'b')]
+        documents = self.egg_doc_sync.bulk_create_documents_from_queryset(queryset)
+
+        assert list(documents) == [4, 8]
+        assert documents[8].str_field == 'b'
+        queryset.values_list.assert_called_once_with('pk', 'id', 'str_field')
+        assert not queryset.__iter__.called
+
+    def test_rows_are_timed(self):
+        queryset, timings = MagicMock(), {}
+        queryset.values_list.return_value = [(4, 4, 'a')]
+        self.egg_doc_sync.bulk_create_documents_from_queryset(queryset, timings)
+        assert timings['sql_seconds'] >= 0
+
+    def test_instances_are_restricted_to_needed_columns(self):
+        instances = [NP(self.foo, id=4), NP(self.foo, id=8)]
+        queryset = MagicMock(db='tenant')
+        queryset.values_list.return_value = [(4, 15, 4), (8, 16, 8), (15, 23, 15)]
+        bars = {instances[0]: [NP(self.bar, id=23)], instances[1]: []}
+        with patch.object(self.foo_bars_sync.m2m_field, 'get_bulk_source', return_value=lambda _: bars), \
+                patch.object(self.foo, 'objects') as objects_mock:
+            only_mock = objects_mock.db_manager.return_value.only
+            only_mock.return_value.filter.return_value = instances  # row 15 was deleted in between
+            documents = self.foo_bars_sync.bulk_create_documents_from_queryset(queryset)
+
+        queryset.values_list.assert_called_once_with('pk', 'int_field', 'id')
+        objects_mock.db_manager.assert_called_once_with('tenant')
+        only_mock.assert_called_once_with('id')
+        only_mock.return_value.filter.assert_called_once_with(pk__in=[4, 8, 15])
+        assert [(d.id, d.int_field) for d in list(documents.values())[:2]] == [(4, 15), (8, 16)]
+        assert [bar.id for bar in documents[4].m2m_field] == [23] and documents[8].m2m_field == []
+        assert documents[15] is None
+
+    def test_instances_are_built_for_nested_fields(self):
+        factory = self.sync_cls._document_factory
+        assert factory.get_instance_columns(factory.get_columns()) is None
+
+        instances = [NP(self.model, id=4), NP(self.model, id=8)]
+        with patch.object(self.sync_cls, 'bulk_create_documents', return_value={instances[1]: 'doc'}):
+            documents = self.sync_cls.bulk_create_documents_from_queryset(instances)
+        assert documents == {4: None, 8: 'doc'}
+
+    def test_columns(self):
+        assert self.egg_doc_sync.str_field.get_column(self.egg) == 'str_field'
+        assert self.sync_cls.emb_field.get_column(self.foo) is None
+        assert self.sync_cls.dep_field.get_column(self.foo) is None
+
+    def test_instance_columns(self):
+        assert self.sync_cls.m2m_field.get_instance_columns(self.foo) == []
+        assert self.sync_cls.emb_field.get_instance_columns(self.foo) == ['emb_field']
+        assert self.sync_cls.fk_field.get_instance_columns(self.foo) is None
+        assert self.sync_cls.dep_field.get_instance_columns(self.foo) is None
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+from msync.tracking import ChangeTracker
+from msync.signals import SignalConnector
+from .utils import NP, DbSetup
+
+
+class TestChangeTracker(DbSetup):
+    def setup(self):
+        super(TestChangeTracker, self).setup()
+        self.tracker = ChangeTracker(self.sync_cls)
+
+    def test_no_snapshot(self):
+        ins = NP(self.model, id=4, int_field=8)
+        assert self.tracker.get_changed_fields(ins, self.sync_cls) is None
+
+    def test_nothing_changed(self):
+        ins = NP(self.model, id=4, int_field=8)
+        self.tracker.snapshot(ins, self.sync_cls)
+        assert self.tracker.get_changed_fields(ins, self.sync_cls) == set()
+
+    def test_changed_field(self):
+        ins = NP(self.model, id=4, int_field=8)
+        self.tracker.snapshot(ins, self.sync_cls)
+        ins.int_field = 15
+        assert self.tracker.get_changed_fields(ins, self.sync_cls) == {'int_field'}
+
+    def test_owners_do_not_share_snapshots(self):
+        ins = NP(self.model, id=4, int_field=8)
+        self.tracker.snapshot(ins, self.sync_cls)
+        assert ChangeTracker(self.bar_sync).get_changed_fields(ins, self.sync_cls) is None
+
+
+class TestPostSaveChangedFields(DbSetup):
+    def setup(self):
+        super(TestPostSaveChangedFields, self).setup()
+        self.connector = SignalConnector(self.sync_cls)
+
+    def _save(self, ins, update_fields=None):
+        self.connector._post_save_handler(instance=ins, raw=False, created=False, using='default',
+                                          update_fields=update_fields)
+
+    @patch('msync.signals.save_parent_sfields')
+    def test_unchanged_save_is_skipped(self, save_mock):
+        ins = NP(self.model, id=4, int_field=8)
+        self.connector._post_init_handler(ins)
+        self._save(ins)
+        assert not save_mock.called
+
+    @patch('msync.signals.save_parent_sfields')
+    def test_only_changed_fields_are_sent(self, save_mock):
+        ins = NP(self.model, id=4, int_field=8)
+        self.connector._post_init_handler(ins)
+        ins.int_field = 15
+        self._save(ins)
+        assert save_mock.call_args[1]['fields'] == {'int_field'}
+
+    @patch('msync.signals.save_parent_sfields')
+    def test_snapshot_is_refreshed_after_save(self, save_mock):
+        ins = NP(self.model, id=4, int_field=8)
+        self.connector._post_init_handler(ins)
+        ins.int_field = 15
+        self._save(ins)
+        self._save(ins)
+        assert save_mock.call_count == 1
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import threading
+from mock import Mock, patch
+from msync.batches import BatchQuery, BatchTask
+from msync.writebehind import WriteBehindFlusher
+from .utils import DbSetup
+
+
+class TestWriteBehindFlusher(DbSetup):
+    def test_flush_groups_tasks_by_sync_cls(self):
+        flusher = WriteBehindFlusher()
+        tasks = [Mock(), Mock(), Mock()]
+        flusher._queue.put((self.sync_cls, None, tasks[0]))
+        flusher._queue.put((self.bar_sync, None, tasks[1]))
+        flusher._queue.put((self.sync_cls, None, tasks[2]))
+        flusher.flush()
+
+        batch = tasks[0].call_args[0][0]
+        assert isinstance(batch, BatchQuery) and batch._sync_cls == self.sync_cls
+        assert tasks[2].call_args[0][0] is batch
+        assert tasks[1].call_args[0][0]._sync_cls == self.bar_sync
+
+    def test_stop_drains_queue(self):
+        flusher = WriteBehindFlusher(flush_size=100, flush_interval=60)
+        tasks = [Mock() for _ in range(3)]
+        flusher.put(self.sync_cls, tasks)
+        flusher.stop(timeout=5)
+
+        assert all(task.call_count == 1 for task in tasks)
+        assert not flusher._thread.is_alive()
+
+    def test_full_queue_runs_synchronously(self):
+        flusher = WriteBehindFlusher(max_size=1, put_timeout=0.01)
+        calls = Mock()
+        with patch.object(flusher, '_ensure_started'):
+            flusher.put(self.sync_cls, [calls.old, calls.new])
+        assert [c[0] for c in calls.mock_calls] == ['old', 'new']
+        assert flusher._queue.empty()
+
+    def test_full_queue_runs_pending_tasks_first(self):
+        flusher = WriteBehindFlusher(max_size=1, put_timeout=0.01)
+        calls = Mock()
+        flusher._pending.append((self.sync_cls, None, calls.oldest))
+        with patch.object(flusher, '_ensure_started'):
+            flusher.put(self.sync_cls, [calls.old, calls.new])
+        assert [c[0] for c in calls.mock_calls] == ['oldest', 'old', 'new']
+        assert not flusher._pending
+
+    def test_stop_with_full_queue(self):
+        flusher = WriteBehindFlusher(max_size=1, flush_size=1)
+        started, release = threading.Event(), threading.Event()
+        blocking = Mock(side_effect=lambda b: started.set() or release.wait(5))
+        last = Mock()
+        flusher.put(self.sync_cls, [blocking])
+        assert started.wait(5)
+        flusher.put(self.sync_cls, [last])
+
+        threading.Timer(0.1, release.set).start()
+        flusher.stop(timeout=5)
+        assert last.call_count == 1 and not flusher._thread.is_alive()
+
+    def test_batch_task_uses_flusher(self):
+        self.sync_cls._meta.async_backend = 'thread'
+        with patch('msync.batches.get_flusher') as get_flusher_mock:
+            with BatchTask(self.sync_cls) as t:
+                t.add(4)
+        get_flusher_mock.return_value.put.assert_called_once_with(self.sync_cls, [4], using=None)